@@ -183,6 +183,43 @@ if st.session_state["authentication_status"]:
     elif view_mode == "database" and user_role in ["admin", "manager"]:
         st.header("📂 Dữ liệu hệ thống")
         st.info("Chức năng xem database trực tiếp đang bảo trì khi chuyển lên Cloud.")
+
+        # [NEW] Trạng thái kết nối (Circuit Breaker + Pool)
+        from db_utils import get_db_health
+        health = get_db_health()
+        brk = health["breaker"]
+        st.subheader("🔌 Kết nối Cloud (Supabase)")
+        c1, c2, c3 = st.columns(3)
+        c1.metric("Trạng thái", brk["state"].upper())
+        c2.metric("Thời gian ở trạng thái hiện tại", f"{brk['current_state_for']:.0f}s")
+        c3.metric("Số lần chuyển trạng thái", brk["transitions"])
+        st.dataframe(pd.DataFrame(
+            [{"Trạng thái": k, "Tổng thời gian (s)": round(v, 1)} for k, v in brk["seconds_in_state"].items()]
+        ), hide_index=True)
+        if brk["last_error"]: st.caption(f"Lỗi gần nhất: {brk['last_error']}")
+        st.subheader("🏊 Connection Pool")
+        st.dataframe(pd.DataFrame(health["pools"]), hide_index=True)
+        if health["log_queue"]:
+            st.subheader("📝 Hàng đợi ghi log")
+            st.dataframe(pd.DataFrame([health["log_queue"]]), hide_index=True)
+        st.subheader("🗃️ Cache dùng chung")
+        st.json(health["cache"])
+
+        # [NEW] Kiểm tra index cho các truy vấn nóng (EXPLAIN)
+        st.subheader("📇 Index truy vấn nóng")
+        if st.button("Chạy EXPLAIN"):
+            from db_utils import check_hot_query_indexes
+            report = check_hot_query_indexes()
+            if report and not all(r["uses_index"] for r in report):
+                st.warning("Có truy vấn đang quét toàn bảng - kiểm tra migration.")
+            st.dataframe(pd.DataFrame(report), hide_index=True)
+
+        # Bảng tổng hợp lượt làm câu hỏi (question_attempt_stats) dựng lại từ learning_logs
+        if st.button("Tổng hợp lại thống kê câu hỏi"):
+            from db_utils import rebuild_question_attempt_stats
+            ok, msg = rebuild_question_attempt_stats()
+            (st.success if ok else st.error)(msg)
+
         if st.button("Đóng"):
             st.session_state["view_mode"] = "home"; st.rerun()
 
@@ -0,0 +1,159 @@
+"""
+Benchmark: one answer submit, legacy flow vs. unit-of-work grade_and_update.
+
+Runs against a temporary copy of local_course.db (SQLite fallback, no secrets),
+so it never touches real data. Reports per submit:
+  - connections : get_connection() checkouts (each was a fresh connect before pooling)
+  - statements  : SQL round trips seen by the driver (incl. BEGIN/COMMIT)
+  - commits
+  - p50 / p95 latency (ms)
+
+Usage: python bench_grade_and_update.py [n_submits] [simulated_rtt_ms]
+  simulated_rtt_ms: sleep per SQL round trip, to approximate Supabase latency (default 0)
+"""
+import io
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+from unittest import mock
+
+import pandas as pd
+import streamlit as st
+
+st.secrets = {}  # No Supabase -> SQLite fallback
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import db_utils
+import practice_engine
+from db_pool import pool_stats
+
+SUBJECT = "BENCH_UOW"
+USER = "bench_user"
+NODE = "B.4"
+PARENTS = ["B.1", "B.2", "B.3"]
+
+
+def setup_db():
+    tmp_dir = tempfile.mkdtemp(prefix="bench_uow_")
+    db_path = os.path.join(tmp_dir, "bench.db")
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "local_course.db")
+    if os.path.exists(src):
+        shutil.copy(src, db_path)
+    db_utils.LOCAL_DB_PATH = db_path
+    db_utils.init_db()
+
+    conn = db_utils.get_connection()
+    db_utils.execute_many(conn, "INSERT INTO knowledge_structure (source, target, subject_id) VALUES (%s, %s, %s)",
+                          [(p, NODE, SUBJECT) for p in PARENTS])
+    conn.commit()
+    conn.close()
+    for p in PARENTS:
+        db_utils.save_progress(USER, p, SUBJECT, "Completed", 0.9)
+    db_utils.get_graph_structure.clear()
+
+    q_df = pd.DataFrame([{
+        "question_id": f"BQ{i}", "skill_id_list": NODE, "content": f"Q{i}",
+        "options": str(["A. a", "B. b", "C. c", "D. d"]), "answer": "A", "difficulty": "medium",
+    } for i in range(20)])
+    return tmp_dir, q_df
+
+
+class StatementCounter:
+    """sqlite3 trace callback on this thread's pooled connection; optionally sleeps `rtt` per statement."""
+
+    def __init__(self, rtt=0.0):
+        self.rtt = rtt
+        self.statements = 0
+        self.commits = 0
+
+    def __call__(self, sql):
+        self.statements += 1
+        if sql.strip().upper().startswith("COMMIT"):
+            self.commits += 1
+        if self.rtt:
+            time.sleep(self.rtt)  # Simulated network round trip to the cloud DB
+
+
+def checkouts():
+    return sum(p.get("checkouts", 0) for p in pool_stats())
+
+
+def _legacy_penalize_parents(username, subject_id, node_id, penalty_factor=0.15, conn=None, threshold=None):
+    """Baseline penalize_parents: SELECT on one connection, then one save_progress per parent."""
+    k_df = db_utils.get_graph_structure(subject_id)
+    parents = k_df[k_df['target'] == node_id]['source'].tolist()
+    if not parents: return
+    own = db_utils.get_connection()
+    placeholders = ','.join(['%s'] * len(parents))
+    rows = db_utils.execute_query(
+        own, f"SELECT node_id, status, score FROM user_progress WHERE username=%s AND subject_id=%s AND node_id IN ({placeholders})",
+        (username, subject_id, *parents)).fetchall()
+    own.close()
+    for p_node, p_status, p_score in rows:
+        db_utils.save_progress(username, p_node, subject_id, p_status, max(0.0, p_score - penalty_factor))
+
+
+@contextmanager
+def _legacy_unit_of_work():
+    yield object()  # Truthy placeholder: helpers below ignore it and use their own connection
+
+
+def _own_connection(fn):
+    def wrapper(*args, conn=None, **kwargs):
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def legacy_submit(q, selected, q_df):
+    """Same grade_and_update code, with the baseline per-step connections + commits patched in."""
+    with mock.patch.object(practice_engine, "unit_of_work", _legacy_unit_of_work), \
+         mock.patch.object(practice_engine, "penalize_parents", _legacy_penalize_parents), \
+         mock.patch.object(practice_engine, "save_progress", _own_connection(db_utils.save_progress)), \
+         mock.patch.object(practice_engine, "log_activity", _own_connection(db_utils.log_activity)), \
+         mock.patch.object(practice_engine, "get_mastered_question_ids", _own_connection(db_utils.get_mastered_question_ids)):
+        practice_engine.grade_and_update(q, selected, USER, SUBJECT, NODE, {}, q_df, 0.7, 0.3)
+
+
+def uow_submit(q, selected, q_df):
+    practice_engine.grade_and_update(q, selected, USER, SUBJECT, NODE, {}, q_df, 0.7, 0.3)
+
+
+def run(label, submit, q_df, n, rtt_ms):
+    conn = db_utils.get_connection()  # Per-thread pooled connection: the callback stays attached
+    counter = StatementCounter(rtt_ms / 1000.0)
+    conn.set_trace_callback(counter)
+    conn.close()
+    start_checkouts = checkouts()
+    latencies = []
+    for i in range(n):
+        q = q_df.iloc[i % len(q_df)].to_dict()
+        selected = "A. a" if i % 2 == 0 else "B. b"  # Alternate correct / wrong
+        t0 = time.perf_counter()
+        with redirect_stdout(io.StringIO()):  # grade_and_update prints a DEBUG line per answer
+            submit(q, selected, q_df)
+        latencies.append((time.perf_counter() - t0) * 1000)
+    conn.set_trace_callback(None)
+
+    latencies.sort()
+    p95 = latencies[max(0, int(round(0.95 * len(latencies))) - 1)]
+    print(f"{label:<16} conn/submit={(checkouts() - start_checkouts) / n:5.2f}  "
+          f"stmts/submit={counter.statements / n:5.2f}  commits/submit={counter.commits / n:4.2f}  "
+          f"p50={statistics.median(latencies):6.2f}ms  p95={p95:6.2f}ms")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rtt_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    tmp_dir, q_df = setup_db()
+    try:
+        db_utils.LOG_WRITE_BEHIND = False  # Legacy flow wrote logs inline
+        print(f"{n} submits (half correct, half wrong with 3 parents), simulated RTT {rtt_ms}ms")
+        run("before (legacy)", legacy_submit, q_df, n, rtt_ms)
+        run("after (uow)", uow_submit, q_df, n, rtt_ms)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,388 @@
+"""
+Pluggable cache backend for the shared read-mostly datasets
+(get_all_subjects / get_all_questions / get_graph_structure).
+
+st.cache_data is per process, so each replica behind nginx loads and keeps its
+own copy. @shared_cache stores the pickled result in a backend picked by
+CACHE_BACKEND_URL, so one replica's load serves all of them:
+
+    memory://                     in-process (default, same as before)
+    sqlite:////data/cache.db      file on a volume shared by the replicas
+    redis://redis:6379/0          Redis-protocol server (needs the `redis` package)
+
+Keys are versioned: <namespace>:<function>:g<generation>:<args hash>. fn.clear()
+bumps the function's generation in the backend, so every replica stops using
+the old entries at once; they simply expire.
+"""
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+CACHE_BACKEND_URL = os.environ.get("CACHE_BACKEND_URL", "memory://")
+CACHE_NAMESPACE = os.environ.get("CACHE_NAMESPACE", "tk:v1")  # Bump when cached shapes change
+COMPRESS_MIN_BYTES = 64 * 1024
+
+_RAW = b"P"
+_ZLIB = b"Z"
+
+
+# ============================================================
+# 📦 SERIALIZATION
+# ============================================================
+
+def dumps(value):
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(data) >= COMPRESS_MIN_BYTES:
+        return _ZLIB + zlib.compress(data, 1)  # Level 1: big win on text columns, ~no CPU
+    return _RAW + data
+
+
+def loads(blob):
+    if blob[:1] == _ZLIB:
+        return pickle.loads(zlib.decompress(blob[1:]))
+    return pickle.loads(blob[1:])
+
+
+# ============================================================
+# 🗄️ BACKENDS (bytes in, bytes out)
+# ============================================================
+
+class MemoryBackend:
+    """In-process LRU with per-key TTL."""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] is not None and item[0] < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.time() + ttl if ttl else None, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        """Set only if absent; True if this call set it (used as a load lock)."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (item[0] is None or item[0] >= time.time()):
+                return False
+            self._data[key] = (time.time() + ttl if ttl else None, value)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            value = int(item[1]) + 1 if item else 1
+            self._data[key] = (None, str(value).encode())
+            return value
+
+    def stats(self):
+        return {"backend": "memory", "entries": len(self._data)}
+
+
+class SQLiteBackend:
+    """Cache table in a SQLite file; share the file (volume) between replicas."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""CREATE TABLE IF NOT EXISTS cache_entries (
+                            key TEXT PRIMARY KEY, value BLOB, expires_at REAL)""")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute("SELECT value, expires_at FROM cache_entries WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return bytes(row[0])
+
+    def set(self, key, value, ttl=None):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+                     (key, value, now + ttl if ttl else None))
+        conn.execute("DELETE FROM cache_entries WHERE expires_at < ?", (now,))
+        conn.commit()
+
+    def add(self, key, value, ttl=None):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("DELETE FROM cache_entries WHERE key = ? AND expires_at < ?", (key, now))
+        c = conn.execute("INSERT OR IGNORE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, value, now + ttl if ttl else None))
+        conn.commit()
+        return c.rowcount == 1
+
+    def delete(self, key):
+        conn = self._conn()
+        conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+        conn.commit()
+
+    def incr(self, key):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM cache_entries WHERE key = ?", (key,)).fetchone()
+            value = int(bytes(row[0])) + 1 if row else 1
+            conn.execute("INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, NULL)",
+                         (key, str(value).encode()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return value
+
+    def stats(self):
+        n = self._conn().execute("SELECT count(*) FROM cache_entries").fetchone()[0]
+        return {"backend": "sqlite", "path": self.path, "entries": n}
+
+
+class RedisBackend:
+    def __init__(self, url):
+        if redis is None:
+            raise ImportError("redis package not installed")
+        self.url = url
+        self._client = redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2)
+
+    def get(self, key):
+        return self._client.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, value, ex=int(ttl) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self._client.set(key, value, ex=int(ttl) if ttl else None, nx=True))
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def incr(self, key):
+        return int(self._client.incr(key))
+
+    def stats(self):
+        return {"backend": "redis", "url": self.url, "entries": self._client.dbsize()}
+
+
+def backend_from_url(url):
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url[len("sqlite:///"):])
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisBackend(url)
+    return MemoryBackend()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+_fallback = MemoryBackend()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                try:
+                    _backend = backend_from_url(CACHE_BACKEND_URL)
+                except Exception as e:
+                    print(f"⚠️ Cache backend '{CACHE_BACKEND_URL}' unavailable ({e}), using in-process cache.")
+                    _backend = _fallback
+    return _backend
+
+
+# ============================================================
+# 🎯 DECORATOR
+# ============================================================
+
+_registry = {}
+_stats = {"hits": 0, "misses": 0, "loads": 0, "errors": 0}
+
+
+_key_locks = {}  # key -> [lock, waiters]: one in-process loader per cache key
+_key_locks_mutex = threading.Lock()
+
+
+@contextmanager
+def _key_lock(key):
+    """Serialize loaders of the same key only; other keys of the same function load in parallel."""
+    with _key_locks_mutex:
+        entry = _key_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _key_locks_mutex:
+            entry[1] -= 1
+            if not entry[1]:
+                del _key_locks[key]
+
+
+def _args_key(args, kwargs):
+    raw = pickle.dumps((args, sorted(kwargs.items())), protocol=pickle.HIGHEST_PROTOCOL)
+    return hashlib.md5(raw).hexdigest()[:16]
+
+
+def shared_cache(ttl=3600, name=None, lock_timeout=30.0, version=None):
+    """
+    Cache fn's result in the shared backend. Callers get a fresh copy each
+    time (like st.cache_data), so mutating the returned DataFrame is safe.
+    Concurrent misses for the same key (any replica) wait for one loader.
+    version(*args, **kwargs): extra key part (e.g. the subject's content_version),
+    so a bump only retires the entries it covers.
+    """
+    def decorator(fn):
+        fn_name = name or fn.__name__
+        gen_key = f"{CACHE_NAMESPACE}:{fn_name}:gen"
+
+        def generation(backend):
+            raw = backend.get(gen_key)
+            return int(raw) if raw else 0
+
+        def cached_call(backend, args, kwargs):
+            key = f"{CACHE_NAMESPACE}:{fn_name}:g{generation(backend)}"
+            if version is not None:
+                key += f":v{version(*args, **kwargs)}"
+            key += f":{_args_key(args, kwargs)}"
+            blob = backend.get(key)
+            if blob is not None:
+                _stats["hits"] += 1
+                return loads(blob)
+
+            _stats["misses"] += 1
+            with _key_lock(key):  # One loader per key per process...
+                lock_key = key + ":loading"
+                deadline = time.time() + lock_timeout
+                # ...and one per cluster: the others poll for its result
+                while not backend.add(lock_key, b"1", ttl=lock_timeout):
+                    blob = backend.get(key)
+                    if blob is not None:
+                        _stats["hits"] += 1
+                        return loads(blob)
+                    if time.time() > deadline:
+                        break
+                    time.sleep(0.1)
+                try:
+                    blob = backend.get(key)
+                    if blob is not None:
+                        return loads(blob)
+                    value = fn(*args, **kwargs)
+                    _stats["loads"] += 1
+                    backend.set(key, dumps(value), ttl)
+                    return value  # Only the backend keeps the pickled copy
+                finally:
+                    backend.delete(lock_key)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            backend = get_backend()
+            try:
+                return cached_call(backend, args, kwargs)
+            except Exception as e:
+                if backend is _fallback:
+                    raise
+                # Shared cache unreachable: keep caching per process until it is back
+                _stats["errors"] += 1
+                print(f"Cache Error ({fn_name}): {e}")
+                return cached_call(_fallback, args, kwargs)
+
+        def clear():
+            """Invalidate every cached result of this function on all replicas."""
+            _fallback.incr(gen_key)
+            try:
+                get_backend().incr(gen_key)
+            except Exception as e:
+                print(f"Cache Clear Error ({fn_name}): {e}")
+
+        wrapper.clear = clear
+        _registry[fn_name] = wrapper
+        return wrapper
+    return decorator
+
+
+def get_or_load(key, loader, ttl):
+    """Small shared value (e.g. a version counter): backend first, else loader() and store."""
+    key = f"{CACHE_NAMESPACE}:{key}"
+    backend = get_backend()
+    try:
+        blob = backend.get(key)
+    except Exception as e:
+        _stats["errors"] += 1
+        print(f"Cache Error ({key}): {e}")
+        backend = _fallback
+        blob = backend.get(key)
+    if blob is not None:
+        return loads(blob)
+    with _key_lock(key):  # Concurrent misses of this key run loader() once
+        try:
+            blob = backend.get(key)
+        except Exception:
+            blob = None
+        if blob is not None:
+            return loads(blob)
+        value = loader()
+        try:
+            backend.set(key, dumps(value), ttl)
+        except Exception as e:
+            print(f"Cache Error ({key}): {e}")
+    return value
+
+
+def invalidate(*keys):
+    for key in keys:
+        _fallback.delete(f"{CACHE_NAMESPACE}:{key}")
+        try:
+            get_backend().delete(f"{CACHE_NAMESPACE}:{key}")
+        except Exception as e:
+            print(f"Cache Invalidate Error ({key}): {e}")
+
+
+def clear_all():
+    for wrapper in _registry.values():
+        wrapper.clear()
+
+
+def cache_stats():
+    try:
+        info = get_backend().stats()
+    except Exception as e:
+        info = {"backend": CACHE_BACKEND_URL, "error": str(e)}
+    return {**info, **_stats, "functions": sorted(_registry)}
@@ -0,0 +1,109 @@
+"""
+Circuit breaker for the Supabase -> SQLite fallback in db_utils.get_connection().
+
+CLOSED     normal: callers try the cloud DB.
+OPEN       cloud DB is down: callers skip it immediately and use local SQLite.
+HALF_OPEN  the background probe is running its trial connect; callers still skip.
+
+Only the probe thread ever pays the connect timeout while the breaker is not
+CLOSED, so a page render with dozens of DB calls decides the fallback in
+microseconds instead of 3 s per call.
+"""
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=2, probe_interval=15.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._since = time.monotonic()
+        self._time_in_state = {CLOSED: 0.0, OPEN: 0.0, HALF_OPEN: 0.0}
+        self._failures = 0
+        self._transitions = 0
+        self._last_error = None
+        self._probe_fn = None
+        self._probe_thread = None
+
+    # --- state machine (call with lock held) ---
+    def _set_state(self, new_state):
+        if new_state == self._state:
+            return
+        now = time.monotonic()
+        self._time_in_state[self._state] += now - self._since
+        print(f"🔌 Circuit '{self.name}': {self._state} -> {new_state}")
+        self._state = new_state
+        self._since = now
+        self._transitions += 1
+
+    # --- caller API ---
+    @property
+    def state(self):
+        return self._state
+
+    def allow_request(self):
+        """Lock-free fast path: only CLOSED lets callers try the protected resource."""
+        return self._state == CLOSED
+
+    def record_success(self):
+        if self._state == CLOSED and self._failures == 0:
+            return
+        with self._lock:
+            self._failures = 0
+            self._set_state(CLOSED)
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self._failures += 1
+            self._last_error = str(error) if error else None
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._set_state(OPEN)
+                self._start_probe_locked()
+
+    # --- background probe ---
+    def set_probe(self, probe_fn):
+        """probe_fn() must raise if the resource is still unavailable."""
+        self._probe_fn = probe_fn
+
+    def _start_probe_locked(self):
+        if self._probe_fn is None:
+            return
+        if self._probe_thread is not None and self._probe_thread.is_alive():
+            return
+        self._probe_thread = threading.Thread(
+            target=self._probe_loop, name=f"breaker-probe-{self.name}", daemon=True)
+        self._probe_thread.start()
+
+    def _probe_loop(self):
+        while self._state != CLOSED:
+            time.sleep(self.probe_interval)
+            with self._lock:
+                self._set_state(HALF_OPEN)
+            try:
+                self._probe_fn()
+            except Exception as e:
+                self.record_failure(e)
+            else:
+                self.record_success()
+
+    def stats(self):
+        with self._lock:
+            durations = dict(self._time_in_state)
+            durations[self._state] += time.monotonic() - self._since
+            return {
+                "name": self.name,
+                "state": self._state,
+                "seconds_in_state": durations,
+                "current_state_for": durations[self._state] - self._time_in_state[self._state],
+                "consecutive_failures": self._failures,
+                "transitions": self._transitions,
+                "last_error": self._last_error,
+            }
@@ -0,0 +1,139 @@
+"""
+Concurrent data prefetch for page bootstrap.
+
+A page declares the independent reads it needs up front; they are fetched in
+parallel on a shared thread pool (each worker checks out its own pooled
+connection), so the first paint waits for the slowest read instead of the sum
+of all of them. Page-level loaders (e.g. a cached packet decode) go in `extra`:
+
+    data = prefetch_page_data({"role", "progress"}, username, subject_id,
+                              extra={"meta": lambda: load_meta_data(subject_id, version)})
+    k_df, q_df, chapters = data.extra["meta"]
+    store = get_mastery_store(username, subject_id, rows=data.progress)
+
+Loaders are the normal db_utils functions, so cached ones (st.cache_data) are
+warmed for any later call in the same run.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:
+    add_script_run_ctx = get_script_run_ctx = None
+
+from db_utils import (
+    get_all_subjects, get_graph_structure, get_all_questions,
+    get_user_progress, get_user_role, get_user_settings
+)
+
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", "6"))
+PREFETCH_TIMEOUT = float(os.environ.get("PREFETCH_TIMEOUT", "30"))
+
+
+@dataclass
+class PageData:
+    """Typed bundle returned by prefetch_page_data (None = not requested)."""
+    username: str
+    subject_id: Optional[str]
+    subjects: Optional[List[Tuple[str, str]]] = None
+    graph: Optional[pd.DataFrame] = None
+    questions: Optional[pd.DataFrame] = None
+    progress: Optional[List[tuple]] = None
+    role: Optional[str] = None
+    settings: Optional[Tuple[float, float]] = None
+    extra: Dict[str, Any] = field(default_factory=dict)
+    timings_ms: Dict[str, float] = field(default_factory=dict)
+    total_ms: float = 0.0
+
+    def matches(self, subject_id):
+        """Subject-scoped fields are only valid for the subject they were fetched for."""
+        return self.subject_id is not None and self.subject_id == subject_id
+
+
+# dataset -> (loader(username, subject_id), needs a subject)
+DATASETS = {
+    "subjects": (lambda u, s: get_all_subjects(), False),
+    "role": (lambda u, s: get_user_role(u), False),
+    "graph": (lambda u, s: get_graph_structure(s), True),
+    "questions": (lambda u, s: get_all_questions(s), True),
+    "progress": (lambda u, s: get_user_progress(u, s), True),
+    "settings": (lambda u, s: get_user_settings(u, s), True),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+    return _executor
+
+
+def _timed(name, loader, ctx, timings):
+    thread = threading.current_thread()
+    attached = ctx is not None and add_script_run_ctx is not None
+    if attached:
+        # Let st.cache_data / session_state in the worker see the session (no "missing ScriptRunContext")
+        add_script_run_ctx(thread, ctx)
+    t0 = time.perf_counter()
+    try:
+        return loader()
+    finally:
+        timings[name] = (time.perf_counter() - t0) * 1000
+        if attached:
+            # Pool threads are shared by every session: don't leave this one's context behind
+            for attr, value in list(vars(thread).items()):
+                if value is ctx:
+                    delattr(thread, attr)
+
+
+def prefetch_page_data(needs, username, subject_id=None, timeout=PREFETCH_TIMEOUT,
+                       extra: Optional[Dict[str, Callable[[], Any]]] = None):
+    """
+    Fetches every dataset in `needs` and every `extra` loader concurrently and returns
+    a PageData (extra results in .extra). Subject-scoped datasets are skipped when
+    subject_id is None. A task that fails or misses the timeout is run again inline,
+    so the result is the same as calling the loaders one after another.
+    """
+    unknown = set(needs) - set(DATASETS)
+    if unknown:
+        raise ValueError(f"Unknown datasets: {sorted(unknown)}")
+
+    data = PageData(username=username, subject_id=subject_id)
+    tasks = {
+        n: (lambda loader=DATASETS[n][0]: loader(username, subject_id))
+        for n in needs if subject_id is not None or not DATASETS[n][1]
+    }
+    extra = extra or {}
+    tasks.update({("extra", n): fn for n, fn in extra.items()})
+    ctx = get_script_run_ctx() if get_script_run_ctx is not None else None
+
+    t0 = time.perf_counter()
+    futures = {
+        _get_executor().submit(_timed, n if isinstance(n, str) else n[1], fn, ctx, data.timings_ms): n
+        for n, fn in tasks.items()
+    }
+    wait(futures, timeout=timeout)
+    for fut, name in futures.items():
+        try:
+            value = fut.result(timeout=0)
+        except Exception as e:
+            print(f"⚠️ Prefetch '{name}' failed, loading inline: {e}")
+            value = tasks[name]()
+        if isinstance(name, tuple):
+            data.extra[name[1]] = value
+        else:
+            setattr(data, name, value)
+    data.total_ms = (time.perf_counter() - t0) * 1000
+    return data
@@ -0,0 +1,244 @@
+"""
+Versioned schema migrations for both backends (Supabase Postgres + local SQLite).
+
+init_schema() (db_utils) creates the base tables on each backend the first
+time its pool hands out a connection, then run_migrations() applies every
+migration whose version is not yet in `schema_migrations`, each in its own
+transaction together with its version row. Replicas starting at the same time
+serialize on an advisory lock (Postgres) / BEGIN IMMEDIATE (SQLite).
+
+Add new schema changes by appending to MIGRATIONS - never edit an applied one.
+"""
+import json
+from datetime import datetime
+
+from db_query import SQLITE, dialect_of, run, run_many
+
+MIGRATION_LOCK_ID = 7262025  # pg_advisory_xact_lock key shared by all replicas
+
+
+# ============================================================
+# 🧰 HELPERS
+# ============================================================
+
+def column_exists(conn, table, column):
+    if dialect_of(conn) == SQLITE:
+        cols = conn.execute(f"PRAGMA table_info({table})").fetchall()
+        return any(r[1] == column for r in cols)
+    c = run(conn, "SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s", (table, column))
+    return c.fetchone() is not None
+
+
+def add_column(conn, table, column, ddl_type):
+    if not column_exists(conn, table, column):
+        print(f"🔄 Migrating Schema: Adding {column} to {table}...")
+        run(conn, f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}")
+
+
+def create_index(conn, name, table, columns):
+    run(conn, f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+
+
+def backfill_question_attempt_stats(conn):
+    """Rebuilds question_attempt_stats from learning_logs (one GROUP BY). Caller commits."""
+    run(conn, "DELETE FROM question_attempt_stats")
+    run(conn, """
+        INSERT INTO question_attempt_stats
+            (username, subject_id, question_id, attempts, corrects, first_correct_at, last_attempt_at)
+        SELECT username, subject_id, question_id, COUNT(*),
+               SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END),
+               MIN(CASE WHEN is_correct = 1 THEN timestamp END),
+               MAX(timestamp)
+        FROM learning_logs
+        WHERE username IS NOT NULL AND subject_id IS NOT NULL AND question_id IS NOT NULL
+        GROUP BY username, subject_id, question_id
+    """)
+
+
+# ============================================================
+# 📜 MIGRATIONS
+# ============================================================
+
+def m001_baseline_columns(conn):
+    """Columns that used to be patched in at runtime (init_db / create_class self-healing)."""
+    add_column(conn, "learning_logs", "duration_seconds", "REAL DEFAULT 0.0")
+    add_column(conn, "learning_logs", "details", "TEXT")
+    add_column(conn, "learning_logs", "action_type", "TEXT")
+    add_column(conn, "learning_logs", "score", "REAL DEFAULT 0.0")
+    add_column(conn, "questions", "subject_id", "TEXT")
+    add_column(conn, "knowledge_structure", "subject_id", "TEXT")
+    add_column(conn, "classes", "teacher_id", "TEXT")
+
+
+def m002_hot_path_indexes(conn):
+    """Secondary indexes for the log, progress and content read paths."""
+    # get_user_logs (ORDER BY timestamp DESC per user, optionally per subject)
+    create_index(conn, "idx_logs_user_time", "learning_logs", ["username", "timestamp"])
+    create_index(conn, "idx_logs_user_subject_time", "learning_logs", ["username", "subject_id", "timestamp"])
+    # get_global_test_logs (ORDER BY timestamp DESC, optionally per subject)
+    create_index(conn, "idx_logs_time", "learning_logs", ["timestamp"])
+    create_index(conn, "idx_logs_subject_time", "learning_logs", ["subject_id", "timestamp"])
+    # get_user_progress filters (username, subject_id); the PK is (username, node_id, subject_id)
+    create_index(conn, "idx_progress_user_subject", "user_progress", ["username", "subject_id"])
+    # get_all_questions / get_graph_structure per subject
+    create_index(conn, "idx_questions_subject", "questions", ["subject_id"])
+    create_index(conn, "idx_structure_subject", "knowledge_structure", ["subject_id"])
+
+
+def m003_content_versions(conn):
+    """Per-subject content_version, bumped with every content edit (cache keys include it)."""
+    run(conn, """
+        CREATE TABLE IF NOT EXISTS content_versions (
+            subject_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP
+        )""")
+
+
+def m004_progress_due_at(conn):
+    """Review due time per progress row (spaced-repetition queue), backfilled from score + timestamp."""
+    from review_scheduler import review_due_at, DEFAULT_THRESHOLD # Lazy: review_scheduler -> decay_engine imports db_utils
+    add_column(conn, "user_progress", "due_at", "TIMESTAMP")
+    # get_smart_recommendations: WHERE username, subject_id AND due_at <= now ORDER BY due_at
+    create_index(conn, "idx_progress_user_subject_due", "user_progress", ["username", "subject_id", "due_at"])
+    rows = run(conn, """
+        SELECT p.username, p.node_id, p.subject_id, p.status, p.score, p.timestamp, s.mastery_threshold
+        FROM user_progress p
+        LEFT JOIN user_settings s ON s.username = p.username AND s.subject_id = p.subject_id
+    """).fetchall()
+    updates = [
+        (review_due_at(status, score, ts, DEFAULT_THRESHOLD if thr is None else thr), user, node, subject)
+        for user, node, subject, status, score, ts, thr in rows
+    ]
+    if updates:
+        run_many(conn, "UPDATE user_progress SET due_at = %s WHERE username = %s AND node_id = %s AND subject_id = %s", updates)
+
+
+def m005_question_attempt_stats(conn):
+    """Per-user-per-question attempt aggregates, maintained with every learning_logs insert."""
+    run(conn, """
+        CREATE TABLE IF NOT EXISTS question_attempt_stats (
+            username TEXT NOT NULL,
+            subject_id TEXT NOT NULL,
+            question_id TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            corrects INTEGER NOT NULL DEFAULT 0,
+            first_correct_at TIMESTAMP,
+            last_attempt_at TIMESTAMP,
+            PRIMARY KEY (username, subject_id, question_id)
+        )""")
+    backfill_question_attempt_stats(conn)
+
+
+def m006_log_keyset_indexes(conn):
+    """(timestamp, id) keyset pagination of the admin log explorer (query_global_logs)."""
+    create_index(conn, "idx_logs_action_time", "learning_logs", ["action_type", "timestamp"])
+    if dialect_of(conn) == SQLITE:
+        return  # rowid is implicitly the last column of every SQLite index: idx_logs_time / idx_logs_subject_time fit
+    create_index(conn, "idx_logs_time_id", "learning_logs", ["timestamp", "id"])
+    create_index(conn, "idx_logs_subject_time_id", "learning_logs", ["subject_id", "timestamp", "id"])
+
+
+MIGRATIONS = [
+    (1, "baseline_columns", m001_baseline_columns),
+    (2, "hot_path_indexes", m002_hot_path_indexes),
+    (3, "content_versions", m003_content_versions),
+    (4, "progress_due_at", m004_progress_due_at),
+    (5, "question_attempt_stats", m005_question_attempt_stats),
+    (6, "log_keyset_indexes", m006_log_keyset_indexes),
+]
+
+
+# ============================================================
+# 🚀 RUNNER
+# ============================================================
+
+def _ensure_version_table(conn):
+    run(conn, """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TIMESTAMP
+        )""")
+    conn.commit()
+
+
+def get_schema_version(conn):
+    try:
+        row = run(conn, "SELECT MAX(version) FROM schema_migrations").fetchone()
+        return row[0] or 0
+    except Exception:
+        conn.rollback()
+        return 0
+
+
+def run_migrations(conn):
+    """Applies pending migrations; returns the schema version afterwards."""
+    _ensure_version_table(conn)
+    for version, name, fn in MIGRATIONS:
+        try:
+            if dialect_of(conn) == SQLITE:
+                conn.execute("BEGIN IMMEDIATE")
+            else:
+                run(conn, "SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+            # Re-check under the lock: another replica may have just applied it
+            done = run(conn, "SELECT 1 FROM schema_migrations WHERE version = %s", (version,)).fetchone()
+            if done:
+                conn.commit()
+                continue
+            fn(conn)
+            run(conn, "INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s, %s, %s)",
+                (version, name, datetime.now()))
+            conn.commit()
+            print(f"✅ Migration {version:03d}_{name} applied.")
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ Migration {version:03d}_{name} failed: {e}")
+            break
+    return get_schema_version(conn)
+
+
+# ============================================================
+# 🔍 EXPLAIN CHECK
+# ============================================================
+
+def _pg_plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _pg_plan_nodes(child)
+
+
+def explain_uses_index(conn, sql, params=()):
+    """
+    Returns (uses_index, plan_text) for one query.
+    On Postgres seq scans are disabled for the check, so a tiny table still
+    proves the index is *usable* rather than whatever the planner prefers today.
+    """
+    if dialect_of(conn) == SQLITE:
+        rows = run(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        details = [r[-1] for r in rows]
+        scans = [d for d in details if d.startswith("SCAN") or d.startswith("SEARCH")]
+        uses_index = bool(scans) and all(("INDEX" in d or "PRIMARY KEY" in d) for d in scans)
+        return uses_index, "\n".join(details)
+
+    try:
+        run(conn, "SET LOCAL enable_seqscan = off")
+        raw = run(conn, "EXPLAIN (FORMAT JSON) " + sql, params).fetchone()[0]
+        plan = (raw if isinstance(raw, list) else json.loads(raw))[0]["Plan"]
+        node_types = [n["Node Type"] for n in _pg_plan_nodes(plan)]
+        uses_index = "Seq Scan" not in node_types and any("Index" in t for t in node_types)
+        return uses_index, " -> ".join(node_types)
+    finally:
+        conn.rollback()
+
+
+def check_indexes(conn, hot_queries):
+    """hot_queries: [(name, sql, params)] -> [{"query", "uses_index", "plan"}]"""
+    report = []
+    for name, sql, params in hot_queries:
+        try:
+            ok, plan = explain_uses_index(conn, sql, params)
+        except Exception as e:
+            ok, plan = False, f"EXPLAIN failed: {e}"
+        report.append({"query": name, "uses_index": ok, "plan": plan})
+    return report
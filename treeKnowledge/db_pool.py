@@ -0,0 +1,430 @@
+"""
+Connection pooling behind db_utils.get_connection().
+
+- Postgres (Supabase): one process-wide, thread-safe pool with a hard max size.
+- SQLite (local_course.db): one long-lived connection per thread, WAL already set.
+
+Handed-out connections are subclasses of the driver classes, so the existing
+`isinstance(conn, sqlite3.Connection)` checks and `pd.read_sql(..., conn)` keep
+working, and the usual `conn.close()` in a `finally:` returns the connection to
+its pool instead of tearing it down.
+
+Checkouts are re-entrant per thread: a nested get_connection() (e.g.
+apply_forgetting_decay -> save_progress) gets the connection its caller already
+holds, so a full pool can never deadlock on itself and nested SQLite writers no
+longer wait on their own lock.
+
+Each pool can take an `initializer(conn)` (db_utils: base tables + migrations):
+it runs once per pool, i.e. once per backend, on the first checkout - so the
+SQLite fallback is migrated the first time the circuit breaker sends traffic
+to it, not only when it happened to be the backend at boot.
+"""
+import atexit
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+# ============================================================
+# ⚙️ SETTINGS
+# ============================================================
+
+# 4 replicas x 10 = 40 server connections at most (Supabase pooler limit is 60)
+PG_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+PG_CONNECT_TIMEOUT = 3          # seconds, same as the old direct connect
+POOL_CHECKOUT_TIMEOUT = 10.0    # seconds to wait for a free connection when the pool is full
+HEALTH_CHECK_INTERVAL = 30.0    # idle seconds after which a connection is pinged before reuse
+SQLITE_MAX_THREAD_CONNECTIONS = int(os.environ.get("DB_SQLITE_MAX_CONNECTIONS", 64))
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection frees up within POOL_CHECKOUT_TIMEOUT."""
+
+
+class _InitOnce:
+    """Runs the pool's initializer on its first checkout; other threads wait for it."""
+
+    def _setup_initializer(self, initializer):
+        self.initializer = initializer
+        self._init_lock = threading.RLock()
+        self._init_state = None if initializer else "done"  # None -> "running" -> "done"
+
+    def _initialize(self, conn):
+        if self._init_state == "done":
+            return
+        with self._init_lock:
+            if self._init_state is not None:
+                return  # Done by another thread, or re-entered from inside the initializer
+            self._init_state = "running"
+            try:
+                self.initializer(conn)
+            except Exception as e:
+                print(f"⚠️ Pool initializer failed: {e}")
+            finally:
+                self._init_state = "done"
+
+
+# ============================================================
+# 🐘 POSTGRES POOL
+# ============================================================
+
+if psycopg2 is not None:
+    class PooledPgConnection(psycopg2.extensions.connection):
+        """psycopg2 connection whose close() hands it back to its pool."""
+        _pool = None
+        _depth = 0  # Nested checkouts by the owning thread
+
+        def close(self):
+            if self._pool is None:
+                return super().close()
+            if self._depth <= 0:
+                return  # Double close() must not put it back twice
+            self._depth -= 1
+            if self._depth == 0:
+                self._pool.putconn(self)
+
+        def discard(self):
+            """Really closes the socket (used by the pool itself)."""
+            self._pool = None
+            super().close()
+
+
+class PostgresPool(_InitOnce):
+    """
+    Thread-safe Postgres pool.
+    checkout() blocks up to `checkout_timeout` when `max_size` connections are in use.
+    Idle connections older than `health_check_interval` are pinged before reuse.
+    """
+
+    def __init__(self, dsn, max_size=PG_POOL_MAX_SIZE, connect_timeout=PG_CONNECT_TIMEOUT,
+                 checkout_timeout=POOL_CHECKOUT_TIMEOUT, health_check_interval=HEALTH_CHECK_INTERVAL,
+                 initializer=None):
+        if psycopg2 is None:
+            raise RuntimeError("psycopg2 is not installed")
+        self.dsn = dsn
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._idle = []        # [(conn, last_used_monotonic)]
+        self._in_use = 0       # checked out or reserved (being health-checked / opened)
+        self._closed = False
+        self._stats = {"checkouts": 0, "connects": 0, "discarded": 0, "waits": 0, "timeouts": 0}
+        self._setup_initializer(initializer)
+
+    # --- internal ---
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, connect_timeout=self.connect_timeout,
+                                connection_factory=PooledPgConnection)
+        conn._pool = self
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            c = conn.cursor()
+            c.execute("SELECT 1")
+            c.fetchone()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.discard()
+        except Exception:
+            pass
+        with self._cond:
+            self._stats["discarded"] += 1
+
+    def _release_slot(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    # --- public API ---
+    def checkout(self):
+        held = getattr(self._local, "conn", None)
+        if held is not None and held._depth > 0 and not held.closed:
+            held._depth += 1
+            with self._cond:
+                self._stats["checkouts"] += 1
+            return held
+
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            candidate = None
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("Pool is closed")
+                while not self._idle and self._in_use >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(f"No free DB connection after {self.checkout_timeout}s (max_size={self.max_size})")
+                    self._stats["waits"] += 1
+                    self._cond.wait(remaining)
+                if self._idle:
+                    candidate = self._idle.pop()
+                self._in_use += 1  # Reserve the slot; network work happens outside the lock
+
+            if candidate is not None:
+                conn, last_used = candidate
+                if not self._is_healthy(conn, last_used):
+                    self._discard(conn)
+                    self._release_slot()
+                    continue
+            else:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+                with self._cond:
+                    self._stats["connects"] += 1
+
+            conn._depth = 1
+            self._local.conn = conn
+            with self._cond:
+                self._stats["checkouts"] += 1
+            self._initialize(conn)
+            return conn
+
+    def putconn(self, conn):
+        """Returns a connection; any open transaction is rolled back first."""
+        if getattr(self._local, "conn", None) is conn:
+            self._local.conn = None
+        conn._depth = 0
+        healthy = not conn.closed
+        if healthy and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                healthy = False
+
+        with self._cond:
+            self._in_use -= 1
+            keep = healthy and not self._closed
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if not keep:
+            self._discard(conn)
+
+    def close_all(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "backend": "postgres",
+                "max_size": self.max_size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                **self._stats,
+            }
+
+
+# ============================================================
+# 🗃️ SQLITE PER-THREAD CONNECTIONS
+# ============================================================
+
+class PooledSQLiteConnection(sqlite3.Connection):
+    """
+    Per-thread SQLite connection. The outermost close() only ends whatever
+    transaction the caller left open (same outcome as a real close) and keeps
+    the handle.
+    """
+    _pool = None
+    _depth = 0
+
+    def close(self):
+        if self._pool is None:
+            return super().close()
+        if self._depth <= 0:
+            return
+        self._depth -= 1
+        if self._depth == 0 and self.in_transaction:
+            self.rollback()
+
+    def discard(self):
+        self._pool = None
+        super().close()
+
+
+class SQLiteThreadPool(_InitOnce):
+    """
+    One connection per thread, opened lazily with WAL + synchronous=NORMAL.
+    At most `max_size` connections are retained; extra threads get a
+    one-shot connection that really closes on close().
+    """
+
+    def __init__(self, db_path, max_size=SQLITE_MAX_THREAD_CONNECTIONS, timeout=60.0,
+                 health_check_interval=HEALTH_CHECK_INTERVAL, initializer=None):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._live = weakref.WeakSet()  # Entries vanish when their thread exits
+        self._stats = {"checkouts": 0, "connects": 0, "overflow": 0, "discarded": 0}
+        self._setup_initializer(initializer)
+
+    def _connect(self, retained):
+        # [OPTIMIZATION] Timeout 60s for High Concurrency (40 users)
+        # cached_statements: db_query hands sqlite3 stable compiled SQL, so parsed statements are reused
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=self.timeout,
+                               factory=PooledSQLiteConnection, cached_statements=256)
+        # [OPTIMIZATION] WAL: simultaneous readers and writers
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        if retained:
+            conn._pool = self
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def checkout(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and conn._depth > 0:
+            conn._depth += 1
+            with self._lock:
+                self._stats["checkouts"] += 1
+            return conn
+        if conn is not None and not self._is_healthy(conn, self._local.last_used):
+            self.discard_current()
+            conn = None
+
+        if conn is None:
+            with self._lock:
+                retained = len(self._live) < self.max_size
+                self._stats["connects"] += 1
+                if not retained:
+                    self._stats["overflow"] += 1
+            conn = self._connect(retained)
+            if not retained:
+                self._initialize(conn)
+                return conn
+            with self._lock:
+                self._live.add(conn)
+            self._local.conn = conn
+
+        conn._depth = 1
+        self._local.last_used = time.monotonic()
+        with self._lock:
+            self._stats["checkouts"] += 1
+        self._initialize(conn)
+        return conn
+
+    def putconn(self, conn):
+        while conn._depth > 0:
+            conn.close()
+
+    def discard_current(self):
+        """Drops this thread's connection (e.g. after a 'database is locked' storm)."""
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is None:
+            return
+        with self._lock:
+            self._live.discard(conn)
+            self._stats["discarded"] += 1
+        try:
+            conn.discard()
+        except Exception:
+            pass
+
+    def close_all(self):
+        with self._lock:
+            conns = list(self._live)
+            self._live = weakref.WeakSet()
+        for conn in conns:
+            try:
+                conn.discard()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "sqlite",
+                "max_size": self.max_size,
+                "live_threads": len(self._live),
+                **self._stats,
+            }
+
+
+# ============================================================
+# 🌐 PROCESS-WIDE REGISTRY
+# ============================================================
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pg_pool(dsn, initializer=None):
+    """initializer: only used when this call creates the pool."""
+    key = ("postgres", dsn)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = PostgresPool(dsn, initializer=initializer)
+    return pool
+
+
+def get_sqlite_pool(db_path, initializer=None):
+    """initializer: only used when this call creates the pool."""
+    key = ("sqlite", os.path.abspath(db_path))
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = SQLiteThreadPool(db_path, initializer=initializer)
+    return pool
+
+
+def pool_stats():
+    """Snapshot of every pool in this process (for the admin/health pages)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [p.stats() for p in pools]
+
+
+@atexit.register
+def close_all_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for p in pools:
+        p.close_all()
@@ -0,0 +1,158 @@
+"""
+Dialect-aware statement layer used by db_utils.execute_query.
+
+All SQL in the app is written psycopg2-style: `%s` positional or `%(name)s`
+named parameters. Each statement is compiled once per dialect and cached:
+
+- sqlite:   `%s` -> `?`, `%(name)s` -> `:name`, `%%` -> `%`. The compiled text is
+            a stable string, so sqlite3's own per-connection statement cache
+            (cached_statements) reuses the parsed statement on every call.
+- postgres: statements executed with prepare=True become a server-side
+            `PREPARE` once per connection, then `EXECUTE name(...)`, which skips
+            the parse/plan work on the hot read paths.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+from collections import namedtuple
+from functools import lru_cache
+
+import pandas as pd
+
+try:
+    from psycopg2.extras import execute_batch
+except ImportError:
+    execute_batch = None
+
+SQLITE = "sqlite"
+POSTGRES = "postgres"
+
+_PARAM_RE = re.compile(r"%\((\w+)\)s|%s|%%")
+
+# Server-side PREPARE does not survive a transaction-mode pooler (pgbouncer / Supabase :6543)
+SERVER_PREPARE = os.environ.get("DB_SERVER_PREPARE", "1") != "0"
+
+CompiledStatement = namedtuple(
+    "CompiledStatement",
+    ["text", "names", "n_params", "prepare_name", "prepare_sql", "execute_sql"],
+)
+
+
+def dialect_of(conn):
+    return SQLITE if isinstance(conn, sqlite3.Connection) else POSTGRES
+
+
+@lru_cache(maxsize=512)
+def compile_sql(sql, dialect):
+    """Translate a psycopg2-style statement for `dialect` (cached)."""
+    names = []
+    positional = [0]
+
+    def _sqlite_sub(m):
+        tok = m.group(0)
+        if tok == "%%":
+            return "%"
+        if tok == "%s":
+            positional[0] += 1
+            return "?"
+        names.append(m.group(1))
+        return f":{m.group(1)}"
+
+    if dialect == SQLITE:
+        text = _PARAM_RE.sub(_sqlite_sub, sql)
+        n_params = positional[0] + len(set(names))
+        return CompiledStatement(text, tuple(dict.fromkeys(names)) or None, n_params, None, None, None)
+
+    # --- Postgres: driver text is the original; build the PREPARE form alongside ---
+    slots = []  # For named params: order of first appearance -> $n
+
+    def _pg_sub(m):
+        tok = m.group(0)
+        if tok == "%%":
+            return "%"
+        if tok == "%s":
+            slots.append(None)
+            return f"${len(slots)}"
+        name = m.group(1)
+        if name in slots:
+            return f"${slots.index(name) + 1}"
+        slots.append(name)
+        return f"${len(slots)}"
+
+    body = _PARAM_RE.sub(_pg_sub, sql)
+    named = [s for s in slots if s is not None]
+    if named and len(named) != len(slots):
+        raise ValueError("Cannot mix %s and %(name)s parameters in one statement")
+    stmt_name = "q_" + hashlib.md5(sql.encode("utf-8")).hexdigest()[:16]
+    placeholders = ", ".join(["%s"] * len(slots))
+    return CompiledStatement(
+        text=sql,
+        names=tuple(named) or None,
+        n_params=len(slots),
+        prepare_name=stmt_name,
+        prepare_sql=f"PREPARE {stmt_name} AS {body}",
+        execute_sql=f"EXECUTE {stmt_name} ({placeholders})" if slots else f"EXECUTE {stmt_name}",
+    )
+
+
+def _prepared_set(conn):
+    """Per-connection set of PREPAREd names; None if this connection can't track them."""
+    prepared = getattr(conn, "_prepared", None)
+    if prepared is None:
+        try:
+            prepared = conn._prepared = set()
+        except AttributeError:
+            return None  # Plain psycopg2 connection (scripts): no __dict__ to hang state on
+    return prepared
+
+
+def _server_prepare_allowed(conn):
+    if not SERVER_PREPARE or getattr(conn, "_prepare_disabled", False):
+        return False
+    try:
+        return conn.get_dsn_parameters().get("port") != "6543"
+    except Exception:
+        return False
+
+
+def run(conn, sql, params=None, prepare=False):
+    """Execute one statement; returns the cursor. Caller handles commit/rollback."""
+    stmt = compile_sql(sql, dialect_of(conn))
+    c = conn.cursor()
+    if stmt.prepare_name and prepare and _server_prepare_allowed(conn):
+        prepared = _prepared_set(conn)
+        if prepared is not None:
+            values = params or ()
+            if stmt.names:
+                values = tuple(values[n] for n in stmt.names)
+            try:
+                if stmt.prepare_name not in prepared:
+                    c.execute(stmt.prepare_sql)
+                    prepared.add(stmt.prepare_name)
+                c.execute(stmt.execute_sql, values)
+                return c
+            except Exception:
+                # Server state for this session is now unknown: stop preparing on it
+                try: conn._prepare_disabled = True
+                except AttributeError: pass
+                raise
+    c.execute(stmt.text, params or ())
+    return c
+
+
+def run_many(conn, sql, seq_of_params, page_size=200):
+    """Bulk insert/update; one batched round trip per page on Postgres."""
+    stmt = compile_sql(sql, dialect_of(conn))
+    c = conn.cursor()
+    if dialect_of(conn) == POSTGRES and execute_batch is not None:
+        execute_batch(c, stmt.text, seq_of_params, page_size=page_size)
+    else:
+        c.executemany(stmt.text, seq_of_params)
+    return c
+
+
+def read_sql(sql, conn, params=None):
+    """pd.read_sql with the same placeholder translation as run()."""
+    stmt = compile_sql(sql, dialect_of(conn))
+    return pd.read_sql(stmt.text, conn, params=params)
@@ -1,4 +1,3 @@
-import psycopg2
 import pandas as pd
 from datetime import datetime
 import bcrypt
@@ -7,72 +6,162 @@ import re
 import base64
 import streamlit as st
 import json
+import threading
+from contextlib import contextmanager
+from datetime import timezone
 
 # ============================================================
 # 🔌 DATABASE CONNECTION (SUPABASE ONLY)
 # ============================================================
 
-import sqlite3
 try:
     import docx
 except ImportError:
     docx = None
 
+from db_pool import get_pg_pool, get_sqlite_pool, pool_stats, PoolTimeout
+from circuit_breaker import CircuitBreaker
+from db_query import run, run_many, read_sql, dialect_of, SQLITE
+from log_writer import WriteBehindQueue
+from db_migrations import run_migrations, check_indexes, backfill_question_attempt_stats
+from cache_backend import shared_cache, clear_all as clear_shared_cache, cache_stats, get_or_load, invalidate
+
+LOCAL_DB_PATH = "local_course.db"
+
+# Process-wide: once Supabase is known to be down, every caller goes straight to
+# SQLite until the background probe sees it come back.
+_cloud_breaker = CircuitBreaker("supabase")
+
+def _get_cloud_url():
+    if "connections" in st.secrets and "supabase" in st.secrets["connections"]:
+        return st.secrets["connections"]["supabase"]["url"]
+    return None
+
 def get_connection():
     """
-    Returns a connection to Database.
+    Returns a pooled connection to Database (conn.close() hands it back).
     Priority:
-    1. Supabase (if configured and working)
+    1. Supabase (if configured and the circuit breaker is closed)
     2. Local SQLite (local_course.db) as fallback
+    Raises PoolTimeout when the Supabase pool stays full: a busy pool is not an
+    outage, and falling back would split one user's writes across two databases.
     """
-    conn = None
-    
     # 1. Try Supabase
     try:
-        if "connections" in st.secrets and "supabase" in st.secrets["connections"]:
-            db_url = st.secrets["connections"]["supabase"]["url"]
-            conn = psycopg2.connect(db_url, connect_timeout=3) # Short timeout
-            return conn
+        db_url = _get_cloud_url()
     except Exception as e:
         print(f"⚠️ Supabase Connect Failed: {e}")
+        db_url = None
+    if db_url and _cloud_breaker.allow_request():
+        try:
+            # [OPTIMIZATION] Reuse warm connections instead of a new TLS handshake per call
+            conn = get_pg_pool(db_url, initializer=init_schema).checkout()
+        except PoolTimeout:
+            raise  # Pool busy, not an outage: don't trip the breaker, don't fall back
+        except Exception as e:
+            _cloud_breaker.set_probe(lambda: get_pg_pool(db_url, initializer=init_schema).checkout().close())
+            _cloud_breaker.record_failure(e)
+            print(f"⚠️ Supabase Connect Failed: {e}")
+        else:
+            _cloud_breaker.record_success()
+            return conn
         
     # 2. Fallback to Local SQLite
     try:
-        # Check if local db exists or create it
-        db_path = "local_course.db"
-        # [OPTIMIZATION] Increase timeout to 60s for High Concurrency (40 users)
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=60.0)
-        
-        # [OPTIMIZATION] Enable WAL Mode (Write-Ahead Logging) 
-        # Allows simultaneous readers and writers.
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA synchronous=NORMAL;")
-        
-        return conn
+        # [OPTIMIZATION] One connection per thread, WAL + 60s busy timeout set once (see db_pool)
+        # First checkout migrates it: the fallback may never have been the boot backend
+        return get_sqlite_pool(LOCAL_DB_PATH, initializer=init_schema).checkout()
     except Exception as e:
         print(f"❌ Local DB Connection Error: {e}")
         return None
 
-def execute_query(conn, sql, params=None):
+def get_db_health():
+    """Circuit breaker state (+ seconds spent in each state), pool usage, log queue and cache."""
+    return {"breaker": _cloud_breaker.stats(), "pools": pool_stats(), "log_queue": get_log_queue_stats(),
+            "cache": cache_stats()}
+
+def check_hot_query_indexes():
+    """
+    EXPLAINs the hot read paths against the live DB and reports whether each
+    one is served by an index (a missing/dropped index shows up as a seq scan).
+    """
+    conn = get_connection()
+    if not conn: return []
+    dialect = dialect_of(conn)
+    hot_queries = [
+        ("get_mastered_question_ids / get_question_status_map", ATTEMPT_STATS_BY_QID_SQL + " IN (%s)", ("u", "s", "q")),
+        ("get_user_logs", USER_LOGS_SQL, ("u", 100)),
+        ("get_user_logs (subject)", USER_SUBJECT_LOGS_SQL, ("u", "s", 100)),
+        ("query_global_logs", _global_logs_sql(dialect), (100,)),
+        ("query_global_logs (subject, next page)", _global_logs_sql(dialect, " AND l.subject_id = %s", keyset=True),
+         ("s", datetime.now(), 1, 100)),
+        ("get_user_progress", "SELECT node_id, status, score, timestamp FROM user_progress WHERE username = %s AND subject_id = %s", ("u", "s")),
+        ("get_smart_recommendations", DUE_REVIEWS_SQL, ("u", "s", datetime.now(), 3)),
+    ]
+    try:
+        return check_indexes(conn, hot_queries)
+    finally:
+        conn.close()
+
+def execute_query(conn, sql, params=None, prepare=False):
+    """
+    Runs one statement. Placeholders (%s / %(name)s) are translated per dialect
+    once and cached (see db_query). prepare=True reuses a server-side prepared
+    statement on Postgres - use it for hot, fixed-shape reads.
+    """
     if not conn: return None
-    
-    # [ADAPTIVE] Fix placeholder for SQLite (fallback mode)
-    if isinstance(conn, sqlite3.Connection):
-        sql = sql.replace('%s', '?')
-        
-    c = conn.cursor()
     try:
-        c.execute(sql, params or ())
-        return c
+        return run(conn, sql, params, prepare=prepare)
     except Exception as e:
         print(f"Query Error: {e} \nSQL: {sql}")
         conn.rollback()
         raise e
 
+def execute_many(conn, sql, seq_of_params):
+    """Bulk version of execute_query (batched round trips on Postgres)."""
+    if not conn: return None
+    try:
+        return run_many(conn, sql, seq_of_params)
+    except Exception as e:
+        print(f"Query Error: {e} \nSQL: {sql}")
+        conn.rollback()
+        raise e
+
+@contextmanager
+def unit_of_work():
+    """
+    One connection + one transaction for a multi-step write (e.g. grading).
+    Pass the yielded conn as `conn=` to save_progress / log_activity /
+    penalize_parents / get_mastered_question_ids: they then join the
+    transaction instead of opening and committing their own.
+    Commits once on success, rolls everything back on error.
+    Yields None if no DB is reachable (helpers then no-op as before).
+    """
+    conn = get_connection()
+    if not conn:
+        yield None
+        return
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
 @st.cache_resource
 def init_db():
+    """Prepares the schema of the current backend (init_schema runs on its pool's first checkout)."""
     conn = get_connection()
-    if not conn: return
+    if conn: conn.close()
+
+def init_schema(conn):
+    """
+    Base tables + seed rows + pending migrations on one backend.
+    Pool initializer (see db_pool): runs once per backend per process, so a
+    Supabase -> SQLite failover (or back) never lands on an unmigrated DB.
+    """
     try:
         c = conn.cursor()
     
@@ -189,7 +278,7 @@ def init_db():
                 ("DaiSo", "Đại Số", "Đại số tuyến tính"),
                 ("KNS", "Kỹ Năng Số", "Kiến thức và kỹ năng số cốt lõi")
             ]
-            c.executemany("INSERT INTO subjects (subject_id, subject_name, description) VALUES (%s, %s, %s)", default_subjects)
+            run_many(conn, "INSERT INTO subjects (subject_id, subject_name, description) VALUES (%s, %s, %s)", default_subjects)
 
         # Init Admin
         c.execute("SELECT count(*) FROM users")
@@ -198,66 +287,78 @@ def init_db():
             default_pass = "123"
             hashed = bcrypt.hashpw(default_pass.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
             try:
-                c.execute('INSERT INTO users (username, name, password, role, is_approved) VALUES (%s, %s, %s, %s, %s)', 
+                run(conn, 'INSERT INTO users (username, name, password, role, is_approved) VALUES (%s, %s, %s, %s, %s)', 
                       (default_user, "Super Admin", hashed, "admin", 1))
                 print("✅ Created default Admin.")
             except Exception as e: print(f"Admin creation error: {e}")
 
-        # --- MIGRATION: Add duration_seconds to learning_logs if not exists ---
-        try:
-            # Check if column exists
-            c.execute("SELECT column_name FROM information_schema.columns WHERE table_name='learning_logs' AND column_name='duration_seconds'")
-            if not c.fetchone():
-                print("🔄 Migrating Schema: Adding duration_seconds to learning_logs...")
-                c.execute("ALTER TABLE learning_logs ADD COLUMN duration_seconds REAL DEFAULT 0.0")
-            
-            # --- MIGRATION: Add details to learning_logs if not exists (Phase 5) ---
-            c.execute("SELECT column_name FROM information_schema.columns WHERE table_name='learning_logs' AND column_name='details'")
-            if not c.fetchone():
-                print("🔄 Migrating Schema: Adding details to learning_logs...")
-                c.execute("ALTER TABLE learning_logs ADD COLUMN details TEXT")
-
-            # --- MIGRATION: Ensure subject_id exists in questions and knowledge_structure ---
-            # For questions table
-            c.execute("SELECT column_name FROM information_schema.columns WHERE table_name='questions' AND column_name='subject_id'")
-            if not c.fetchone():
-                print("🔄 Migrating Schema: Adding subject_id to questions...")
-                c.execute("ALTER TABLE questions ADD COLUMN subject_id TEXT")
-            
-            # For knowledge_structure table
-            # --- MIGRATION: Adding subject_id to knowledge_structure ---
-            c.execute("SELECT column_name FROM information_schema.columns WHERE table_name='knowledge_structure' AND column_name='subject_id'")
-            if not c.fetchone():
-                print("🔄 Migrating Schema: Adding subject_id to knowledge_structure...")
-                c.execute("ALTER TABLE knowledge_structure ADD COLUMN subject_id TEXT")
-
-            # --- MIGRATION: Ensure action_type exists in learning_logs (CRITICAL FIX) ---
-            c.execute("SELECT column_name FROM information_schema.columns WHERE table_name='learning_logs' AND column_name='action_type'")
-            if not c.fetchone():
-                print("🔄 Migrating Schema: Adding action_type to learning_logs...")
-                c.execute("ALTER TABLE learning_logs ADD COLUMN action_type TEXT")
-
-            # --- MIGRATION: Ensure score exists in learning_logs ---
-            c.execute("SELECT column_name FROM information_schema.columns WHERE table_name='learning_logs' AND column_name='score'")
-            if not c.fetchone():
-                print("🔄 Migrating Schema: Adding score to learning_logs...")
-                c.execute("ALTER TABLE learning_logs ADD COLUMN score REAL DEFAULT 0.0")
-
-
-        except Exception as e:
-            print(f"Migration Warning: {e}")
-
         conn.commit()
+
+        # --- MIGRATIONS: versioned, dialect-aware (see db_migrations) ---
+        version = run_migrations(conn)
+        print(f"🗄️ Schema version ({dialect_of(conn)}): {version}")
     except Exception as e:
         print(f"Init DB Warning: {e}")
-    finally:
-        if conn: conn.close()
+        conn.rollback()
 
 # ============================================================
 # 🚀 CACHED READ FUNCTIONS (HIGH PERFORMANCE)
 # ============================================================
+# [OPTIMIZATION] Subjects / questions / graph live in the shared cache backend
+# (CACHE_BACKEND_URL, see cache_backend): one replica's load serves all of them.
+
+def clear_content_caches():
+    """Full flush (admin button): drop Streamlit caches and the shared content cache (all replicas)."""
+    st.cache_data.clear()
+    clear_shared_cache()
+
+# --- CONTENT VERSIONING ---
+# Every content edit bumps its subject's row in content_versions inside the same
+# transaction; cached questions/graph are keyed by that version, so only the
+# edited subject is reloaded. "*" is bumped too and versions the all-subject reads.
+ALL_SUBJECTS = "*"
+CONTENT_VERSION_TTL = 60 # Bounds staleness for edits made outside the app (direct SQL, sync scripts)
+
+BUMP_CONTENT_VERSION_SQL = """
+    INSERT INTO content_versions (subject_id, version, updated_at) VALUES (%s, 1, %s)
+    ON CONFLICT (subject_id) DO UPDATE SET version = content_versions.version + 1, updated_at = EXCLUDED.updated_at
+"""
+
+def bump_content_version(conn, *subject_ids):
+    """
+    Joins the caller's transaction. Returns the bumped ids: pass them to
+    publish_content_versions() after the commit.
+    """
+    ids = sorted({s for s in subject_ids if s} | {ALL_SUBJECTS}) # Fixed order: no deadlock between editors
+    now = datetime.now()
+    execute_many(conn, BUMP_CONTENT_VERSION_SQL, [(s, now) for s in ids])
+    return ids
 
-@st.cache_data(ttl=3600, show_spinner=False)
+def bump_all_content_versions(conn):
+    """For edits that span every subject (clear_table_data)."""
+    c = execute_query(conn, "SELECT subject_id FROM subjects")
+    return bump_content_version(conn, *[r[0] for r in c.fetchall()])
+
+def publish_content_versions(subject_ids):
+    """After commit: drop the cached version numbers so every replica reads the new ones."""
+    invalidate(*[f"content_version:{s}" for s in subject_ids])
+
+def _load_content_version(subject_id):
+    conn = get_connection()
+    if not conn: return 0
+    try:
+        c = execute_query(conn, "SELECT version FROM content_versions WHERE subject_id = %s", (subject_id,), prepare=True)
+        row = c.fetchone()
+        return row[0] if row else 0
+    except: return 0
+    finally: conn.close()
+
+def get_content_version(subject_id=None):
+    """Current content version of a subject (None = all subjects). Cached in the shared backend."""
+    sid = subject_id or ALL_SUBJECTS
+    return get_or_load(f"content_version:{sid}", lambda: _load_content_version(sid), CONTENT_VERSION_TTL)
+
+@shared_cache(ttl=3600)
 def get_all_subjects():
     conn = get_connection()
     if not conn: return []
@@ -270,26 +371,26 @@ def get_all_subjects():
     except: return []
     finally: conn.close()
 
-@st.cache_data(ttl=3600, show_spinner=False)
+@shared_cache(ttl=3600, version=lambda subject_id=None: get_content_version(subject_id))
 def get_all_questions(subject_id=None):
     conn = get_connection()
     if not conn: return pd.DataFrame()
     try: 
         if subject_id:
-            df = pd.read_sql("SELECT * FROM questions WHERE subject_id = %s", conn, params=(subject_id,))
+            df = read_sql("SELECT * FROM questions WHERE subject_id = %s", conn, params=(subject_id,))
         else:
             df = pd.read_sql("SELECT * FROM questions", conn)
     except: df = pd.DataFrame()
     finally: conn.close()
     return df
 
-@st.cache_data(ttl=3600, show_spinner=False)
+@shared_cache(ttl=3600, version=lambda subject_id=None: get_content_version(subject_id))
 def get_graph_structure(subject_id=None):
     conn = get_connection()
     if not conn: return pd.DataFrame(columns=['source', 'target'])
     try: 
         if subject_id:
-            df = pd.read_sql("SELECT * FROM knowledge_structure WHERE subject_id = %s", conn, params=(subject_id,))
+            df = read_sql("SELECT * FROM knowledge_structure WHERE subject_id = %s", conn, params=(subject_id,))
         else:
             df = pd.read_sql("SELECT * FROM knowledge_structure", conn)
             
@@ -419,22 +520,6 @@ def create_class(class_name, teacher_id, subject_id):
         conn.commit()
         return True, f"Đã tạo lớp {class_name} thành công!"
     except Exception as e:
-        err_msg = str(e)
-        # [SELF-HEALING] Auto-add column if missing
-        if 'column "teacher_id" of relation "classes" does not exist' in err_msg:
-            print("⚠️ Schema Mismatch Detected. Auto-healing...")
-            try:
-                conn.rollback()
-                execute_query(conn, "ALTER TABLE classes ADD COLUMN teacher_id TEXT")
-                conn.commit()
-                # Retry
-                execute_query(conn, "INSERT INTO classes (class_name, teacher_id, subject_id) VALUES (%s, %s, %s)", 
-                             (class_name, teacher_id, subject_id))
-                conn.commit()
-                return True, f"Đã tạo lớp {class_name} thành công! (Schema Updated)"
-            except Exception as e2:
-                return False, f"Lỗi không thể sửa schema: {str(e2)}"
-        
         return False, str(e)
     finally: conn.close()
 
@@ -444,7 +529,7 @@ def get_classes(teacher_id=None):
     if not conn: return pd.DataFrame()
     try:
         if teacher_id:
-            return pd.read_sql("SELECT * FROM classes WHERE teacher_id = %s", conn, params=(teacher_id,))
+            return read_sql("SELECT * FROM classes WHERE teacher_id = %s", conn, params=(teacher_id,))
         else:
             return pd.read_sql("SELECT * FROM classes", conn)
     except: return pd.DataFrame()
@@ -470,7 +555,7 @@ def get_students_in_class(class_id):
             JOIN class_enrollments e ON u.username = e.username
             WHERE e.class_id = %s
         """
-        return pd.read_sql(sql, conn, params=(class_id,))
+        return read_sql(sql, conn, params=(class_id,))
     except: return pd.DataFrame()
     finally: conn.close()
 
@@ -484,7 +569,7 @@ def get_student_classes(username):
             JOIN class_enrollments e ON c.class_id = e.class_id
             WHERE e.username = %s
         """
-        return pd.read_sql(sql, conn, params=(username,))
+        return read_sql(sql, conn, params=(username,))
     except: return pd.DataFrame()
     finally: conn.close()
 
@@ -520,16 +605,22 @@ def get_class_matrix(class_id, subject_id):
         
         # Get progress
         if len(students) == 1:
-            sql = "SELECT username, node_id, score FROM user_progress WHERE subject_id=%s AND username=%s"
+            sql = "SELECT username, node_id, status, score, timestamp FROM user_progress WHERE subject_id=%s AND username=%s"
             params = (subject_id, students[0])
         else:
-            sql = f"SELECT username, node_id, score FROM user_progress WHERE subject_id=%s AND username IN {students}"
+            sql = f"SELECT username, node_id, status, score, timestamp FROM user_progress WHERE subject_id=%s AND username IN {students}"
             params = (subject_id,)
             
-        progress_df = pd.read_sql(sql, conn, params=params)
+        progress_df = read_sql(sql, conn, params=params)
         
         if progress_df.empty: return pd.DataFrame()
         
+        from decay_engine import DECAY_MODE, effective_progress # Lazy: decay_engine imports db_utils
+        if DECAY_MODE == "lazy":
+            # Cùng điểm hiệu dụng như get_user_progress (decay theo từng dòng; ma trận chỉ hiện điểm nên threshold không ảnh hưởng)
+            rows = list(progress_df[['node_id', 'status', 'score', 'timestamp']].itertuples(index=False, name=None))
+            progress_df['score'] = [sc for _, _, sc, _ in effective_progress(rows)]
+        
         # Pivot
         matrix = progress_df.pivot(index='username', columns='node_id', values='score')
         return matrix.fillna(0.0)
@@ -577,38 +668,115 @@ def reset_classes_table_schema():
 # 💾 WRITE OPERATIONS
 # ============================================================
 
-def save_progress(username, node_id, subject_id, status, score):
-    conn = get_connection()
+UPSERT_PROGRESS_SQL = """
+    INSERT INTO user_progress (username, node_id, subject_id, status, score, timestamp, due_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (username, node_id, subject_id)
+    DO UPDATE SET
+        status    = EXCLUDED.status,
+        score     = EXCLUDED.score,
+        timestamp = EXCLUDED.timestamp,
+        due_at    = EXCLUDED.due_at
+"""
+
+def save_progress(username, node_id, subject_id, status, score, conn=None, threshold=None):
+    """
+    conn: join a unit_of_work() transaction (no commit here, errors propagate).
+    threshold: user's mastery threshold, for the review due time (default 0.7).
+    """
+    from review_scheduler import review_due_at, DEFAULT_THRESHOLD # Lazy: review_scheduler -> decay_engine imports db_utils
+    own = conn is None
+    if own: conn = get_connection()
     if not conn: return
     timestamp = datetime.now()
-    sql = """
-        INSERT INTO user_progress (username, node_id, subject_id, status, score, timestamp)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        ON CONFLICT (username, node_id, subject_id)
-        DO UPDATE SET
-            status    = EXCLUDED.status,
-            score     = EXCLUDED.score,
-            timestamp = EXCLUDED.timestamp
-    """
+    due_at = review_due_at(status, score, timestamp, DEFAULT_THRESHOLD if threshold is None else threshold)
     try:
-        execute_query(conn, sql, (username, node_id, subject_id, status, score, timestamp))
-        conn.commit()
+        execute_query(conn, UPSERT_PROGRESS_SQL, (username, node_id, subject_id, status, score, timestamp, due_at))
+        if own: conn.commit()
     except Exception as e:
+        if not own: raise
         print(f"Save Progress Error: {e}")
     finally:
-        conn.close()
-
-def log_activity(username, action_type, subject_id, node_id, question_id, is_correct, duration_seconds=0.0, details=None):
+        if own: conn.close()
+
+# [OPTIMIZATION] Logs are written behind the request: log_activity() only enqueues,
+# a background writer commits them in batches. Set LOG_WRITE_BEHIND=0 to write inline.
+LOG_WRITE_BEHIND = os.environ.get("LOG_WRITE_BEHIND", "1") != "0"
+
+INSERT_LOG_SQL = """
+    INSERT INTO learning_logs (username, action_type, subject_id, node_id, question_id, is_correct, duration_seconds, details, timestamp)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+# [OPTIMIZATION] question_attempt_stats = learning_logs aggregated per (username, subject_id, question_id),
+# updated in the same transaction as every log insert: practice lookups read it by key, never scan the logs.
+UPSERT_ATTEMPT_STATS_SQL = """
+    INSERT INTO question_attempt_stats
+        (username, subject_id, question_id, attempts, corrects, first_correct_at, last_attempt_at)
+    VALUES (%s, %s, %s, 1, %s, %s, %s)
+    ON CONFLICT (username, subject_id, question_id)
+    DO UPDATE SET
+        attempts         = question_attempt_stats.attempts + 1,
+        corrects         = question_attempt_stats.corrects + EXCLUDED.corrects,
+        first_correct_at = COALESCE(question_attempt_stats.first_correct_at, EXCLUDED.first_correct_at),
+        last_attempt_at  = EXCLUDED.last_attempt_at
+"""
+
+def attempt_stats_rows(log_rows):
+    """INSERT_LOG_SQL rows -> UPSERT_ATTEMPT_STATS_SQL rows (rows without user / subject / question are not attempts)."""
+    return [
+        (u, s, q, 1 if c else 0, ts if c else None, ts)
+        for u, _, s, _, q, c, _, _, ts in log_rows
+        if u is not None and s is not None and q is not None
+    ]
+
+def write_logs(conn, rows):
+    """Inserts learning_logs rows + their attempt stats on conn (caller commits)."""
+    execute_many(conn, INSERT_LOG_SQL, rows)
+    stats = attempt_stats_rows(rows)
+    if stats: execute_many(conn, UPSERT_ATTEMPT_STATS_SQL, stats)
+
+_log_queue = None
+_log_queue_lock = threading.Lock()
+
+def _write_log_rows(rows):
     conn = get_connection()
-    if not conn: return
+    if not conn: raise RuntimeError("Lỗi kết nối DB")
     try:
-        execute_query(conn, 
-            'INSERT INTO learning_logs (username, action_type, subject_id, node_id, question_id, is_correct, duration_seconds, details) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)', 
-            (username, action_type, subject_id, node_id, question_id, 1 if is_correct else 0, float(duration_seconds), details))
+        write_logs(conn, rows)
         conn.commit()
-    except Exception as e: print(f"Log Error: {e}")
     finally: conn.close()
 
+def _get_log_queue():
+    global _log_queue
+    if _log_queue is None:
+        with _log_queue_lock:
+            if _log_queue is None:
+                _log_queue = WriteBehindQueue(_write_log_rows)
+    return _log_queue
+
+def flush_logs(timeout=10.0):
+    """Waits until queued log rows are committed. Call before reading learning_logs."""
+    if _log_queue is not None:
+        _log_queue.flush(timeout)
+
+def get_log_queue_stats():
+    return _log_queue.stats() if _log_queue is not None else None
+
+def log_activity(username, action_type, subject_id, node_id, question_id, is_correct, duration_seconds=0.0, details=None, conn=None):
+    """conn: insert inside a unit_of_work() transaction instead of the write-behind queue."""
+    # Timestamp taken now (UTC, like CURRENT_TIMESTAMP), not when the batch lands
+    ts = datetime.now(timezone.utc).replace(tzinfo=None)
+    row = (username, action_type, subject_id, node_id, question_id, 1 if is_correct else 0, float(duration_seconds), details, ts)
+    if conn is not None:
+        write_logs(conn, [row])
+        return
+    if LOG_WRITE_BEHIND:
+        _get_log_queue().submit(row)
+        return
+    try: _write_log_rows([row])
+    except Exception as e: print(f"Log Error: {e}")
+
 def save_user_settings(username, subject_id, threshold, alpha):
     conn = get_connection()
     if not conn: return
@@ -630,8 +798,9 @@ def add_question(q_id, skill, content, options, ans, diff, exp, subject_id):
     try:
         execute_query(conn, '''INSERT INTO questions (question_id, skill_id_list, content, options, answer, difficulty, explanation, subject_id)
                      VALUES (%s, %s, %s, %s, %s, %s, %s, %s)''', (q_id, skill, content, options, ans, diff, exp, subject_id))
+        bumped = bump_content_version(conn, subject_id)
         conn.commit()
-        get_all_questions.clear()
+        publish_content_versions(bumped)
         return True, "Success"
     except Exception as e: return False, str(e)
     finally: conn.close()
@@ -641,8 +810,9 @@ def add_edge(source, target, subject_id):
     if not conn: return False, "Lỗi kết nối DB"
     try:
         execute_query(conn, "INSERT INTO knowledge_structure (source, target, subject_id) VALUES (%s, %s, %s)", (source, target, subject_id))
+        bumped = bump_content_version(conn, subject_id) # Invalidate only this subject's cache
         conn.commit()
-        get_graph_structure.clear() # Invalidate cache
+        publish_content_versions(bumped)
         return True, "Thêm cạnh thành công"
     except Exception as e:
         return False, str(e)
@@ -762,10 +932,15 @@ def get_user_progress(username, subject_id):
     conn = get_connection()
     if not conn: return []
     try:
-        c = execute_query(conn, 'SELECT node_id, status, score, timestamp FROM user_progress WHERE username = %s AND subject_id = %s', (username, subject_id))
-        return c.fetchall()
+        c = execute_query(conn, 'SELECT node_id, status, score, timestamp FROM user_progress WHERE username = %s AND subject_id = %s', (username, subject_id), prepare=True)
+        rows = c.fetchall()
     except: return []
     finally: conn.close()
+    from decay_engine import DECAY_MODE, effective_progress # Lazy: decay_engine imports db_utils
+    if DECAY_MODE == "lazy":
+        # [OPTIMIZATION] Read-time decay: điểm hiệu dụng + trạng thái 'Review' suy ra khi đọc, không ghi lại DB
+        return effective_progress(rows, get_user_settings(username, subject_id)[0])
+    return rows
 
 def get_node_status(username, node_id, subject_id):
     conn = get_connection()
@@ -778,16 +953,23 @@ def get_node_status(username, node_id, subject_id):
             WHERE username = %s AND node_id = %s AND subject_id = %s
             """,
             (username, node_id, subject_id),
+            prepare=True,
         )
-        return c.fetchone()
+        row = c.fetchone()
     except: return None
     finally: conn.close()
+    from decay_engine import DECAY_MODE, effective_progress # Lazy: decay_engine imports db_utils
+    if row and DECAY_MODE == "lazy":
+        # Như get_user_progress: điểm hiệu dụng + 'Review' suy ra khi đọc
+        (_, status, score, ts), = effective_progress([(node_id, *row)], get_user_settings(username, subject_id)[0])
+        return (status, score, ts)
+    return row
 
 def get_user_settings(username, subject_id):
     conn = get_connection()
     if not conn: return (0.7, 0.3)
     try:
-        c = execute_query(conn, 'SELECT mastery_threshold, learning_rate FROM user_settings WHERE username = %s AND subject_id = %s', (username, subject_id))
+        c = execute_query(conn, 'SELECT mastery_threshold, learning_rate FROM user_settings WHERE username = %s AND subject_id = %s', (username, subject_id), prepare=True)
         row = c.fetchone()
         return (row[0], row[1]) if row else (0.7, 0.3)
     except: return (0.7, 0.3)
@@ -797,26 +979,32 @@ def get_user_settings(username, subject_id):
 # 🧠 RECOMMENDATION LOGIC
 # ============================================================
 
-def get_smart_recommendations(username, subject_id, limit=3):
-    k_df = get_graph_structure(subject_id)
-    if k_df.empty: return []
-
-    prog_rows = get_user_progress(username, subject_id)
-    prog_map = {r[0]: (r[1], r[2]) for r in prog_rows}
+DUE_REVIEWS_SQL = """
+    SELECT node_id, status, score, timestamp FROM user_progress
+    WHERE username = %s AND subject_id = %s AND COALESCE(due_at, timestamp) <= %s
+    ORDER BY COALESCE(due_at, timestamp), node_id LIMIT %s
+"""
 
-    recs = []
-    
-    # Priority 1: Review
-    for node, (stat, sc) in prog_map.items():
-        if stat == "Review":
-            recs.append((node, stat, sc))
-            
-    # Priority 2: In Progress
-    for node, (stat, sc) in prog_map.items():
-        if stat == "In Progress" and node not in [r[0] for r in recs]:
-             recs.append((node, stat, sc))
-    
-    return recs[:limit]
+def get_smart_recommendations(username, subject_id, limit=3):
+    """
+    Next `limit` reviews: [(node_id, status, score)] due now, most overdue first.
+    [OPTIMIZATION] Range scan of the (username, subject_id, due_at) index: O(k log N), no full
+    progress read (due_at is kept by every progress write, see review_scheduler; a row
+    without one counts as due from its timestamp, like 'In Progress' rows).
+    """
+    conn = get_connection()
+    if not conn: return []
+    try:
+        c = execute_query(conn, DUE_REVIEWS_SQL, (username, subject_id, datetime.now(), limit), prepare=True)
+        rows = c.fetchall()
+    except Exception as e:
+        print(f"Recommendation Error: {e}")
+        return []
+    finally: conn.close()
+    from decay_engine import DECAY_MODE, effective_progress # Lazy: decay_engine imports db_utils
+    if DECAY_MODE == "lazy":
+        rows = effective_progress(rows, get_user_settings(username, subject_id)[0])
+    return [(node, stat, sc) for node, stat, sc, _ in rows]
 
 # ============================================================
 # 🕰️ FORGETTING CURVE (EBBINGHAUS)
@@ -826,104 +1014,74 @@ def apply_forgetting_decay(username, subject_id, decay_rate=0.1):
     """
     Checks user progress and degrades score based on time elapsed.
     If score falls below threshold, Status -> 'Review'.
+    Returns the saved changes as [(node_id, status, score)] ([] with DECAY_MODE=lazy,
+    where get_user_progress derives the decay on read and nothing is rewritten).
+    [OPTIMIZATION] Set-based: decay_engine computes the whole frame at once and writes
+    all progress + log rows in one transaction (decay_subject(subject_id) = every user).
     """
-    conn = get_connection()
-    if not conn: return
-    
+    from decay_engine import decay_subject # Lazy: decay_engine imports db_utils
     try:
-        # Get threshold
-        threshold, _ = get_user_settings(username, subject_id)
-        
-        # Get all completed/mastered nodes
-        sql = """
-            SELECT node_id, score, timestamp 
-            FROM user_progress 
-            WHERE username=%s AND subject_id=%s AND status IN ('Done', 'Mastered')
-        """
-        c = execute_query(conn, sql, (username, subject_id))
-        rows = c.fetchall()
-        
-        updates = []
-        now = datetime.now()
-        
-        for r in rows:
-            node_id, score, ts = r
-            if not ts: continue
-            
-            # Validation: ts might be string or datetime
-            if isinstance(ts, str):
-                try: ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S.%f")
-                except: 
-                    try: ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
-                    except: continue
-            elif not isinstance(ts, datetime):
-                # In case pandas Timestamp
-                try: ts = ts.to_pydatetime()
-                except: continue
-
-            delta = (now - ts).days
-            if delta < 1: continue # No decay if less than 1 day
-            
-            # Simple Exponential Decay: S = S0 * (1 - alpha)^t
-            decay_factor = (1 - decay_rate) ** delta 
-            new_score = score * decay_factor
-            
-            if new_score < threshold:
-                updates.append((node_id, 'Review', new_score))
-                # LOGGING DECAY (RESEARCH DATA)
-                log_activity(username, 'decay', subject_id, node_id, None, False, 0.0, details=f"Decay: {delta} days, Factor: {decay_factor:.2f}")
-
-            elif abs(score - new_score) > 0.01:
-                # Update score but keep status if still above threshold
-                updates.append((node_id, 'Done', new_score))
-                # Optional: Log minor decay too if research requires high granularity
-        
-        # Batch update
-        for node, stat, scr in updates:
-            save_progress(username, node, subject_id, stat, scr)
-            
+        return decay_subject(subject_id, [username], decay_rate).get(username, [])
     except Exception as e:
         print(f"Decay Error: {e}")
-    finally:
-        conn.close()
+        return []
 
-def penalize_parents(username, subject_id, node_id, penalty_factor=0.15):
+def penalize_parents(username, subject_id, node_id, penalty_factor=0.15, conn=None, decay=None, threshold=None):
     """
-    If a user fails a child node, penalize the parent nodes.
+    If a user fails a child node, penalize the prerequisite nodes.
     This reflects the 'Gap in Prerequisites' logic.
+    [OPTIMIZATION] Multi-hop: every ancestor gets penalty_factor * decay^(hops - 1), read off the
+    ancestor matrix cached per subject version (penalty_engine); decay=0 -> direct parents only.
+    conn: join a unit_of_work() transaction (no commit here, errors propagate).
+    threshold: the user's mastery_threshold for the due_at of the penalized rows, as in
+    save_progress(threshold=...) (None -> read once from user_settings).
+    Returns {ancestor_node: (status, new_score)} for the rows it updated.
     """
-    k_df = get_graph_structure(subject_id)
-    if k_df.empty: return
+    from penalty_engine import ancestor_penalties, PENALTY_DECAY # Lazy: penalty_engine imports subject_graph -> db_utils
+    amounts = ancestor_penalties(subject_id, node_id, penalty_factor, PENALTY_DECAY if decay is None else decay)
+    parents = list(amounts)
+    if not parents: return {}
     
-    # Find direct parents
-    parents = k_df[k_df['target'] == node_id]['source'].tolist()
-    if not parents: return
-    
-    conn = get_connection()
-    if not conn: return
+    own = conn is None
+    if own: conn = get_connection()
+    if not conn: return {}
     
     try:
-        # Get current parent scores
+        # Get current ancestor scores (one query for the whole closure)
         placeholders = ','.join(['%s'] * len(parents))
-        sql = f"SELECT node_id, status, score FROM user_progress WHERE username=%s AND subject_id=%s AND node_id IN ({placeholders})"
+        sql = f"SELECT node_id, status, score, timestamp FROM user_progress WHERE username=%s AND subject_id=%s AND node_id IN ({placeholders})"
         c = execute_query(conn, sql, (username, subject_id, *parents))
+        from decay_engine import DECAY_MODE, effective_progress # Lazy: decay_engine imports db_utils
         rows = c.fetchall()
+        if DECAY_MODE == "lazy":
+            # Phạt trên điểm hiệu dụng (đã quên), vì ghi mới sẽ đặt lại mốc thời gian; threshold 0 = giữ status
+            rows = effective_progress(rows, 0.0)
         
-        for r in rows:
-            p_node, p_status, p_score = r
-            new_score = max(0.0, p_score - penalty_factor)
-            
-            # If score drops significantly, might need to change status?
-            # Keeping it simple: If it drops below threshold, subsequent checks (recommender) will catch it.
-            # But we can force status update if we want.
-            # For now, just update score.
-            
-            save_progress(username, p_node, subject_id, p_status, new_score)
+        # If score drops below threshold, subsequent checks (recommender) will catch it.
+        # For now, just update score (status kept).
+        now = datetime.now()
+        from review_scheduler import review_due_at, DEFAULT_THRESHOLD # Lazy: review_scheduler -> decay_engine imports db_utils
+        if threshold is None and rows:
+            c = execute_query(conn, 'SELECT mastery_threshold FROM user_settings WHERE username = %s AND subject_id = %s', (username, subject_id), prepare=True)
+            row = c.fetchone()
+            threshold = row[0] if row and row[0] is not None else DEFAULT_THRESHOLD
+        updates = []
+        for p_node, p_status, p_score, _ in rows:
+            new_score = max(0.0, p_score - amounts.get(p_node, 0.0))
+            updates.append((username, p_node, subject_id, p_status, new_score, now, review_due_at(p_status, new_score, now, threshold)))
+        
+        # [OPTIMIZATION] One batched upsert instead of one save_progress connection per ancestor
+        if updates:
+            execute_many(conn, UPSERT_PROGRESS_SQL, updates)
+        if own: conn.commit()
+        return {u[1]: (u[3], u[4]) for u in updates}
             
     except Exception as e:
+        if not own: raise
         print(f"Penalize Error: {e}")
+        return {}
     finally:
-        conn.close()
+        if own: conn.close()
 
 # ============================================================
 # 📦 HELPER / MISSING FUNCTIONS
@@ -960,102 +1118,191 @@ def get_test_packet(subject_id):
     """
     Returns pre-computed test packet (JSON) for offline/fast mode.
     Returns None to force fallback to standard DB queries.
+    [OPTIMIZATION] One file read; rebuilt from the DB only when the subject's
+    content_version moved past the packet's (see test_packet).
     """
-    return None
+    from test_packet import load_packet # Lazy: test_packet imports db_utils
+    try:
+        return load_packet(subject_id)
+    except Exception as e:
+        print(f"Test Packet Error: {e}")
+        return None
+
+USER_SUBJECT_LOGS_SQL = """
+    SELECT timestamp, action_type, node_id, question_id, is_correct, duration_seconds, details
+    FROM learning_logs 
+    WHERE username=%s AND subject_id=%s 
+    ORDER BY timestamp DESC LIMIT %s
+"""
+
+USER_LOGS_SQL = """
+    SELECT timestamp, action_type, node_id, question_id, is_correct, subject_id, duration_seconds, details
+    FROM learning_logs 
+    WHERE username=%s 
+    ORDER BY timestamp DESC LIMIT %s
+"""
 
 def get_user_logs(username, subject_id=None, limit=1000):
     """
     Get recent activity logs.
     """
+    flush_logs()
     conn = get_connection()
     if not conn: return pd.DataFrame()
     try:
         if subject_id:
-            sql = """
-                SELECT timestamp, action_type, node_id, question_id, is_correct, duration_seconds, details
-                FROM learning_logs 
-                WHERE username=%s AND subject_id=%s 
-                ORDER BY timestamp DESC LIMIT %s
-            """
-            return pd.read_sql(sql, conn, params=(username, subject_id, limit))
+            return read_sql(USER_SUBJECT_LOGS_SQL, conn, params=(username, subject_id, limit))
         else:
-            sql = """
-                SELECT timestamp, action_type, node_id, question_id, is_correct, subject_id, duration_seconds, details
-                FROM learning_logs 
-                WHERE username=%s 
-                ORDER BY timestamp DESC LIMIT %s
-            """
-            return pd.read_sql(sql, conn, params=(username, limit))
+            return read_sql(USER_LOGS_SQL, conn, params=(username, limit))
     except: return pd.DataFrame()
     finally: conn.close()
 
-def get_global_test_logs(subject_id=None, limit=5000):
+# [OPTIMIZATION] Admin log explorer: filters, timezone conversion and pagination run in the DB.
+# Pages are keyset-paginated on (timestamp, id) newest first, so a session only ever holds one page.
+LOG_PAGE_SIZE = 500
+LOG_TIMEZONE = "Asia/Ho_Chi_Minh"  # learning_logs.timestamp is naive UTC
+
+def _log_exprs(dialect):
+    """(local display time, local date, keyset id) of learning_logs l in `dialect`."""
+    if dialect == SQLITE:
+        # No tz database in SQLite: VN is a fixed UTC+7 (no DST). 'id SERIAL' is not a rowid alias there -> rowid
+        # substr: drop fractional seconds first (strftime would round them up, pandas truncated)
+        return ("strftime('%%d/%%m/%%Y %%H:%%M:%%S', substr(l.timestamp, 1, 19), '+7 hours')",
+                "date(substr(l.timestamp, 1, 19), '+7 hours')", "l.rowid")
+    local = f"((l.timestamp AT TIME ZONE 'UTC') AT TIME ZONE '{LOG_TIMEZONE}')"
+    return f"to_char({local}, 'DD/MM/YYYY HH24:MI:SS')", f"to_char({local}, 'YYYY-MM-DD')", "l.id"
+
+def _like_prefix(prefix):
+    """LIKE pattern matching strings that start with prefix ('_' / '%' taken literally)."""
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def _log_filters(subject_id=None, action_prefix=None, username=None):
+    """WHERE fragment + params shared by the explorer queries."""
+    sql, params = "", []
+    if subject_id:
+        sql += " AND l.subject_id = %s"; params.append(subject_id)
+    if action_prefix:
+        sql += " AND l.action_type LIKE %s ESCAPE '\\'"; params.append(_like_prefix(action_prefix))
+    if username:
+        sql += " AND l.username = %s"; params.append(username)
+    return sql, params
+
+def _global_logs_sql(dialect, filters_sql="", keyset=False):
+    local_time, local_date, key = _log_exprs(dialect)
+    return f"""
+        SELECT
+            {local_time} AS timestamp,
+            {local_date} AS log_date,
+            l.username,
+            u.name as full_name,
+            l.subject_id,
+            l.action_type,
+            l.node_id,
+            l.question_id,
+            l.is_correct,
+            l.score,
+            l.duration_seconds,
+            l.timestamp AS cursor_ts,
+            {key} AS cursor_id
+        FROM learning_logs l
+        LEFT JOIN users u ON l.username = u.username
+        WHERE 1=1 {filters_sql}
+        {f"AND (l.timestamp, {key}) < (%s, %s)" if keyset else ""}
+        ORDER BY l.timestamp DESC, {key} DESC
+        LIMIT %s
     """
-    Get activity logs for ALL users (Admin view).
-    Joins with users table to get real names.
+
+def query_global_logs(subject_id=None, action_prefix=None, username=None, cursor=None, limit=LOG_PAGE_SIZE):
+    """
+    One page of logs for ALL users (Admin view), newest first, with real names and local (VN) time.
+    action_prefix: e.g. "test_smart_cat" (also matches "test_smart_cat_start").
+    cursor: the next_cursor of the previous page (None = first page).
+    Returns (df, next_cursor); next_cursor is None on the last page.
     """
+    flush_logs()
     conn = get_connection()
-    if not conn: return pd.DataFrame()
+    if not conn: return pd.DataFrame(), None
     try:
-        # Note: 'learning_logs' and 'users' need to be in the same DB for JOIN to work easily.
-        # If using SQLite simple join works if tables in same file.
-        # If SQLite uses attached DBs, it might be complex, but usually they are in 'local_course.db' or mapped.
-        # Check init_db: users and learning_logs are likely in same DB context for get_connection().
-        
-        base_sql = """
-            SELECT 
-                l.timestamp, 
-                l.username, 
-                u.name as full_name, 
-                l.subject_id, 
-                l.action_type, 
-                l.node_id, 
-                l.question_id, 
-                l.is_correct, 
-                l.score,
-                l.duration_seconds
-            FROM learning_logs l
-            LEFT JOIN users u ON l.username = u.username
-            WHERE 1=1
-        """
-        params = []
-        if subject_id:
-            base_sql += " AND l.subject_id = %s"
-            params.append(subject_id)
-            
-        base_sql += " ORDER BY l.timestamp DESC LIMIT %s"
-        params.append(limit)
-        
-        # [FIX] Compat: Swap %s to ? for SQLite
-        if 'sqlite' in str(type(conn)).lower():
-            base_sql = base_sql.replace('%s', '?')
-            
-        df = pd.read_sql(base_sql, conn, params=tuple(params))
-        
-        # [FIX] Timezone Shift: UTC -> Local (VN UTC+7)
-        if not df.empty and 'timestamp' in df.columns:
-            try:
-                # Ensure datetime
-                df['timestamp'] = pd.to_datetime(df['timestamp'])
-                # If naive (SQlite), assume UTC. if TZ-aware (Postgres), convert.
-                if df['timestamp'].dt.tz is None:
-                    # Naive -> Localize UTC -> Convert VN
-                    df['timestamp'] = df['timestamp'].dt.tz_localize('UTC').dt.tz_convert('Asia/Ho_Chi_Minh')
-                else:
-                    df['timestamp'] = df['timestamp'].dt.tz_convert('Asia/Ho_Chi_Minh')
-                    
-                # Format for display
-                df['timestamp'] = df['timestamp'].dt.strftime('%d/%m/%Y %H:%M:%S')
-            except Exception as e:
-                print(f"Timezone conversion error: {e}")
-
-        return df
+        filters_sql, params = _log_filters(subject_id, action_prefix, username)
+        if cursor is not None:
+            params += list(cursor)
+        df = read_sql(_global_logs_sql(dialect_of(conn), filters_sql, keyset=cursor is not None), conn,
+                      params=tuple(params + [limit + 1]))
     except Exception as e:
         print(f"Error getting global logs: {e}")
+        return pd.DataFrame(), None
+    finally:
+        conn.close()
+    next_cursor = None
+    if len(df) > limit:
+        df = df.iloc[:limit]
+        last = df.iloc[-1]
+        ts = last["cursor_ts"]
+        next_cursor = (ts.to_pydatetime() if hasattr(ts, "to_pydatetime") else ts, int(last["cursor_id"]))  # Plain types for the driver
+    return df.drop(columns=["cursor_ts", "cursor_id"]), next_cursor
+
+def iter_global_logs(subject_id=None, action_prefix=None, username=None, page_size=LOG_PAGE_SIZE):
+    """Every matching log, one page (DataFrame) at a time."""
+    cursor = None
+    while True:
+        df, cursor = query_global_logs(subject_id, action_prefix, username, cursor, page_size)
+        if not df.empty: yield df
+        if cursor is None: return
+
+LOG_SUMMARY_SQL = """
+    SELECT {local_date} AS log_date, l.username,
+           COALESCE(NULLIF(u.name, ''), l.username) AS full_name, l.action_type,
+           COUNT(l.question_id) AS questions_done,
+           AVG(l.is_correct * 1.0) AS avg_score,
+           MAX(l.timestamp) AS last_active
+    FROM learning_logs l
+    LEFT JOIN users u ON l.username = u.username
+    WHERE l.action_type LIKE %s ESCAPE '\\' AND l.action_type NOT LIKE %s ESCAPE '\\' {filters_sql}
+    GROUP BY 1, 2, 3, 4
+    ORDER BY last_active DESC
+    LIMIT %s
+"""
+
+def summarize_global_logs(subject_id=None, action_prefix=None, limit=1000):
+    """
+    CAT answers (action '*_cat*', not '*_start') per local day / user / test type, latest first:
+    log_date, username, full_name, action_type, questions_done, avg_score (0..1), last_active.
+    """
+    flush_logs()
+    conn = get_connection()
+    if not conn: return pd.DataFrame()
+    try:
+        filters_sql, params = _log_filters(subject_id, action_prefix)
+        sql = LOG_SUMMARY_SQL.format(local_date=_log_exprs(dialect_of(conn))[1], filters_sql=filters_sql)
+        return read_sql(sql, conn, params=tuple(["%\\_cat%", "%\\_start%"] + params + [limit]))
+    except Exception as e:
+        print(f"Error summarizing global logs: {e}")
         return pd.DataFrame()
     finally:
         conn.close()
 
+def get_log_distribution(column):
+    """Row counts of learning_logs per subject_id or action_type (GROUP BY in the DB)."""
+    if column not in ("subject_id", "action_type"): raise ValueError(column)
+    flush_logs()
+    conn = get_connection()
+    if not conn: return pd.Series(dtype=int)
+    try:
+        df = read_sql(f"SELECT {column}, COUNT(*) AS count FROM learning_logs GROUP BY {column} ORDER BY count DESC", conn)
+        return df.set_index(column)["count"]
+    except Exception as e:
+        print(f"Error getting log distribution: {e}")
+        return pd.Series(dtype=int)
+    finally:
+        conn.close()
+
+def get_global_test_logs(subject_id=None, limit=5000):
+    """
+    Get activity logs for ALL users (Admin view): the first `limit` rows of query_global_logs().
+    """
+    df, _ = query_global_logs(subject_id, limit=limit)
+    return df
+
 # ============================================================
 # 🛠️ MISSING ADMIN FUNCTIONS (RESTORED)
 # ============================================================
@@ -1064,8 +1311,11 @@ def delete_question(q_id):
     conn = get_connection()
     if not conn: return
     try:
+        c = execute_query(conn, "SELECT subject_id FROM questions WHERE question_id = %s", (q_id,))
         execute_query(conn, "DELETE FROM questions WHERE question_id = %s", (q_id,))
+        bumped = bump_content_version(conn, *[r[0] for r in c.fetchall()])
         conn.commit()
+        publish_content_versions(bumped)
     except Exception as e: print(f"Delete Error: {e}")
     finally: conn.close()
 
@@ -1073,8 +1323,11 @@ def delete_edge(edge_id):
     conn = get_connection()
     if not conn: return
     try:
+        c = execute_query(conn, "SELECT subject_id FROM knowledge_structure WHERE id = %s", (edge_id,))
         execute_query(conn, "DELETE FROM knowledge_structure WHERE id = %s", (edge_id,))
+        bumped = bump_content_version(conn, *[r[0] for r in c.fetchall()])
         conn.commit()
+        publish_content_versions(bumped)
     except Exception as e: print(f"Delete Edge Error: {e}")
     finally: conn.close()
 
@@ -1109,6 +1362,7 @@ def create_subject(sub_id, sub_name, description):
     finally: conn.close()
 
 def delete_subject_content(subject_id):
+    flush_logs() # Pending rows must not land after the DELETE
     conn = get_connection()
     if not conn: return False, "DB Error"
     try:
@@ -1130,8 +1384,10 @@ def delete_subject_content(subject_id):
         
         # Finally delete the subject itself
         execute_query(conn, "DELETE FROM subjects WHERE subject_id = %s", (subject_id,))
+        bumped = bump_content_version(conn, subject_id)
         
         conn.commit()
+        publish_content_versions(bumped)
         get_all_subjects.clear() # Clear cache
         return True, f"Đã xóa hoàn toàn môn học: {subject_id} và các dữ liệu liên quan."
     except Exception as e: 
@@ -1148,7 +1404,9 @@ def clear_table_data(table_name):
     if not conn: return
     try:
         execute_query(conn, f"DELETE FROM {table_name}") # Vulnerable if not whitelisted, but we checked ALLOWED
+        bumped = bump_all_content_versions(conn)
         conn.commit()
+        publish_content_versions(bumped)
     except: pass
     finally: conn.close()
 
@@ -1163,20 +1421,17 @@ def import_knowledge_structure(df, subject_id):
         for _, row in df.iterrows():
             data.append((row['source'], row['target'], subject_id))
         
-        c = conn.cursor()
         sql = "INSERT INTO knowledge_structure (source, target, subject_id) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING"
-        
-        # [ADAPTIVE] Fix placeholder for SQLite
-        if isinstance(conn, sqlite3.Connection):
-            sql = sql.replace('%s', '?')
-            
-        c.executemany(sql, data)
+        execute_many(conn, sql, data)
+        bumped = bump_content_version(conn, subject_id)
         conn.commit()
+        publish_content_versions(bumped)
         return True, f"Imported {len(data)} edges."
     except Exception as e: return False, str(e)
     finally: conn.close()
 
 def import_questions_bank(df, subject_id):
+    from question_index import parse_options, options_json # Lazy: question_index imports db_utils
     conn = get_connection()
     if not conn: return False, "No DB"
     try:
@@ -1191,14 +1446,13 @@ def import_questions_bank(df, subject_id):
                 row['question_id'],
                 row.get('skill_id_list', '[]'),
                 row['content'],
-                row.get('options', '[]'),
+                options_json(parse_options(row.get('options', '[]'))), # Chuẩn hoá: mảng JSON
                 row['answer'],
                 row.get('difficulty', 'medium'),
                 row.get('explanation', ''),
                 subject_id
             ))
         
-        c = conn.cursor()
         sql = """
             INSERT INTO questions (question_id, skill_id_list, content, options, answer, difficulty, explanation, subject_id) 
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s) 
@@ -1211,12 +1465,17 @@ def import_questions_bank(df, subject_id):
                 difficulty=EXCLUDED.difficulty,
                 explanation=EXCLUDED.explanation
         """
-        # [ADAPTIVE] Fix placeholder for SQLite
-        if isinstance(conn, sqlite3.Connection):
-            sql = sql.replace('%s', '?')
-            
-        c.executemany(sql, data)
+        # Upsert can move a question between subjects: the old subjects change too
+        q_ids = [d[0] for d in data]
+        moved_from = set()
+        for i in range(0, len(q_ids), 500):
+            chunk = q_ids[i:i + 500]
+            c = execute_query(conn, f"SELECT DISTINCT subject_id FROM questions WHERE question_id IN ({','.join(['%s'] * len(chunk))})", tuple(chunk))
+            moved_from.update(r[0] for r in c.fetchall())
+        execute_many(conn, sql, data)
+        bumped = bump_content_version(conn, subject_id, *moved_from)
         conn.commit()
+        publish_content_versions(bumped)
         return True, f"Imported {len(data)} questions."
     except Exception as e: return False, str(e)
     finally: conn.close()
@@ -1231,17 +1490,12 @@ def import_lectures_data(df):
                 row['node_id'], row.get('title', ''), row.get('content_type', 'markdown'), 
                 row.get('content_url', ''), row.get('description', '')
             ))
-        c = conn.cursor()
         sql = """
             INSERT INTO learning_resources (node_id, title, content_type, content_url, description)
             VALUES (%s, %s, %s, %s, %s)
             ON CONFLICT (node_id) DO UPDATE SET title=EXCLUDED.title, content_url=EXCLUDED.content_url
         """
-        # [ADAPTIVE] Fix placeholder for SQLite
-        if isinstance(conn, sqlite3.Connection):
-            sql = sql.replace('%s', '?')
-            
-        c.executemany(sql, data)
+        execute_many(conn, sql, data)
         conn.commit()
         return True, f"Imported {len(data)} resources."
     except Exception as e: return False, str(e)
@@ -1252,65 +1506,94 @@ def import_content_from_docx(file_obj):
     return False, "Chức năng import DOCX chưa được cài đặt thư viện hỗ trợ (python-docx)."
 
 def generate_test_packet(subject_id):
-    # Stub
-    return False, "Chức năng Test Packet chưa khả dụng."
+    from test_packet import generate_packet
+    try:
+        packet, path = generate_packet(subject_id)
+        if packet is None: return False, "Lỗi kết nối DB"
+        return True, (f"Đã đóng gói {len(packet['questions'])} câu hỏi, {len(packet['graph']['edges'])} cạnh "
+                      f"(version {packet['content_version']}, hash {packet['hash'][:12]}) → {os.path.basename(path)}")
+    except Exception as e:
+        return False, f"Lỗi tạo Test Packet: {e}"
+
+ATTEMPT_STATS_BY_QID_SQL = "SELECT question_id, corrects FROM question_attempt_stats WHERE username = %s AND subject_id = %s AND question_id"
+
+def _skill_question_ids(subject_id, node_id, question_ids):
+    """The caller's question ids, else node_id's questions from the skill index (stats are keyed per question, not per node)."""
+    if question_ids is not None:
+        return [str(q) for q in question_ids]
+    from question_index import get_question_index # Lazy: question_index imports db_utils
+    return sorted(get_question_index(subject_id).question_ids_for(node_id))
 
-def get_mastered_question_ids(username, subject_id, node_id):
+def _attempt_stats(conn, username, subject_id, question_ids):
+    """
+    [(question_id, corrects)] from question_attempt_stats: primary-key reads for exactly these questions,
+    plus this user's log rows still in the write-behind queue (read-your-writes without flush_logs(),
+    which would wait on every session's rows). Pending rows are taken first: a row is then either
+    listed or already committed.
+    """
+    if not question_ids: return []
+    wanted = set(question_ids)
+    pending = [] if _log_queue is None else _log_queue.pending(
+        lambda r: r[0] == username and r[2] == subject_id and r[4] is not None and str(r[4]) in wanted)
+    placeholders = ','.join(['%s'] * len(question_ids))
+    rows = execute_query(conn, f"{ATTEMPT_STATS_BY_QID_SQL} IN ({placeholders})", (username, subject_id, *question_ids)).fetchall()
+    return rows + [(str(r[4]), 1 if r[5] else 0) for r in pending]
+
+def get_mastered_question_ids(username, subject_id, node_id, conn=None, question_ids=None):
     """
     Get list of question_ids that user has answered CORRECTLY (is_correct=1)
     for a specific skill.
+    conn: read inside a unit_of_work() transaction.
+    question_ids: the skill's questions, if the caller has them (None -> looked up in the question index).
     """
-    conn = get_connection()
+    question_ids = _skill_question_ids(subject_id, node_id, question_ids)
+    own = conn is None
+    if own: conn = get_connection()
     if not conn: return set()
     
     try:
-        sql = """
-            SELECT DISTINCT question_id 
-            FROM learning_logs 
-            WHERE username = %s 
-              AND subject_id = %s 
-              AND node_id = %s
-              AND is_correct = 1
-        """
-        c = execute_query(conn, sql, (username, subject_id, node_id))
-        rows = c.fetchall()
-        return {r[0] for r in rows} # Return set for O(1) lookup
+        rows = _attempt_stats(conn, username, subject_id, question_ids)
+        return {q for q, corrects in rows if corrects} # Return set for O(1) lookup
     except Exception as e:
+        if not own: raise
         print(f"Error getting mastered questions: {e}")
         return set()
+    finally:
+        if own: conn.close()
+
+def rebuild_question_attempt_stats():
+    """Backfill job: recomputes question_attempt_stats from the whole learning_logs table."""
+    flush_logs()
+    try:
+        with unit_of_work() as conn:
+            if conn is None: return False, "Lỗi kết nối DB"
+            backfill_question_attempt_stats(conn)
+            n = execute_query(conn, "SELECT COUNT(*) FROM question_attempt_stats").fetchone()[0]
+        return True, f"Đã tổng hợp lại {n} dòng question_attempt_stats"
+    except Exception as e:
+        return False, str(e)
 
-def get_question_status_map(username, subject_id, node_id):
+def get_question_status_map(username, subject_id, node_id, question_ids=None):
     """
     Returns a dict {question_id: status} where status is:
     - 'correct': If user ever got it right (is_correct=1)
     - 'incorrect': If user has attempted it but NEVER got it right
+    question_ids: as in get_mastered_question_ids.
     """
+    question_ids = _skill_question_ids(subject_id, node_id, question_ids)
     conn = get_connection()
     if not conn: return {}
     
     try:
-        # Get all attempts
-        sql = """
-            SELECT question_id, is_correct
-            FROM learning_logs 
-            WHERE username = %s 
-              AND subject_id = %s 
-              AND node_id = %s
-        """
-        c = execute_query(conn, sql, (username, subject_id, node_id))
-        rows = c.fetchall()
-        
-        status_map = {}
-        for q_id, is_corr in rows:
-            is_corr_bool = bool(is_corr)
-            current_status = status_map.get(q_id)
-            
-            if is_corr_bool:
-                status_map[q_id] = 'correct' # Once correct, always correct
-            elif current_status != 'correct':
-                status_map[q_id] = 'incorrect'
-                
-        return status_map
+        # One aggregate row per attempted question, + queued rows (once correct, always correct)
+        rows = _attempt_stats(conn, username, subject_id, question_ids)
+        status = {}
+        for q_id, corrects in rows:
+            if corrects or q_id not in status:
+                status[q_id] = 'correct' if corrects else 'incorrect'
+        return status
     except Exception as e:
         print(f"Error getting question status map: {e}")
-        return {}
\ No newline at end of file
+        return {}
+    finally:
+        conn.close()
@@ -0,0 +1,166 @@
+"""
+Set-based forgetting decay (FASS).
+
+One read of the Done/Mastered rows (plus each user's threshold), the
+exponential decay S = S0 * (1 - alpha)^days computed over the whole frame,
+then every progress update and decay log row written in one transaction:
+
+    decay_subject("ML", usernames=["an"])   # one learner (page load)
+    decay_subject("ML")                     # every learner of the subject, same single pass
+
+DECAY_MODE=lazy switches to read-time decay instead: user_progress keeps the
+last reinforced score + timestamp untouched, effective_progress() derives the
+decayed score and the 'Review' status whenever a user's progress is read, and
+nothing is ever rewritten in bulk (apply_forgetting_decay becomes a no-op).
+"""
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from db_utils import (
+    get_connection, read_sql, execute_many, unit_of_work, write_logs,
+    UPSERT_PROGRESS_SQL
+)
+
+DEFAULT_THRESHOLD = 0.7
+DECAY_RATE = 0.1
+DECAY_MODE = os.environ.get("DECAY_MODE", "eager")  # "eager" (rewrite rows) | "lazy" (derive on read)
+
+_DECAYING = ("Done", "Mastered")
+
+_DECAY_ROWS_SQL = """
+    SELECT p.username, p.node_id, p.score, p.timestamp, s.mastery_threshold
+    FROM user_progress p
+    LEFT JOIN user_settings s ON s.username = p.username AND s.subject_id = p.subject_id
+    WHERE p.subject_id = %s AND p.status IN ('Done', 'Mastered')
+"""
+
+
+def load_decay_frame(subject_id, usernames=None):
+    """Done/Mastered rows of subject_id (optionally only some users) with each user's threshold."""
+    sql = _DECAY_ROWS_SQL
+    params = [subject_id]
+    if usernames is not None:
+        usernames = list(usernames)
+        if not usernames:
+            return pd.DataFrame(columns=["username", "node_id", "score", "timestamp", "mastery_threshold"])
+        sql += f" AND p.username IN ({', '.join(['%s'] * len(usernames))})"
+        params += usernames
+    conn = get_connection()
+    if not conn: return pd.DataFrame()
+    try:
+        return read_sql(sql, conn, params=tuple(params))
+    finally:
+        conn.close()
+
+
+def _decay_factors(timestamps, scores, decay_rate, now=None):
+    """(whole days elapsed, score, (1 - alpha)^days, timestamps); NaN days / score (NaT) where unreadable."""
+    ts = pd.to_datetime(pd.Series(timestamps, dtype=object), errors="coerce", format="mixed")
+    if ts.dt.tz is not None:
+        ts = ts.dt.tz_convert(None)
+    days = (pd.Timestamp(now or datetime.now()) - ts).dt.days.to_numpy(dtype=float)  # NaN khi timestamp hỏng
+    score = pd.to_numeric(pd.Series(scores, dtype=object), errors="coerce").to_numpy(dtype=float)
+    factor = np.power(1 - decay_rate, np.clip(np.nan_to_num(days), 0, None))
+    return days, score, factor, ts
+
+
+def compute_decay(frame, decay_rate=0.1, now=None):
+    """
+    Decay of every row at once. Returns the rows that change with columns
+    username, node_id, status ('Review' below threshold, else 'Done'), score, days, factor and
+    due_at (the day the curve crossed / will cross threshold, see review_scheduler). Rows decayed by <= 0.01 while still above threshold, younger than a day or without a
+    readable timestamp are left alone.
+    """
+    cols = ["username", "node_id", "status", "score", "days", "factor", "due_at"]
+    if frame is None or frame.empty:
+        return pd.DataFrame(columns=cols)
+    days, score, factor, ts = _decay_factors(frame["timestamp"], frame["score"], decay_rate, now)
+    threshold = pd.to_numeric(frame["mastery_threshold"], errors="coerce").fillna(DEFAULT_THRESHOLD).to_numpy(dtype=float)
+
+    valid = ~np.isnan(days) & ~np.isnan(score) & (days >= 1)
+    factor = np.where(valid, factor, 1.0)
+    new_score = score * factor
+    review = valid & (new_score < threshold)
+    minor = valid & ~review & (np.abs(score - new_score) > 0.01)
+    changed = review | minor
+
+    # Due = first whole day with S0 * (1 - alpha)^d < threshold, counted from the original timestamp
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cross = np.floor(np.log(threshold / score) / np.log(1 - decay_rate)) + 1
+    cross = np.where(score >= threshold, np.nan_to_num(cross), 0)
+    due_at = ts.to_numpy()[changed] + pd.to_timedelta(cross[changed], unit="D").to_numpy()
+
+    out = pd.DataFrame({
+        "username": frame["username"].to_numpy()[changed],
+        "node_id": frame["node_id"].to_numpy()[changed],
+        "status": np.where(review[changed], "Review", "Done"),
+        "score": new_score[changed],
+        "days": days[changed].astype(int),
+        "factor": factor[changed],
+        "due_at": due_at,
+    })
+    return out[cols]
+
+
+def effective_progress(rows, threshold=DEFAULT_THRESHOLD, decay_rate=DECAY_RATE, now=None):
+    """
+    Read-time decay of one user's get_user_progress() rows [(node_id, status, score, timestamp)].
+    Done/Mastered rows older than a day get S0 * (1 - alpha)^days and turn 'Review' once that
+    falls below threshold (as the eager pass would); other rows and the stored timestamp
+    (last reinforcement) pass through.
+    """
+    if not rows:
+        return rows
+    nodes, statuses, scores, stamps = zip(*rows)
+    days, score, factor, _ = _decay_factors(stamps, scores, decay_rate, now)
+    decaying = np.isin(np.asarray(statuses, dtype=object), _DECAYING) & (days >= 1) & ~np.isnan(score)
+    eff = np.where(decaying, score * factor, score)
+    review = decaying & (eff < threshold)
+    out_scores = [float(e) if d else s for e, d, s in zip(eff.tolist(), decaying.tolist(), scores)]
+    out_status = ["Review" if rv else st for rv, st in zip(review.tolist(), statuses)]
+    return list(zip(nodes, out_status, out_scores, stamps))
+
+
+def write_decay(subject_id, changes, conn=None):
+    """Progress upserts + 'decay' log rows (Review transitions) of compute_decay(), in one transaction."""
+    if changes.empty:
+        return
+    now = datetime.now()
+    log_ts = datetime.now(timezone.utc).replace(tzinfo=None)
+    progress_rows = [
+        (u, n, subject_id, st, float(sc), now, due)
+        for u, n, st, sc, due in zip(changes["username"], changes["node_id"], changes["status"], changes["score"],
+                                     [t.to_pydatetime() for t in pd.to_datetime(changes["due_at"])])
+    ]
+    # LOGGING DECAY (RESEARCH DATA): chỉ các node rơi xuống Review, như trước
+    review = changes[changes["status"] == "Review"]
+    log_rows = [
+        (u, 'decay', subject_id, n, None, 0, 0.0, f"Decay: {d} days, Factor: {f:.2f}", log_ts)
+        for u, n, d, f in zip(review["username"], review["node_id"], review["days"], review["factor"])
+    ]
+    if conn is not None:
+        execute_many(conn, UPSERT_PROGRESS_SQL, progress_rows)
+        if log_rows: write_logs(conn, log_rows)
+        return
+    with unit_of_work() as uow:
+        if uow is None: return
+        write_decay(subject_id, changes, conn=uow)
+
+
+def decay_subject(subject_id, usernames=None, decay_rate=0.1, now=None):
+    """
+    Decay for the given users of subject_id (None = every user), one read + one transaction.
+    Returns {username: [(node_id, status, score)]} of the saved changes.
+    Lazy mode writes nothing and returns {}: reads already see the decayed scores.
+    """
+    if DECAY_MODE == "lazy":
+        return {}
+    changes = compute_decay(load_decay_frame(subject_id, usernames), decay_rate, now)
+    write_decay(subject_id, changes)
+    result = {}
+    for u, n, st, sc in zip(changes["username"], changes["node_id"], changes["status"], changes["score"]):
+        result.setdefault(u, []).append((n, st, float(sc)))
+    return result
@@ -0,0 +1,163 @@
+"""
+Graph view-model shared by the knowledge-map pages.
+
+Everything about the map that does not depend on the user is computed once
+per compiled SubjectGraph (i.e. per subject content_version) and cached:
+chapter detection, chapter ownership, chapter order, zig-zag levels, spine
+edges, labels and per-page node styles. A page only recolours on top:
+
+    view = get_graph_view(subject_graph)
+    layout = view.project()                       # full map (cached)
+    for spec in view.node_specs(MAP_STYLE):       # cached per style name
+        Node(**spec, color=..., title=...)
+
+Compact views pass the visible node set: project(visible) re-wires edges
+whose source is hidden to the owner chapter and compacts the levels.
+"""
+import re
+import threading
+import weakref
+from collections import deque
+
+_DIGITS_RE = re.compile(r"\d+")
+
+
+def is_chapter_id(node_id):
+    """Chapter / container heuristic used by the map pages ("Chg1", "3", "Intro")."""
+    n = str(node_id)
+    return "Chg" in n or n.isdigit() or (len(n) < 5 and "." not in n)
+
+
+def chapter_sort_key(chapter):
+    m = _DIGITS_RE.search(chapter)
+    return int(m.group()) if m else 999
+
+
+def chapter_label(chapter):
+    """"Chg2" -> "2. Chg2"."""
+    m = _DIGITS_RE.search(chapter)
+    return f"{m.group(0)}. {chapter}" if m else chapter
+
+
+class GraphLayout:
+    """One projection of the map: nodes in first-seen edge order, drawn edges, levels and spine."""
+
+    def __init__(self, nodes, edges, levels, spine):
+        self.nodes = nodes      # tuple of node ids
+        self.edges = edges      # tuple of (source, target)
+        self.levels = levels    # {node: level}
+        self.spine = spine      # tuple of (chapter, next chapter)
+
+
+class GraphView:
+    """Read-only after construction: shared by every session that renders this graph version."""
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.chapters = tuple(n for n in graph.ids if is_chapter_id(n))
+        self.chapter_set = frozenset(self.chapters)
+        self.sorted_chapters = tuple(sorted(self.chapters, key=chapter_sort_key))
+
+        # Owner chapter: BFS from each chapter, never crossing into another chapter
+        owner = {}
+        for chap in self.chapters:
+            queue = deque([chap])
+            visited = {chap}
+            while queue:
+                curr = queue.popleft()
+                owner.setdefault(curr, chap)
+                for child in graph.children(curr):
+                    if child in self.chapter_set and child != chap: continue
+                    if child not in visited:
+                        visited.add(child); queue.append(child)
+        self.node_to_chapter = owner
+
+        self._full = None
+        self._specs = {}
+        self._lock = threading.Lock()
+
+    def project(self, visible=None):
+        """Layout of the visible nodes (None = all; the full layout is cached)."""
+        if visible is None and self._full is not None:
+            return self._full
+
+        owner = self.node_to_chapter
+        order = {}
+        edges = []
+        for src, tgt in self.graph.edges():
+            final_src = None
+            if visible is None or (src in visible and tgt in visible):
+                final_src = src
+            elif tgt in visible:
+                # Nguồn bị ẩn -> nối vào Chương sở hữu
+                chap = owner.get(tgt)
+                if chap and chap in visible:
+                    final_src = chap
+            if final_src is None:
+                continue
+            order.setdefault(final_src)
+            order.setdefault(tgt)
+            edges.append((final_src, tgt))
+
+        # Zig-zag levels over the visible chapters: chapter i -> 2i, its lessons -> 2i + 1
+        shown = self.sorted_chapters if visible is None else [c for c in self.sorted_chapters if c in visible]
+        chap_pos = {c: i for i, c in enumerate(shown)}
+        levels = {}
+        for n in order:
+            i = chap_pos.get(owner.get(n))
+            levels[n] = 0 if i is None else (2 * i if n in self.chapter_set else 2 * i + 1)
+
+        present = [c for c in self.sorted_chapters if c in order]
+        spine = tuple(zip(present, present[1:]))
+        layout = GraphLayout(tuple(order), tuple(edges), levels, spine)
+        if visible is None:
+            self._full = layout
+        return layout
+
+    def node_specs(self, style, visible=None):
+        """
+        Static Node kwargs (id, label, level + chapter / lesson style) of a layout.
+        style: {"name", "chapter": {...}, "lesson": {...}, "numbered": bool}; cached per name for the full layout.
+        """
+        if visible is None:
+            specs = self._specs.get(style["name"])
+            if specs is not None:
+                return specs
+        layout = self.project(visible)
+        specs = []
+        for n in layout.nodes:
+            is_chap = n in self.chapter_set
+            spec = {"id": n, "label": chapter_label(n) if is_chap and style.get("numbered") else n, "level": layout.levels[n]}
+            spec.update(style["chapter"] if is_chap else style["lesson"])
+            specs.append(spec)
+        specs = tuple(specs)
+        if visible is None:
+            with self._lock:
+                self._specs[style["name"]] = specs
+        return specs
+
+
+def spine_widths(count, max_width, min_width):
+    """Widths tapering linearly from max_width to min_width over count spine edges."""
+    if count <= 1:
+        return [max_width] * count
+    return [int(max_width - (max_width - min_width) * (i / (count - 1))) for i in range(count)]
+
+
+# ============================================================
+# 🗂️ PROCESS CACHE (one view per compiled graph = per subject version)
+# ============================================================
+
+_views = weakref.WeakKeyDictionary()
+_views_lock = threading.Lock()
+
+
+def get_graph_view(graph):
+    view = _views.get(graph)
+    if view is None:
+        with _views_lock:
+            view = _views.get(graph)
+            if view is None:
+                view = GraphView(graph)
+                _views[graph] = view
+    return view
@@ -0,0 +1,179 @@
+"""
+Write-behind queue for learning_logs.
+
+log_activity() only enqueues a row; a daemon thread drains the bounded queue
+and writes batches with one executemany + one commit, whenever `batch_size`
+rows are waiting or `flush_interval` seconds have passed since the first one.
+
+- Backpressure: a full queue blocks the producer for up to `put_timeout`,
+  then the row is written synchronously instead of being dropped.
+- Read-your-writes: readers of learning_logs call flush() first, which returns
+  as soon as everything enqueued before the call is committed (instant when idle).
+  Hot paths that must not wait on other sessions' rows use pending(match)
+  instead: the not-yet-committed rows they care about, merged into their read.
+- Shutdown: an atexit hook drains the queue before the process exits.
+"""
+import atexit
+import queue
+import threading
+import time
+
+_FLUSH = object()
+_STOP = object()
+
+
+class WriteBehindQueue:
+    def __init__(self, write_batch, name="learning_logs", batch_size=200, flush_interval=1.0,
+                 maxsize=5000, put_timeout=2.0, retries=3):
+        """write_batch(rows) must insert + commit all rows or raise."""
+        self.write_batch = write_batch
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retries = retries
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._cond = threading.Condition()
+        self._enqueued = 0   # Rows accepted by submit()
+        self._done = 0       # Rows the writer has finished with (committed or given up)
+        self._stats = {"rows_written": 0, "batches": 0, "sync_writes": 0, "failed_rows": 0, "max_depth": 0}
+        self._stopped = False
+        self._batch = []     # Rows the writer has taken off the queue and not committed yet
+        self._thread = threading.Thread(target=self._run, name=f"write-behind-{name}", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # --- producer side ---
+    def submit(self, row):
+        if self._stopped:
+            self._write_sync([row])
+            return
+        with self._cond:
+            self._enqueued += 1
+        try:
+            self._queue.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            # [BACKPRESSURE] Writer can't keep up (DB slow/down): pay the write here, never drop
+            with self._cond:
+                self._enqueued -= 1
+            self._write_sync([row])
+            return
+        depth = self._queue.qsize()
+        if depth > self._stats["max_depth"]:
+            self._stats["max_depth"] = depth
+
+    def flush(self, timeout=10.0):
+        """Blocks until every row submitted before this call is committed."""
+        with self._cond:
+            target = self._enqueued
+            if self._done >= target:
+                return True
+        try:
+            self._queue.put_nowait(_FLUSH)
+        except queue.Full:
+            pass  # Writer is busy draining anyway
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._done < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def pending(self, match):
+        """
+        Submitted rows not committed yet that satisfy match(row), without waiting.
+        Take it before reading the table: a row is either still listed here or already
+        committed (a row moving from queue to batch may be listed twice).
+        """
+        with self._queue.mutex:
+            queued = list(self._queue.queue)
+        in_batch = list(self._batch)
+        return [r for r in queued + in_batch if r is not _FLUSH and r is not _STOP and match(r)]
+
+    def close(self, timeout=30.0):
+        """Drains the queue durably and stops the writer."""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {"name": self.name, "pending": self._enqueued - self._done,
+                    "queue_depth": self._queue.qsize(), **self._stats}
+
+    # --- writer side ---
+    def _write_sync(self, rows):
+        with self._cond:
+            self._stats["sync_writes"] += 1
+        self._write_with_retry(rows)
+
+    def _write_with_retry(self, rows):
+        delay = 0.5
+        for attempt in range(1, self.retries + 1):
+            try:
+                self.write_batch(rows)
+                with self._cond:
+                    self._stats["rows_written"] += len(rows)
+                    self._stats["batches"] += 1
+                return True
+            except Exception as e:
+                print(f"Log Batch Error ({len(rows)} rows, attempt {attempt}/{self.retries}): {e}")
+                if attempt < self.retries:
+                    time.sleep(delay)
+                    delay *= 2
+        with self._cond:
+            self._stats["failed_rows"] += len(rows)
+        return False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                stopping = True
+                batch = []
+            elif item is _FLUSH:
+                batch = []
+            else:
+                batch = [item]
+            self._batch = batch  # Visible to pending() while it fills up and is written
+
+            # Collect more rows until the batch is full, the interval ends, or someone asks to flush
+            deadline = time.monotonic() + self.flush_interval
+            while batch and len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _FLUSH:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            if stopping:
+                # Drain whatever is left without waiting
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not _FLUSH and item is not _STOP:
+                        batch.append(item)
+
+            for i in range(0, len(batch), self.batch_size):
+                chunk = batch[i:i + self.batch_size]
+                self._write_with_retry(chunk)
+                with self._cond:
+                    self._done += len(chunk)
+                    self._cond.notify_all()
+            self._batch = []
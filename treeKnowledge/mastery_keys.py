@@ -0,0 +1,60 @@
+"""
+Resolve graph node ids to stored progress keys.
+
+Progress rows may be keyed by a longer id than the graph node ("1.1" vs
+"1.1_KhaiNiem_ML" / "1.1 Khái niệm"). MasteryKeyIndex keeps the keys sorted
+once per user map, so a prefix lookup is a bisect (O(log M)) instead of a
+startswith scan over every key for every node:
+
+    keys = MasteryKeyIndex(user_mastery)
+    keys.resolve("1.1")               # exact key, else the first "1.1_" / "1.1 " key
+    keys.report(subject_graph.nodes)  # what did not resolve (for content admins)
+"""
+from bisect import bisect_left
+
+_SEPARATORS = ("_", " ")
+
+
+class MasteryKeyIndex:
+    def __init__(self, keys):
+        self.keys = list(dict.fromkeys(str(k) for k in keys))  # Input order: first match wins, as before
+        self._exact = set(self.keys)
+        ordered = sorted((k, pos) for pos, k in enumerate(self.keys))
+        self._sorted = [k for k, _ in ordered]
+        self._pos = [pos for _, pos in ordered]
+        self.matched = {}  # node_id -> key, filled by resolve()
+
+    def _first_with_prefix(self, prefix):
+        """(input position, key) of the earliest key starting with prefix, or None."""
+        best = None
+        i = bisect_left(self._sorted, prefix)
+        while i < len(self._sorted) and self._sorted[i].startswith(prefix):
+            if best is None or self._pos[i] < best[0]:
+                best = (self._pos[i], self._sorted[i])
+            i += 1
+        return best
+
+    def prefix_match(self, node_id):
+        """First stored key "<node_id>_..." or "<node_id> ..." (in input order), or None."""
+        node_id = str(node_id)
+        hits = [h for h in (self._first_with_prefix(node_id + sep) for sep in _SEPARATORS) if h]
+        return min(hits)[1] if hits else None
+
+    def resolve(self, node_id, fuzzy=True):
+        """Exact key, else (if fuzzy) the prefix match; None if neither."""
+        node_id = str(node_id)
+        key = node_id if node_id in self._exact else (self.prefix_match(node_id) if fuzzy else None)
+        if key is not None:
+            self.matched[node_id] = key
+        return key
+
+    def report(self, nodes):
+        """
+        {"unresolved_keys": stored keys no resolved node points to (orphan progress),
+         "unresolved_nodes": nodes of `nodes` that resolve() has not matched}.
+        """
+        used = set(self.matched.values())
+        return {
+            "unresolved_keys": [k for k in self.keys if k not in used],
+            "unresolved_nodes": [n for n in nodes if n not in self.matched],
+        }
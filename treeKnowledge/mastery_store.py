@@ -0,0 +1,110 @@
+"""
+Per-session mastery store (user_progress for one user + subject).
+
+Loaded from the DB once per Streamlit session instead of on every rerun, then
+kept in sync in place: grade_and_update / decay write to the DB first and then
+apply the same change here (write-through), so readers never need to re-query.
+
+    store = get_mastery_store(username, subject_id)
+    store.score("1.2")      # O(1)
+    store.scores            # live {node_id: score} dict for the engine APIs
+"""
+import os
+import time
+from datetime import datetime
+
+import streamlit as st
+
+from db_utils import get_user_progress, save_progress
+
+# Other tabs / admins can also write user_progress: bound how stale a session can get
+MASTERY_STORE_MAX_AGE = float(os.environ.get("MASTERY_STORE_MAX_AGE", "600"))
+
+_SESSION_KEY = "_mastery_stores"
+
+
+class MasteryStore:
+    def __init__(self, username, subject_id, rows=None):
+        self.username = username
+        self.subject_id = subject_id
+        self.scores = {}     # node_id -> score
+        self.statuses = {}   # node_id -> status
+        self.timestamps = {} # node_id -> last update
+        self.derived = {}    # key -> view with .update(node_id) (e.g. SkillFrontier), kept in sync by apply()
+        self.loaded_at = 0.0
+        self.reload(rows)
+
+    def reload(self, rows=None):
+        """rows: get_user_progress() rows the caller already fetched (e.g. prefetch_page_data)."""
+        if rows is None:
+            rows = get_user_progress(self.username, self.subject_id)
+        # Clear in place: pages may hold a reference to self.scores
+        self.scores.clear(); self.statuses.clear(); self.timestamps.clear()
+        self.derived.clear()  # Built from the old scores: rebuilt lazily
+        for node_id, status, score, ts in rows:
+            self.scores[node_id] = score
+            self.statuses[node_id] = status
+            self.timestamps[node_id] = ts
+        self.loaded_at = time.monotonic()
+
+    def is_stale(self, max_age=MASTERY_STORE_MAX_AGE):
+        return time.monotonic() - self.loaded_at > max_age
+
+    # --- reads (O(1)) ---
+    def score(self, node_id, default=0.0):
+        return self.scores.get(node_id, default)
+
+    def status(self, node_id, default=None):
+        return self.statuses.get(node_id, default)
+
+    def rows(self):
+        """Same shape as get_user_progress(): [(node_id, status, score, timestamp)]."""
+        return [(n, self.statuses.get(n), s, self.timestamps.get(n)) for n, s in self.scores.items()]
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __contains__(self, node_id):
+        return node_id in self.scores
+
+    # --- writes ---
+    def apply(self, node_id, status, score, timestamp=None):
+        """Record a change that is already committed to the DB."""
+        self.scores[node_id] = score
+        self.statuses[node_id] = status
+        self.timestamps[node_id] = timestamp or datetime.now()
+        for view in self.derived.values():
+            view.update(node_id)
+
+    def save(self, node_id, status, score):
+        """Write-through: persist to user_progress, then update in place."""
+        save_progress(self.username, node_id, self.subject_id, status, score)
+        self.apply(node_id, status, score)
+
+
+def mastery_store_needs_load(username, subject_id):
+    """True if get_mastery_store() would read user_progress (no store yet, or stale): prefetch "progress" then."""
+    store = st.session_state.get(_SESSION_KEY, {}).get((username, subject_id))
+    return store is None or store.is_stale()
+
+
+def get_mastery_store(username, subject_id, rows=None):
+    """
+    Session-scoped store for (username, subject_id); loads on first use.
+    rows: prefetched get_user_progress() rows, used instead of a DB read if the store (re)loads.
+    """
+    stores = st.session_state.setdefault(_SESSION_KEY, {})
+    store = stores.get((username, subject_id))
+    if store is None:
+        store = stores[(username, subject_id)] = MasteryStore(username, subject_id, rows)
+    elif store.is_stale():
+        store.reload(rows)
+    return store
+
+
+def invalidate_mastery_store(username=None, subject_id=None):
+    """Drop cached stores (all, or those matching username / subject_id)."""
+    stores = st.session_state.get(_SESSION_KEY, {})
+    for key in list(stores):
+        if (username is None or key[0] == username) and (subject_id is None or key[1] == subject_id):
+            del stores[key]
@@ -0,0 +1,166 @@
+"""
+Vectorized node-status aggregation over a compiled SubjectGraph.
+
+A user's mastery is a float array aligned to graph.ids (NaN = no own score).
+aggregate_status() fills every node in one bottom-up pass over the depth
+levels: a node without its own score takes the average of its children and
+is mastered only if all of them are. A (users x nodes) matrix goes through
+the same pass, so a whole class costs one call:
+
+    own = mastery_vector(graph, {"1.1": 0.9, "1.2": 0.4})
+    status = aggregate_status(graph, own, threshold=0.7)
+    status.get("Chg1")            # (score, is_mastered)
+    status.color("Chg1")          # "#B9F6CA"
+
+    m = mastery_matrix(graph, class_df)          # index=username, columns=node_id
+    aggregate_status(graph, m, 0.7).frame()     # same pass, every student
+"""
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from mastery_keys import MasteryKeyIndex
+
+# Bucket -> colour (0: chưa học, 1: đang học, 2: đạt, 3: tốt ≥85%, 4: hoàn thành 100%)
+BUCKET_COLORS = ("#CFD8DC", "#FFD600", "#B9F6CA", "#69F0AE", "#00C853")
+
+_plans = weakref.WeakKeyDictionary()
+
+
+def _level_plan(graph):
+    """
+    Per-graph reduceat plan, deepest level first: [(targets, child_idx, starts, counts)].
+    Children of a node are one level deeper or more, so each level reads finished values.
+    """
+    plan = _plans.get(graph)
+    if plan is not None:
+        return plan
+    ptr = np.asarray(graph._child_ptr, dtype=np.int64)
+    idx = np.asarray(graph._child_idx, dtype=np.int64)
+    depth = np.asarray(graph._depth, dtype=np.int64)
+    degree = np.diff(ptr)
+
+    plan = []
+    for d in range(int(depth.max()) if len(depth) else -1, -1, -1):
+        targets = np.flatnonzero((depth == d) & (degree > 0))
+        if not len(targets):
+            continue
+        counts = degree[targets]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        # Flat child positions of every target, in edge order
+        offsets = np.repeat(ptr[targets] - starts, counts)
+        child_idx = idx[offsets + np.arange(counts.sum())]
+        plan.append((targets, child_idx, starts, counts.astype(float)))
+    _plans[graph] = plan
+    return plan
+
+
+def mastery_vector(graph, scores):
+    """{node_id: score} -> float array aligned to graph.ids (NaN where the node has no score)."""
+    own = np.full(len(graph), np.nan)
+    for node_id, score in scores.items():
+        i = graph.index.get(str(node_id))
+        if i is not None and score is not None:
+            own[i] = score
+    return own
+
+
+def mastery_matrix(graph, scores):
+    """
+    (users x nodes) array aligned to graph.ids.
+    scores: DataFrame (index=user, columns=node_id, e.g. get_class_matrix) or {user: {node_id: score}}.
+    """
+    if isinstance(scores, pd.DataFrame):
+        scores = scores.rename(columns=str)
+        # Progress keys may be longer than graph ids ("1.1" vs "1.1_KhaiNiem"): same Exact / Smart Match as the graph pages
+        keys = MasteryKeyIndex(scores.columns)
+        cols = [keys.resolve(n, fuzzy="." in n) for n in graph.ids]
+        out = np.full((len(scores), len(graph)), np.nan)
+        hit = [i for i, k in enumerate(cols) if k is not None]
+        if hit:
+            out[:, hit] = scores[[cols[i] for i in hit]].to_numpy(dtype=float)
+        return out
+    return np.vstack([mastery_vector(graph, m) for m in scores.values()]) if scores else np.empty((0, len(graph)))
+
+
+class NodeStatus:
+    """Aggregated score / mastered / colour bucket of every node (one row per user for a matrix)."""
+
+    def __init__(self, graph, score, mastered, users=None):
+        self.graph = graph
+        self.score = score
+        self.mastered = mastered
+        self.users = users
+        bucket = np.zeros(score.shape, dtype=np.int8)
+        bucket[score > 0] = 1
+        bucket[mastered] = 2
+        bucket[mastered & (score >= 0.85)] = 3
+        bucket[mastered & (score >= 1.0)] = 4
+        self.bucket = bucket
+
+    def row(self, i):
+        """NodeStatus of the i-th user of a matrix."""
+        return NodeStatus(self.graph, self.score[i], self.mastered[i])
+
+    def get(self, node_id, default=(0.0, False)):
+        i = self.graph.index.get(str(node_id))
+        if i is None:
+            return default
+        return float(self.score[..., i]), bool(self.mastered[..., i])
+
+    def color(self, node_id):
+        i = self.graph.index.get(str(node_id))
+        return BUCKET_COLORS[0] if i is None else BUCKET_COLORS[self.bucket[..., i]]
+
+    def as_map(self):
+        """{node_id: (score, is_mastered)} for a single user (drop-in for node_info_map)."""
+        return dict(zip(self.graph.ids, zip(self.score.tolist(), self.mastered.tolist())))
+
+    def frame(self, nodes=None):
+        """Scores as a DataFrame (index=users, columns=nodes)."""
+        cols = list(self.graph.ids) if nodes is None else [n for n in nodes if n in self.graph.index]
+        pos = [self.graph.index[n] for n in cols]
+        return pd.DataFrame(np.atleast_2d(self.score)[:, pos], index=self.users, columns=cols)
+
+
+def aggregate_status(graph, own, threshold):
+    """
+    own: mastery_vector (N,) or mastery_matrix (U, N).
+    Own score wins; otherwise avg of children / all children mastered; no score, no children -> (0, False).
+    """
+    own = np.asarray(own, dtype=float)
+    has_own = ~np.isnan(own)
+    score = np.where(has_own, own, 0.0)
+    mastered = has_own & (np.nan_to_num(own) >= threshold)
+
+    for targets, child_idx, starts, counts in _level_plan(graph):
+        agg = np.add.reduceat(score[..., child_idx], starts, axis=-1) / counts
+        agg_m = np.logical_and.reduceat(mastered[..., child_idx], starts, axis=-1)
+        keep = has_own[..., targets]
+        score[..., targets] = np.where(keep, score[..., targets], agg)
+        mastered[..., targets] = np.where(keep, mastered[..., targets], agg_m)
+
+    return NodeStatus(graph, score, mastered)
+
+
+def class_status(graph, class_matrix, threshold):
+    """Whole class in one pass: class_matrix is get_class_matrix() (index=username, columns=node_id)."""
+    status = aggregate_status(graph, mastery_matrix(graph, class_matrix), threshold)
+    status.users = list(class_matrix.index)
+    return status
+
+
+def chapter_means(node_to_chapter, scores):
+    """{chapter: avg of the scored nodes it owns, or -1 if none is scored} (one bincount, no per-chapter scan)."""
+    if not node_to_chapter:
+        return {}
+    chaps = list(dict.fromkeys(node_to_chapter.values()))
+    code = {c: i for i, c in enumerate(chaps)}
+    owner = np.fromiter((code[c] for c in node_to_chapter.values()), dtype=np.int64, count=len(node_to_chapter))
+    vals = np.array([scores.get(n, -1) for n in node_to_chapter], dtype=float)
+    tested = vals != -1
+    totals = np.bincount(owner[tested], weights=vals[tested], minlength=len(chaps))
+    counts = np.bincount(owner[tested], minlength=len(chaps))
+    means = np.divide(totals, counts, out=np.full(len(chaps), -1.0), where=counts > 0)
+    return dict(zip(chaps, means.tolist()))
@@ -1,14 +1,13 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import ast
 import os
 import sys
 import random
 import time
+import io
 from datetime import datetime, timedelta
 import re
-from collections import defaultdict
 from streamlit_autorefresh import st_autorefresh
 from streamlit_agraph import agraph, Node, Edge, Config # [NEW] Interactive Graph
 
@@ -20,9 +19,18 @@ sys.path.append(parent_dir)
 from db_utils import (
     get_user_progress, save_progress, log_activity, 
     get_all_chapters, get_graph_structure, get_all_questions,
-    get_students_in_class, get_test_packet, get_all_subjects,
-    get_user_role, get_global_test_logs, get_user_logs, get_all_users_list # [NEW]
+    get_students_in_class, get_test_packet, get_all_subjects, get_content_version,
+    query_global_logs, iter_global_logs, summarize_global_logs, get_log_distribution,
+    get_user_logs, get_all_users_list, get_user_settings # [NEW]
 )
+from data_prefetch import prefetch_page_data
+from mastery_store import get_mastery_store, mastery_store_needs_load
+from review_scheduler import review_due_at
+from subject_graph import get_subject_graph
+from question_index import get_question_index, question_options
+from mastery_vectors import mastery_vector, aggregate_status, chapter_means
+from graph_view import get_graph_view, spine_widths
+from mastery_keys import MasteryKeyIndex
 
 
 if "authentication_status" not in st.session_state or st.session_state["authentication_status"] is None:
@@ -151,7 +159,7 @@ st.markdown("""
 # ------------------------------------------------------------
 st.sidebar.title("📁 Chọn Môn Học")
 
-all_subs = get_all_subjects() 
+all_subs = get_all_subjects()
 if not all_subs:
     st.error("Chưa có môn học nào.")
     st.stop()
@@ -191,16 +199,8 @@ def get_smart_test_nodes(username, subject_id):
     progress = get_user_progress(username, subject_id)
     user_map = {r[0]: {'status': r[1], 'score': r[2]} for r in progress}
     
-    # Lấy cấu trúc cây
-    parents_map = {} # node -> [parents]
-    all_nodes = set()
-    
-    # Build graph map
-    for _, row in k_graph_df.iterrows():
-        src, tgt = str(row['source']), str(row['target'])
-        if tgt not in parents_map: parents_map[tgt] = []
-        parents_map[tgt].append(src)
-        all_nodes.add(src); all_nodes.add(tgt)
+    # Lấy cấu trúc cây (SubjectGraph: cha tra O(degree))
+    all_nodes = subject_graph.nodes
         
     target_nodes = set()
     
@@ -216,7 +216,7 @@ def get_smart_test_nodes(username, subject_id):
         if node in user_map and user_map[node]['score'] >= 0.8:
             continue
             
-        parents = parents_map.get(node, [])
+        parents = subject_graph.parents(node)
         if not parents: # Node gốc
             # Nếu chưa học node gốc -> Thêm vào
             if node not in user_map: target_nodes.add(node)
@@ -236,9 +236,10 @@ def get_smart_test_nodes(username, subject_id):
     return list(target_nodes)
 
 @st.cache_data
-def load_meta_data():
+def load_meta_data(subject_id, content_version):
+    # content_version chỉ để làm khóa cache: admin sửa môn nào thì chỉ môn đó tải lại
     # [OPTIMIZATION] Try loading from Test Packet first
-    packet = get_test_packet(current_subject)
+    packet = get_test_packet(subject_id)
     
     if packet and packet.get('questions'):
         # Reconstruct DataFrames from JSON Packet
@@ -276,45 +277,33 @@ def load_meta_data():
         
     else:
         # Fallback to DB
-        k_df = get_graph_structure(current_subject)
-        q_df = get_all_questions(current_subject)
+        k_df = get_graph_structure(subject_id)
+        q_df = get_all_questions(subject_id)
         chapters = get_all_chapters() 
 
-    # --- INDEXING (Cached) ---
-    # 1. Pre-parse skill_id_list
-    def safe_parse(x):
-        try:
-            if isinstance(x, list): return [str(s).strip() for s in x]
-            x = str(x).strip()
-            if x.startswith('['):
-                return [str(s).strip() for s in ast.literal_eval(x)]
-            return [x]
-        except:
-            return []
-            
-    if 'parsed_skills' not in q_df.columns:
-        q_df['parsed_skills'] = q_df['skill_id_list'].apply(safe_parse)
-        
-    # 2. Build Index: Skill -> List of Rows (dict)
-    s_index = {}
-    q_records = q_df.to_dict('records')
-    
-    for row in q_records:
-        for s in row['parsed_skills']:
-            if s not in s_index: s_index[s] = []
-            s_index[s].append(row)
-            
-    return k_df, q_df, chapters, s_index
+    return k_df, q_df, chapters
 
-k_graph_df, q_matrix_df, available_chapters, q_skill_index = load_meta_data()
+content_version = get_content_version(current_subject)
+# [OPTIMIZATION] Tải song song các đọc khởi tạo độc lập: Test Packet -> DataFrame, điểm (nếu mastery store cần nạp), vai trò
+page_data = prefetch_page_data({"role"} | ({"progress"} if mastery_store_needs_load(username, current_subject) else set()),
+                               username, current_subject,
+                               extra={"meta": lambda: load_meta_data(current_subject, content_version)})
+k_graph_df, q_matrix_df, available_chapters = page_data.extra["meta"]
+get_mastery_store(username, current_subject, rows=page_data.progress)
+# [OPTIMIZATION] Đồ thị biên dịch 1 lần / content_version, dùng chung mọi session: cha/con O(degree)
+subject_graph = get_subject_graph(current_subject, k_graph_df)
+# Chỉ mục skill -> câu hỏi (khớp chính xác skill id, chia sẵn độ khó), dùng chung mọi session
+question_index = get_question_index(current_subject, q_matrix_df)
 
 # --- HELPER FUNCTIONS ---
 def load_local_data(username, subject_id):
     """Pre-load data into session state for offline/fast mode"""
     with st.spinner("📥 Đang tải dữ liệu bài thi (Offline Mode)..."):
-        progress = get_user_progress(username, subject_id)
+        # Bản sao điểm từ mastery store: kết quả trong bài thi chỉ ghi vào bản sao này
+        store = get_mastery_store(username, subject_id)
         st.session_state.local_data = {
-            "user_progress": progress, # List of tuples
+            "subject_id": subject_id,
+            "user_mastery": dict(store.scores), # {node_id: score}
             "loaded_at": datetime.now()
         }
 
@@ -322,27 +311,17 @@ def get_user_mastery_map(target_user=None):
     # [OPTIMIZATION] Read from local_data if available AND matching user
     u = target_user if target_user else username
     
-    if "local_data" in st.session_state and "user_progress" in st.session_state.local_data and u == username:
-        raw = st.session_state.local_data["user_progress"]
-    else:
-        raw = get_user_progress(u, current_subject)
+    local = st.session_state.get("local_data", {})
+    if u == username and local.get("subject_id") == current_subject and "user_mastery" in local:
+        return local["user_mastery"]
+    if u == username:
+        return get_mastery_store(username, current_subject).scores
+    raw = get_user_progress(u, current_subject)
     return {r[0]: r[2] for r in raw} if raw else {}
 
-@st.cache_data(ttl=3600) # Cache cấu trúc chương vì ít thay đổi
-def get_nodes_in_chapters(chapters_list):
-    """Lọc ra các node thuộc các chương đã chọn"""
-    all_nodes = set(k_graph_df['source']).union(set(k_graph_df['target']))
-    valid_nodes = set()
-    for n in all_nodes:
-        n_str = str(n)
-        import re
-        match = re.match(r"^(\d+)\.", n_str)
-        if match:
-            if int(match.group(1)) in chapters_list: valid_nodes.add(n_str)
-        elif n_str.startswith("Chg"): # Support Chg1 format
-             match = re.search(r"\d+", n_str)
-             if match and int(match.group(0)) in chapters_list: valid_nodes.add(n_str)
-    return valid_nodes
+def get_nodes_in_chapters(chapters_list, subject_id=None, content_version=None):
+    """Lọc ra các node thuộc các chương đã chọn ("1.x" / "Chg1"); chương -> node tính sẵn trong subject_graph"""
+    return subject_graph.nodes_in_chapters(chapters_list)
 
 # ============================================================
 # 1. LOGIC KIỂM TRA ĐẦU VÀO (DIAGNOSTIC)
@@ -356,24 +335,17 @@ def generate_diagnostic_test():
     
     for chap in chapters:
         # Tìm các node thuộc chương này
-        nodes = get_nodes_in_chapters([chap])
+        nodes = get_nodes_in_chapters([chap], current_subject, content_version)
         if not nodes: continue
         
-        # [OPTIMIZED] Use q_skill_index instead of Loop
-        candidates = []
-        for node in nodes:
-            found_qs = q_skill_index.get(str(node), [])
-            candidates.extend(found_qs)
-            
-        # Deduplicate by ID
-        unique_cands = {c['question_id']: c for c in candidates}.values()
-        candidates = list(unique_cands)
+        # [OPTIMIZED] question_index: skill -> vị trí câu hỏi (set: tự loại trùng)
+        candidates = sorted({pos for node in nodes for pos in question_index.positions(node)})
         
         # Chọn 1 câu ngẫu nhiên (ưu tiên độ khó Medium)
         if candidates:
             # Thử tìm medium
-            mediums = [c for c in candidates if str(c.get('difficulty')).lower() == 'medium']
-            chosen = random.choice(mediums) if mediums else random.choice(candidates)
+            mediums = [pos for pos in candidates if question_index.levels[pos] == 'medium']
+            chosen = question_index.record(random.choice(mediums) if mediums else random.choice(candidates))
             
             questions.append({
                 "q_data": chosen,
@@ -410,13 +382,13 @@ def check_stopping_condition(history, limit_min=10, limit_max=50, mode="smart_ca
 # 2. LOGIC KIỂM TRA THÍCH ỨNG (SMART CAT - GRAPH TRAVERSAL)
 # ============================================================
 
-def get_parents(node, k_df):
-    return k_df[k_df['target'] == str(node)]['source'].tolist()
+def get_parents(node, graph):
+    return graph.parents(node)
 
-def get_children(node, k_df):
-    return k_df[k_df['source'] == str(node)]['target'].tolist()
+def get_children(node, graph):
+    return graph.children(node)
 
-def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None, strict_mastery=False):
+def get_strategic_question(history, user_map, k_graph, q_index, valid_nodes_pool=None, strict_mastery=False):
     """
     Chiến lược chọn câu hỏi thông minh dựa trên đồ thị:
     1. EXPLORATION (Đầu trận): Khảo sát ngẫu nhiên các nhánh khác nhau.
@@ -428,11 +400,17 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None,
     """
     # 0. Setup
     if user_map is None: user_map = get_user_mastery_map()
-    hist_q_ids = [h['q_id'] for h in history]
-    
-    # Filter available questions (exclude history)
-    available_qs = q_df[~q_df['question_id'].isin(hist_q_ids)].copy()
-    if available_qs.empty: return None, None, "Hết ngân hàng câu hỏi"
+    hist_q_ids = {h['q_id'] for h in history}
+
+    def is_unused(pos):
+        return q_index.question_ids[pos] not in hist_q_ids
+
+    def unused(positions):
+        # Exclude history
+        return [p for p in positions if is_unused(p)]
+
+    # Còn câu chưa làm? (any() dừng ngay ở câu đầu tiên tìm thấy)
+    if not any(qid not in hist_q_ids for qid in q_index.question_ids): return None, None, "Hết ngân hàng câu hỏi"
 
     # --- STRATEGY SELECTION ---
     target_node = None
@@ -466,7 +444,7 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None,
             if not last_correct:
                 # ---> REMEDIATION: Backtrack to Parent
                 strategy_name = "Remediation"
-                parents = get_parents(last_node, k_df)
+                parents = get_parents(last_node, k_graph)
                 if parents:
                     # Pick a parent that is strictly NOT Mastered yet (or weak)
                     weak_parents = [p for p in parents if user_map.get(p, 0.5) < 0.8]
@@ -502,7 +480,7 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None,
                 
                 if can_progress:
                     # ---> PROGRESSION: Move to Children or Harder
-                    children = get_children(last_node, k_df)
+                    children = get_children(last_node, k_graph)
                     
                     # Prioritize children that are NOT Mastered
                     unmastered_children = [c for c in children if user_map.get(c, 0.0) < 0.7]
@@ -525,17 +503,12 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None,
     # 1. Try finding Q for specific target_node
     if target_node:
         target_node_s = str(target_node)
-        # Use Index
-        raw_candidates = q_skill_index.get(target_node_s, [])
-        # Filter already taken
-        candidates = [r for r in raw_candidates if r['question_id'] not in hist_q_ids]
-        
-        # Filter by difficulty
-        diff_matches = [r for r in candidates if str(r.get('difficulty', 'medium')).lower() == difficulty_target]
-        final_pool = diff_matches if diff_matches else candidates
+        # Use Index (exact skill id), filter already taken
+        # Difficulty buckets tính sẵn; fallback (hard -> medium -> any) giống engine luyện tập
+        final_pool, _ = q_index.clad_pool(target_node_s, difficulty_target, keep=is_unused)
         
         if final_pool:
-            chosen = random.choice(final_pool)
+            chosen = q_index.record(random.choice(final_pool))
             return chosen, target_node_s, f"{strategy_name} ({difficulty_target})"
         
         # [Adjust] If Drill mode but run out of questions for this node -> Force Progress
@@ -550,18 +523,20 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None,
         random.shuffle(shuffled_nodes)
         
         for node in shuffled_nodes[:5]: # Try 5 nodes max
-            qs = q_skill_index.get(str(node), [])
-            valid_qs = [q for q in qs if q['question_id'] not in hist_q_ids]
+            valid_qs = unused(q_index.positions(node))
             
             if valid_qs:
-                chosen = random.choice(valid_qs)
+                chosen = q_index.record(random.choice(valid_qs))
                 return chosen, str(node), "Fallback"
 
     # 3. Last Resort: Random from available
-    if not available_qs.empty: 
-        rand_row = available_qs.sample(1).iloc[0].to_dict()
-        skills = rand_row.get('parsed_skills', [])
+    available = unused(range(len(q_index)))
+    if available:
+        rand_row = q_index.record(random.choice(available))
+        # Use parsed skills
+        skills = rand_row['parsed_skills']
         rand_skill = skills[0] if skills else "General"
+        
         return rand_row, rand_skill, "Random"
 
     return None, None, "Hết câu hỏi"
@@ -578,14 +553,14 @@ def prepare_speculative_next(valid_nodes, full_history, current_skill, current_q
     
     # Append simulated result
     sim_hist_corr = full_history + [{"q_id": current_q_id, "skill": current_skill, "is_correct": True}]
-    q_corr, s_corr, _ = get_strategic_question(sim_hist_corr, map_correct, k_graph_df, q_matrix_df, valid_nodes)
+    q_corr, s_corr, _ = get_strategic_question(sim_hist_corr, map_correct, subject_graph, question_index, valid_nodes)
     
     # 2. Scenario Incorrect
     map_incorr = user_map.copy()
     map_incorr[current_skill] = 0.0
     
     sim_hist_inc = full_history + [{"q_id": current_q_id, "skill": current_skill, "is_correct": False}]
-    q_inc, s_inc, _ = get_strategic_question(sim_hist_inc, map_incorr, k_graph_df, q_matrix_df, valid_nodes)
+    q_inc, s_inc, _ = get_strategic_question(sim_hist_inc, map_incorr, subject_graph, question_index, valid_nodes)
     
     return {
         True: (q_corr, s_corr) if q_corr is not None else None,
@@ -615,8 +590,8 @@ if 'test_session' not in st.session_state:
 ts = st.session_state.test_session
 
 # Kiểm tra User mới hay cũ
-user_progress_data = get_user_progress(username, current_subject)
-is_new_user = len(user_progress_data) == 0
+# [OPTIMIZATION] Đọc từ mastery store của session thay vì query DB mỗi lần rerun
+is_new_user = len(get_mastery_store(username, current_subject)) == 0
 
 # [FIX] AUTO-RESET SESSION IF USER CHANGED OR INVALID STATE
 # 1. Ownership Check
@@ -653,7 +628,7 @@ if not ts["active"] and not st.session_state.get("show_result", False):
 
     # --- ADMIN DASHBOARD ---
     # Chỉ Admin mới thấy section này
-    if get_user_role(username) == "admin":
+    if page_data.role == "admin":
         with st.expander("👨‍💼 Quản trị viên (Admin Dashboard)", expanded=False):
             st.warning("⚠️ Khu vực dành cho Quản trị viên - Xem kết quả toàn hệ thống.")
             
@@ -686,115 +661,98 @@ if not ts["active"] and not st.session_state.get("show_result", False):
                                  target_id = sid
                                  break
                      
-                     with st.spinner("Đang truy xuất dữ liệu..."):
-                         # [REF] Store in Session State
-                         # [FIX] Increase limit to capture more history (Requested by User)
-                         st.session_state['adm_logs_df'] = get_global_test_logs(target_id, limit=5000)
-                         st.session_state['adm_view_active'] = True
+                     # [OPTIMIZATION] Session chỉ giữ bộ lọc + con trỏ trang; lọc / đổi múi giờ / phân trang chạy trong DB
+                     st.session_state['adm_log_filters'] = {"subject_id": target_id, "action_prefix": type_map[adm_sel_type]}
+                     st.session_state['adm_log_cursors'] = [None]  # Con trỏ keyset (timestamp, id) của các trang đã xem
+                     st.session_state['adm_view_active'] = True
                      
             # [REF] DISPLAY SECTION (Full Width)
-            if st.session_state.get('adm_view_active', False) and 'adm_logs_df' in st.session_state:
-                df_logs = st.session_state['adm_logs_df']
+            if st.session_state.get('adm_view_active', False) and 'adm_log_filters' in st.session_state:
+                log_filters = st.session_state['adm_log_filters']
                 st.divider()
                 
-                # 1. Filter by Type in Python
-                if not df_logs.empty:
-                    target_type = type_map[adm_sel_type]
-                    if target_type:
-                        # [FIX] Use startswith/contains to catch '_start' events
-                        df_logs = df_logs[df_logs['action_type'].str.contains(target_type, na=False)]
+                # Friendly Name Column
+                readable_map = {v: k for k, v in type_map.items() if v}
+                # [FIX] Add mappings for Start events
+                readable_map.update({
+                    "test_diagnostic_cat_start": "Bắt đầu KT Đầu vào",
+                    "test_smart_cat_start": "Bắt đầu Smart CAT",
+                    "test_deep_cat_start": "Bắt đầu Deep CAT",
+                    "test_standard_start": "Bắt đầu Tự chọn"
+                })
+
+                def with_type_label(df):
+                    if 'action_type' in df.columns:
+                        df['Loại bài thi'] = df['action_type'].map(readable_map).fillna(df['action_type'])
+                    return df
+
+                def logs_to_csv(pages):
+                    buf = io.StringIO()
+                    for i, page in enumerate(pages):
+                        page.to_csv(buf, index=False, header=(i == 0))
+                    return buf.getvalue().encode('utf-8')
                 
-                if df_logs.empty:
-                    st.info("Không có dữ liệu khớp với bộ lọc loại bài thi.")
+                # --- STATS AGGREGATION (GROUP BY ngày / học viên / loại bài trong DB) ---
+                st.markdown("### 📊 Thống Kê Kết Quả")
+                with st.spinner("Đang truy xuất dữ liệu..."):
+                    stats = summarize_global_logs(**log_filters)
+                
+                if stats.empty:
+                    st.info("Chưa có dữ liệu trả lời câu hỏi khớp với bộ lọc.")
                     # [DEBUG TOOL] Offer to show raw recent logs
                     if st.button("🔍 Debug: Xem 20 dòng log mới nhất (Bỏ qua bộ lọc)"):
-                        raw_df = get_global_test_logs(None, limit=20)
+                        raw_df, _ = query_global_logs(limit=20)
                         st.write(raw_df)
                 else:
-                    st.success(f"Tìm thấy {len(df_logs)} bản ghi.")
-                    
-                    # 2. Add Friendly Name Column
-                    readable_map = {v: k for k, v in type_map.items() if v}
-                    # [FIX] Add mappings for Start events
-                    readable_map.update({
-                        "test_diagnostic_cat_start": "Bắt đầu KT Đầu vào",
-                        "test_smart_cat_start": "Bắt đầu Smart CAT",
-                        "test_deep_cat_start": "Bắt đầu Deep CAT",
-                        "test_standard_start": "Bắt đầu Tự chọn"
+                    with_type_label(stats)
+                    stats['Điểm TB (%)'] = (stats['avg_score'].astype(float) * 100).round(1)
+                    summary_table = stats[['log_date', 'full_name', 'Loại bài thi', 'questions_done', 'Điểm TB (%)']].rename(columns={
+                        'log_date': 'Ngày',
+                        'full_name': 'Học viên',
+                        'questions_done': 'Số câu đã làm'
                     })
+                    st.dataframe(summary_table, use_container_width=True, hide_index=True)
                     
-                    if 'action_type' in df_logs.columns:
-                        df_logs['Loại bài thi'] = df_logs['action_type'].map(readable_map).fillna(df_logs['action_type'])
+                    # B. Drill-down Selection
+                    st.markdown("### 🔍 Chi Tiết Bài Làm")
+                    student_list = list(dict.fromkeys(zip(stats['username'], stats['full_name'])))
+                    sel_student = st.selectbox("Chọn học viên để xem chi tiết:", [None] + student_list,
+                                               format_func=lambda s: "-- Chọn học viên --" if s is None else s[1])
                     
-                    # --- NEW: STATS AGGREGATION & DRILL-DOWN ---
-                    st.markdown("### 📊 Thống Kê Kết Quả")
-                    
-                    # A. Pre-process Data for Stats
-                    # Create 'Date' column
-                    if 'timestamp' in df_logs.columns:
-                         # Convert to datetime if not already
-                         df_logs['timestamp'] = pd.to_datetime(df_logs['timestamp'], errors='coerce')
-                         df_logs['Ngày'] = df_logs['timestamp'].dt.strftime('%Y-%m-%d')
-                    
-                    # Grouping: Date | Full Name | Test Type
-                    # Filter out 'Start' events for score calculation, but keep them for grouping if needed
-                    # Actually, we want to group by SESSION vs User. Simple approach: Group by User + Day + TestType
-                    
-                    # Get "Answered" rows only for calculating scores
-                    df_answers = df_logs[df_logs['action_type'].str.contains("_cat", na=False) & ~df_logs['action_type'].str.contains("_start", na=False)]
-                    
-                    if not df_answers.empty:
-                        # [FIX] Fill missing full_name to prevent groupby from dropping rows
-                        if 'full_name' in df_answers.columns:
-                            df_answers['full_name'] = df_answers['full_name'].fillna(df_answers['username'])
-                            df_answers['full_name'] = df_answers['full_name'].replace('', 'Unknown')
-
-                        # Aggregation
-                        # [FIX] dropna=False is safer, but filling NaNs above is better for display
-                        stats = df_answers.groupby(['Ngày', 'full_name', 'username', 'Loại bài thi']).agg(
-                            questions_done=('question_id', 'count'),
-                            avg_score=('is_correct', 'mean'), # average of 0/1
-                            last_active=('timestamp', 'max')
-                        ).reset_index()
-                        
-                        # Formatting
-                        stats['Điểm TB (%)'] = (stats['avg_score'] * 100).round(1)
-                        stats = stats.sort_values('last_active', ascending=False)
-                        
-                        # Rename for Display
-                        summary_table = stats[['Ngày', 'full_name', 'Loại bài thi', 'questions_done', 'Điểm TB (%)']].rename(columns={
-                            'full_name': 'Học viên',
-                            'questions_done': 'Số câu đã làm'
-                        })
-                        
-                        st.dataframe(summary_table, use_container_width=True, hide_index=True)
-                        
-                        # B. Drill-down Selection
-                        st.markdown("### 🔍 Chi Tiết Bài Làm")
-                        student_list = stats['full_name'].unique().tolist()
-                        sel_student = st.selectbox("Chọn học viên để xem chi tiết:", ["-- Chọn hc viên --"] + student_list)
-                        
-                        if sel_student and sel_student != "-- Chọn học viên --":
-                             # Filter logs for this student
-                             student_logs = df_logs[df_logs['full_name'] == sel_student].copy()
-                             st.caption(f"Chi tiết lịch sử bài làm của: **{sel_student}**")
-                             
-                             cols_to_show = ['timestamp', 'Loại bài thi', 'question_id', 'is_correct', 'score']
-                             st.dataframe(student_logs[cols_to_show], use_container_width=True)
-                             
-                    else:
-                        st.info("Chưa có dữ liệu trả lời câu hỏi (chỉ có log bắt đầu).")
-                        st.dataframe(df_logs)
-
-                    # [FEATURE] CSV Export (Original Full Log)
-                    csv = df_logs.to_csv(index=False).encode('utf-8')
-                    st.download_button(
-                        "📥 Tải xuống toàn bộ log (CSV)",
-                        data=csv,
-                        file_name=f"cat_results_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
-                        mime="text/csv",
-                        key='download-csv-filtered'
-                    )
+                    if sel_student:
+                         # Trang mới nhất của học viên này (lọc theo username trong DB)
+                         student_logs, _ = query_global_logs(username=sel_student[0], **log_filters)
+                         st.caption(f"Chi tiết lịch sử bài làm của: **{sel_student[1]}**")
+                         
+                         cols_to_show = ['timestamp', 'Loại bài thi', 'question_id', 'is_correct', 'score']
+                         st.dataframe(with_type_label(student_logs)[cols_to_show], use_container_width=True)
+
+                # --- LOG EXPLORER: từng trang LOG_PAGE_SIZE dòng, keyset (timestamp, id) ---
+                st.markdown("### 📜 Nhật Ký Chi Tiết")
+                cursors = st.session_state['adm_log_cursors']
+                page_df, next_cursor = query_global_logs(cursor=cursors[-1], **log_filters)
+                if page_df.empty:
+                    st.info("Không có dữ liệu khớp với bộ lọc loại bài thi.")
+                else:
+                    st.caption(f"Trang {len(cursors)} · {len(page_df)} bản ghi (giờ Việt Nam)")
+                    st.dataframe(with_type_label(page_df), use_container_width=True, hide_index=True)
+                    c_prev, c_next = st.columns(2)
+                    if c_prev.button("⬅️ Trang trước", key="adm_page_prev", disabled=len(cursors) == 1, use_container_width=True):
+                        cursors.pop(); st.rerun()
+                    if c_next.button("Trang sau ➡️", key="adm_page_next", disabled=next_cursor is None, use_container_width=True):
+                        cursors.append(next_cursor); st.rerun()
+
+                    # [FEATURE] CSV Export (toàn bộ log theo bộ lọc, đọc lần lượt từng trang)
+                    if st.button("📦 Chuẩn bị CSV theo bộ lọc", key="adm_prepare_csv"):
+                        with st.spinner("Đang xuất dữ liệu..."):
+                            csv = logs_to_csv(iter_global_logs(**log_filters))
+                        st.download_button(
+                            "📥 Tải xuống log theo bộ lọc (CSV)",
+                            data=csv,
+                            file_name=f"cat_results_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+                            mime="text/csv",
+                            key='download-csv-filtered'
+                        )
                 
                 # [NEW] ADVANCED DIAGNOSTICS & EXPORT (Full Width)
                 with st.expander("🛠️ Công cụ Xuất dữ liệu & Chẩn đoán (Nâng cao)", expanded=False):
@@ -803,12 +761,11 @@ if not ts["active"] and not st.session_state.get("show_result", False):
                     c_d1, c_d2 = st.columns(2)
                     with c_d1:
                         st.markdown("#### 📥 Xuất toàn bộ dữ liệu")
-                        st.write("Tải xuống 5000 dòng log mới nhất (Bỏ qua mọi bộ lọc).")
+                        st.write("Tải xuống toàn bộ log (Bỏ qua mọi bộ lọc).")
                         if st.button("Tải toàn bộ Log (CSV)"):
                                 with st.spinner("Đang tải toàn bộ dữ liệu..."):
-                                    all_logs = get_global_test_logs(None, limit=5000)
-                                    if not all_logs.empty:
-                                        csv_all = all_logs.to_csv(index=False).encode('utf-8')
+                                    csv_all = logs_to_csv(iter_global_logs())
+                                    if csv_all:
                                         st.download_button(
                                             "⬇️ Click để tải xuống",
                                             data=csv_all,
@@ -816,7 +773,7 @@ if not ts["active"] and not st.session_state.get("show_result", False):
                                             mime="text/csv",
                                             key='download-csv-all'
                                         )
-                                        st.success(f"Đã chuẩn bị {len(all_logs)} dòng.")
+                                        st.success("Đã chuẩn bị xong file CSV.")
                                     else:
                                         st.warning("Hệ thống chưa có dữ liệu nào.")
 
@@ -824,13 +781,13 @@ if not ts["active"] and not st.session_state.get("show_result", False):
                         st.markdown("#### 📊 Kiểm tra dữ liệu thô")
                         if st.button("Kiểm tra phân bố dữ liệu"):
                             with st.spinner("Đang phân tích..."):
-                                    all_logs = get_global_test_logs(None, limit=5000)
-                                    if not all_logs.empty:
+                                    by_subject = get_log_distribution('subject_id')
+                                    if not by_subject.empty:
                                         st.write("**Thống kê theo Môn học (Subject ID):**")
-                                        st.dataframe(all_logs['subject_id'].value_counts())
+                                        st.dataframe(by_subject)
                                         
                                         st.write("**Thống kê theo Loại hành động (Action Type):**")
-                                        st.dataframe(all_logs['action_type'].value_counts())
+                                        st.dataframe(get_log_distribution('action_type'))
                                     else:
                                         st.warning("Database trống.")
             
@@ -888,7 +845,7 @@ if not ts["active"] and not st.session_state.get("show_result", False):
                 """)
                 if st.button("Bắt đầu Khảo sát", use_container_width=True):
                      # Load all chapters as target scope
-                    all_nodes = get_nodes_in_chapters(available_chapters)
+                    all_nodes = get_nodes_in_chapters(available_chapters, current_subject, content_version)
                     
                     st.session_state.test_session.update({
                         "active": True,
@@ -1012,7 +969,7 @@ if not ts["active"] and not st.session_state.get("show_result", False):
         view_user = username
         view_name = "Bạn"
         
-        if get_user_role(username) == "admin":
+        if page_data.role == "admin":
             st.divider()
             c_adm1, c_adm2 = st.columns([1, 2])
             with c_adm1:
@@ -1181,170 +1138,59 @@ if not ts["active"] and not st.session_state.get("show_result", False):
             
             # 2. Aggregation Logic (Simplified for CAT view)
             # We need to handle Chapters (containers) which might not be in mastery_map
-            children_map = defaultdict(list)
-            for _, row in k_graph_df.iterrows():
-                children_map[str(row['source'])].append(str(row['target']))
+            # [OPTIMIZATION] Điểm riêng -> vector NumPy; gộp Chương trong 1 lượt bottom-up (mastery_vectors)
 
-            memo_calc = {}
-            
-            def get_node_status(node):
-                if node in memo_calc: return memo_calc[node]
-                
-                # Check DB first
-                score = None
-                status = "Unknown"
+            key_index = MasteryKeyIndex(mastery_map) # Prefix Match = bisect O(log M)
 
+            def find_own_score(node):
                 # 1. Exact Match
-                if node in mastery_map:
-                    score = mastery_map[node]
-                
-                # 2. Prefix Match (Smart Match)
+                # 2. Prefix Match (Smart Match): match "1.1_Title" with "1.1"
                 # Only if exact match failed and node might be a prefix (contains dot)
-                if score is None and "." in node:
-                    for db_key in mastery_map:
-                        # Match "1.1_Title" with "1.1"
-                        if db_key.startswith(node + "_") or db_key.startswith(node + " "):
-                            score = mastery_map[db_key]
-                            break
-                
+                db_key = key_index.resolve(node, fuzzy="." in node)
+                return None if db_key is None else mastery_map[db_key]
+
+            own_scores = {}
+            for n in subject_graph.nodes:
+                score = find_own_score(n)
                 if score is not None:
-                     # Infer status from score if simple map doesn't have it
-                    if score >= 0.7: status = "Mastered"
-                    elif score > 0: status = "In Progress"
-                    
-                    memo_calc[node] = (score, score >= 0.7, status)
-                    return score, score >= 0.7, status
-                
-                # If not in DB, aggregate children (for Chapters)
-                kids = children_map.get(node, [])
-                if not kids:
-                    memo_calc[node] = (0.0, False, None)
-                    return 0.0, False, None
-                    
-                total = 0
-                all_mastered = True
-                has_activity = False
-                
-                for k in kids:
-                    s, m, _ = get_node_status(k)
-                    total += s
-                    if not m: all_mastered = False
-                    if s > 0: has_activity = True
-                
-                avg = total / len(kids)
-                memo_calc[node] = (avg, all_mastered, None)
-                return avg, all_mastered, None
-
-            # 3. Identify Chapters & Spine
-            all_nodes = set(k_graph_df['source']).union(set(k_graph_df['target']))
-            chapters = []
-            for n in all_nodes:
-                n_str = str(n)
-                if "Chg" in n_str or n_str.isdigit() or (len(n_str) < 5 and "." not in n_str):
-                    chapters.append(n_str)
-            
-            # Sort Chapters
-            try:
-                sorted_chapters = sorted(chapters, key=lambda x: int(re.search(r'\d+', x).group()) if re.search(r'\d+', x) else 999)
-            except: sorted_chapters = sorted(chapters)
-
-            # Node to Chapter Mapping (BFS)
-            node_to_chapter = {}
-            adj = defaultdict(list)
-            for _, row in k_graph_df.iterrows():
-                adj[str(row['source'])].append(str(row['target']))
-
-            for chap in chapters:
-                queue = [chap]
-                visited = set()
-                while queue:
-                    curr = queue.pop(0)
-                    if curr not in node_to_chapter: node_to_chapter[curr] = chap
-                    if curr in adj:
-                        for child in adj[curr]:
-                            if child in chapters and child != chap: continue
-                            if child not in visited:
-                                visited.add(child); queue.append(child)
-
-            # 4. Build Graph Elements
+                    own_scores[n] = score
+            node_status = aggregate_status(subject_graph, mastery_vector(subject_graph, own_scores), 0.7)
+
+            def get_node_status(node):
+                score, is_mastered = node_status.get(node)
+                status = None
+                if node in own_scores:
+                    # Infer status from score if simple map doesn't have it
+                    status = "Mastered" if is_mastered else ("In Progress" if score > 0 else "Unknown")
+                return score, is_mastered, status
+
+            # 3. Chapters, owner chapter, levels, spine: cached per subject version (graph_view)
+            graph_view = get_graph_view(subject_graph)
+            graph_layout = graph_view.project()
+            chapters = graph_view.chapter_set
+            cat_map_style = {
+                "name": "cat_map",
+                "numbered": True,
+                "chapter": {"shape": "square", "size": 50, "font": "bold 24px arial black", "borderWidth": 4},
+                "lesson": {"shape": "dot", "size": 30, "font": {'size': 18, 'color': 'black'}, "borderWidth": 1},
+            }
+
+            # 4. Build Graph Elements (only colours are per user)
             nodes = []
             edges = []
-            added_nodes = set()
-            
-            # Filter visible chapters (active spine)
-            visible_chapters = [c for c in sorted_chapters if c in all_nodes]
-
-            # Edges from Data
-            for _, row in k_graph_df.iterrows():
-                src = str(row['source'])
-                tgt = str(row['target'])
-                
-                # Add nodes if not added
-                for node in [src, tgt]:
-                    if node not in added_nodes:
-                        score, is_mastered, status = get_node_status(node)
-                        
-                        # Style
-                        color = "#CFD8DC" # Grey
-                        if is_mastered:
-                             if score >= 1.0: color = "#00C853"
-                             elif score >= 0.85: color = "#69F0AE"
-                             else: color = "#B9F6CA"
-                        elif status == "Review": color = "#FF5252"
-                        elif score > 0: color = "#FFD600"
-                        
-                        is_chap = node in chapters
-                        label = node
-                        
-                        if is_chap:
-                            # Chapter Style
-                            shape = "square"
-                            size = 50
-                            font = "bold 24px arial black"
-                            borderWidth = 4
-                            num_match = re.search(r"\d+", node)
-                            label = f"{num_match.group(0)}. {node}" if num_match else node
-                        else:
-                            # Lesson Style
-                            shape = "dot"
-                            size = 30
-                            font = {'size': 18, 'color': 'black'}
-                            borderWidth = 1
-                        
-                        # LEVEL CALCULATION (CRITICAL FOR TREE LAYOUT)
-                        level = 0
-                        try:
-                            owner_chap = node_to_chapter.get(node)
-                            c_idx = -1
-                            if owner_chap in visible_chapters:
-                                c_idx = visible_chapters.index(owner_chap)
-                            if c_idx != -1:
-                                level = c_idx * 2 if is_chap else c_idx * 2 + 1
-                        except: pass
-
-                        nodes.append(Node(
-                            id=node,
-                            label=label,
-                            size=size,
-                            color=color,
-                            shape=shape,
-                            font=font,
-                            borderWidth=borderWidth,
-                            title=f"{node}\nScore: {score:.1%}",
-                            level=level # [FIX] Apply manual level
-                        ))
-                        added_nodes.add(node)
-                
-                # Add Edge
+            for spec in graph_view.node_specs(cat_map_style):
+                node = spec["id"]
+                score, is_mastered, status = get_node_status(node)
+                color = node_status.color(node)
+                if not is_mastered and status == "Review": color = "#FF5252"
+                nodes.append(Node(**spec, color=color, title=f"{node}\nScore: {score:.1%}"))
+
+            for src, tgt in graph_layout.edges:
                 w = 4 if src in chapters else 1
                 edges.append(Edge(source=src, target=tgt, color="#bdc3c7", width=w))
 
             # Spine Edges (Chapter to Chapter)
-            # Filter only chapters acting as nodes in this graph
-            present_chapters = [c for c in sorted_chapters if c in added_nodes]
-            for i in range(len(present_chapters) - 1):
-                c1 = present_chapters[i]
-                c2 = present_chapters[i+1]
+            for c1, c2 in graph_layout.spine:
                 edges.append(Edge(source=c1, target=c2, color="#2979FF", width=12, dashes=[10, 10], title="Next Chapter"))
 
             # 5. Render
@@ -1503,18 +1349,18 @@ elif ts["active"]: # [FIX] Chỉ chạy khi Active = True
                  # Scope: target_nodes OR all chapters
                  valid_nodes = set(ts.get("target_nodes", []))
                  if not valid_nodes: 
-                     valid_nodes = get_nodes_in_chapters(available_chapters)
+                     valid_nodes = get_nodes_in_chapters(available_chapters, current_subject, content_version)
                  
                  # [OPTIMIZATION] If diagnostic_cat, maybe force Exploration Strategy logic inside get_strategic_question?
                  # For now, get_strategic_question's "Exploration" (history < 5) works well.
                      
             else: # Standard (Manual)
-                valid_nodes = get_nodes_in_chapters(ts["selected_chapters"])
+                valid_nodes = get_nodes_in_chapters(ts["selected_chapters"], current_subject, content_version)
             
             # Use cached index approach implicitly via get_strategic_question optimizations?
-            # Wait, get_strategic_question was optimized to use q_skill_index inside? Yes.
+            # Wait, get_strategic_question was optimized to use question_index inside? Yes.
             
-            q, s, msg = get_strategic_question(ts["history"], None, k_graph_df, q_matrix_df, valid_nodes)
+            q, s, msg = get_strategic_question(ts["history"], None, subject_graph, question_index, valid_nodes)
             
             if q is None: # Hết câu hỏi
                 ts["active"] = False
@@ -1545,9 +1391,9 @@ elif ts["active"]: # [FIX] Chỉ chạy khi Active = True
                 # Xác định valid_nodes
                 if ts["mode"] == "smart_cat":
                     v_nodes = set(ts["target_nodes"])
-                    if not v_nodes: v_nodes = get_nodes_in_chapters(available_chapters)
+                    if not v_nodes: v_nodes = get_nodes_in_chapters(available_chapters, current_subject, content_version)
                 else:
-                    v_nodes = get_nodes_in_chapters(ts["selected_chapters"])
+                    v_nodes = get_nodes_in_chapters(ts["selected_chapters"], current_subject, content_version)
                 
                 # Gọi hàm tính toán
                 ts["speculative_next"] = prepare_speculative_next(v_nodes, ts["history"], current_skill, current_q_data['question_id'])
@@ -1580,10 +1426,8 @@ elif ts["active"]: # [FIX] Chỉ chạy khi Active = True
         st.session_state.test_session = st.session_state.test_session # Force update
         
         # 2. UPDATE LOCAL DATA
-        if "local_data" in st.session_state and ts["mode"] != "diagnostic":
-            st.session_state.local_data["user_progress"].append(
-                (current_skill, 'Completed', 1.0 if is_correct else 0.0, datetime.now())
-            )
+        if "user_mastery" in st.session_state.get("local_data", {}) and ts["mode"] != "diagnostic":
+            st.session_state.local_data["user_mastery"][current_skill] = 1.0 if is_correct else 0.0
 
         # 3. LOG TO DB
         try:
@@ -1602,14 +1446,14 @@ elif ts["active"]: # [FIX] Chỉ chạy khi Active = True
                 # Fallback logic
                 if ts["mode"] in ["smart_cat", "diagnostic_cat", "deep_cat"]:
                     valid_nodes = set(ts.get("target_nodes", []))
-                    if not valid_nodes: valid_nodes = get_nodes_in_chapters(available_chapters)
+                    if not valid_nodes: valid_nodes = get_nodes_in_chapters(available_chapters, current_subject, content_version)
                 else:
-                    valid_nodes = get_nodes_in_chapters(ts["selected_chapters"])
+                    valid_nodes = get_nodes_in_chapters(ts["selected_chapters"], current_subject, content_version)
                 
                 
                 # Check for Deep CAT Mode
                 is_deep = (ts["mode"] == "deep_cat")
-                nq, ns, nmsg = get_strategic_question(ts["history"], None, k_graph_df, q_matrix_df, valid_nodes, strict_mastery=is_deep)
+                nq, ns, nmsg = get_strategic_question(ts["history"], None, subject_graph, question_index, valid_nodes, strict_mastery=is_deep)
                 if nq:
                     ts["next_q"] = (nq, ns)
         
@@ -1649,8 +1493,7 @@ elif ts["active"]: # [FIX] Chỉ chạy khi Active = True
         </div>
         """, unsafe_allow_html=True)
         
-        try: ops = ast.literal_eval(current_q_data['options'])
-        except: ops = []
+        ops = question_options(current_q_data) # Parse sẵn trong question index
         
         # Check Mode
         submitted = ts.get("answer_submitted", False)
@@ -1807,19 +1650,21 @@ if st.session_state.get("show_result", False):
                 import sqlite3
                 conn = sqlite3.connect('local_course.db') 
                 c = conn.cursor()
+                unlock_threshold = get_user_settings(username, current_subject)[0]
                 
                 for chap in correct_chapters:
                     # Lấy tất cả node thuộc chương này
-                    nodes = get_nodes_in_chapters([chap])
+                    nodes = get_nodes_in_chapters([chap], current_subject, content_version)
                     for n in nodes:
                         # Chỉ update nếu chưa có điểm
                         try:
                             timestamp = datetime.now()
                             # Set điểm 0.8 (Màu xanh) cho các bài thuộc chương đã pass
                             c.execute('''
-                                INSERT OR IGNORE INTO user_progress (username, node_id, subject_id, status, score, timestamp)
-                                VALUES (?, ?, ?, ?, ?, ?)
-                            ''', (username, n, current_subject, 'Completed', 0.8, timestamp))
+                                INSERT OR IGNORE INTO user_progress (username, node_id, subject_id, status, score, timestamp, due_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)
+                            ''', (username, n, current_subject, 'Completed', 0.8, timestamp,
+                                  review_due_at('Completed', 0.8, timestamp, unlock_threshold)))
                             count_updated += 1
                         except: pass
                 
@@ -1878,257 +1723,54 @@ if st.session_state.get("show_result", False):
             skill = h.get('skill')
             if skill: current_map[skill] = 0.9 if h['is_correct'] else 0.4
             
-        added_nodes = set()
-        
-        # [FEATURE] SMART RE-WIRING (Gắn nhánh rời vào Chương)
-        # 1. Build map: Node -> Owner Chapter
-        node_to_chapter = {}
-        # Find all chapters first
-        all_graph_nodes = set(k_graph_df['source']).union(set(k_graph_df['target']))
-        chapters = []
-        for n in all_graph_nodes:
-             if "Chg" in str(n) or str(n).isdigit() or (len(str(n)) < 5 and "." not in str(n)):
-                 chapters.append(str(n))
-        
-        # BFS to assign chapter
-        # Build adjacency
-        adj = {}
-        for _, row in k_graph_df.iterrows():
-            s, t = str(row['source']), str(row['target'])
-            if s not in adj: adj[s] = []
-            adj[s].append(t)
-            
-        for chap in chapters:
-            queue = [chap]
-            visited = set()
-            while queue:
-                curr = queue.pop(0)
-                if curr not in node_to_chapter:
-                    node_to_chapter[curr] = chap
-                
-                if curr in adj:
-                    for child in adj[curr]:
-                        # [FIX] Stop if we hit another Chapter!
-                        # This prevents Chg1 from claiming Chg2's children.
-                        if child in chapters and child != chap:
-                             continue
-                             
-                        if child not in visited:
-                            visited.add(child)
-                            queue.append(child)
+        # [OPTIMIZATION] Chương, owner chapter (BFS), level zig-zag, spine: cache theo phiên bản môn (graph_view)
+        graph_view = get_graph_view(subject_graph)
+        chapters = graph_view.chapter_set
+        node_to_chapter = graph_view.node_to_chapter
 
         # [FEATURE] CHAPTER AGGREGATION (Tính điểm trung bình cho Chương)
-        chapter_agg_map = {}
-        for chap in chapters:
-            # Find all nodes belonging to this chapter (from node_to_chapter)
-            # OR better: Traverse graph again? No, node_to_chapter is populated now.
-            # But node_to_chapter only has *children*, not the chapter itself.
-            
-            # Find all children of this chapter
-            children = [n for n, c in node_to_chapter.items() if c == chap]
-            
-            # Calculate stats
-            total_tested = 0
-            total_score = 0
-            for child in children:
-                s = current_map.get(child, -1)
-                if s != -1:
-                    total_tested += 1
-                    total_score += s
-            
-            if total_tested > 0:
-                avg_score = total_score / total_tested
-                chapter_agg_map[chap] = avg_score
+        # -1 = Chương chưa có node nào được kiểm tra
+        chapter_agg_map = chapter_means(node_to_chapter, current_map)
+
+        # Pre-calculate visibility (None = Đầy đủ: layout dùng chung, không tính lại)
+        visible_nodes = None
+        if show_mode != "Đầy đủ (+)":
+            # Rút gọn: ONLY Tested Nodes AND Active Chapters
+            visible_nodes = {n for n in subject_graph.nodes if current_map.get(n, -1) != -1}
+            visible_nodes.update(c for c in chapters if chapter_agg_map.get(c, -1) != -1)
+
+        # Compact levels / re-wiring (Src ẩn -> nối từ Chương) nằm trong graph_view.project
+        graph_layout = graph_view.project(visible_nodes)
+        result_style = {
+            "name": "test_result",
+            "numbered": True,
+            "chapter": {"shape": "square", "size": 25, "borderWidth": 3, "font": {'size': 24}},
+            "lesson": {"shape": "dot", "size": 20, "borderWidth": 1, "font": {'size': 14}},
+        }
+        for spec in graph_view.node_specs(result_style, visible_nodes):
+            node = spec["id"]
+            score = current_map.get(node, -1)
+            if node in chapters:
+                # [FEATURE] OVERRIDE CHAPTER COLOR based on Aggregation
+                score_for_color = chapter_agg_map.get(node, -1)
             else:
-                chapter_agg_map[chap] = -1 # Not tested
+                score_for_color = score
 
-        # [RESTORED] SMART LEAF PLACEMENT & SPINE LOGIC
-        # 1. Sort Chapters for X-Axis placement
-        import re
-        sorted_chapters = []
-        try:
-             sorted_chapters = sorted(chapters, key=lambda x: int(re.search(r'\d+', x).group()))
-        except: 
-             sorted_chapters = list(chapters)
-             
-        # Map Chapter -> X Coordinate
-        chapter_x = {}
-        spacing_x = 300 # Distance between chapters
-        for i, chap in enumerate(sorted_chapters):
-             chapter_x[chap] = i * spacing_x
-
-        # 2. Add Nodes & Edges
-        # Pre-calculate visibility
-        visible_nodes = set()
-        for n in all_graph_nodes:
-            is_chap = n in chapters
-            if show_mode == "Đầy đủ (+)":
-                visible_nodes.add(n)
-            else:
-                # Rút gọn: ONLY Tested Nodes AND Active Chapters
-                has_score = current_map.get(n, -1) != -1
-                
-                keep_chapter = False
-                if is_chap:
-                    # Check if chapter has any tested children (via agg map)
-                    # If chapter itself has score or agg_score is present
-                    agg_score = chapter_agg_map.get(n, -1)
-                    if agg_score != -1 or has_score:
-                        keep_chapter = True
-                
-                if keep_chapter or (not is_chap and has_score):
-                    visible_nodes.add(n)
-
-        # [FIX] Pre-calculate visible chapters for Compact Leveling
-        # Identifying valid chapters that are in visible_nodes
-        # This allows us to assign Level 0, 2, 4... consecutively even if Ch 2 is missing.
-        visible_chapters_ordered = [c for c in sorted_chapters if c in visible_nodes]
-        for idx, row in k_graph_df.iterrows():
-            src = str(row['source'])
-            tgt = str(row['target'])
-            
-            # Logic:
-            # Case 1: Both Visible -> Draw Edge
-            # Case 2: Src Hidden, Tgt Visible -> Draw Edge (Chapter -> Tgt)
-            
-            final_src = None
-            if src in visible_nodes and tgt in visible_nodes:
-                final_src = src
-            elif src not in visible_nodes and tgt in visible_nodes:
-                # Re-wire to Chapter
-                owner_chap = node_to_chapter.get(tgt)
-                if owner_chap and owner_chap in visible_nodes:
-                    final_src = owner_chap
-            
-            if final_src:
-                # Add nodes if not added
-                for node in [final_src, tgt]:
-                    if node not in added_nodes:
-                        score = current_map.get(node, -1)
-                        
-                        # COLOR
-                        if score >= 0.7: color = "#00C853"
-                        elif score >= 0.5: color = "#FFD600"
-                        elif score >= 0.0: color = "#FF5252"
-                        else: color = "#CFD8DC"
-                        
-                        # [FEATURE] OVERRIDE CHAPTER COLOR based on Aggregation
-                        if node in chapters:
-                            agg_score = chapter_agg_map.get(node, -1)
-                            if agg_score != -1:
-                                if agg_score >= 0.7: color = "#00C853" # Green
-                                elif agg_score >= 0.5: color = "#FFD600" # Orange
-                                else: color = "#FF5252" # Red
-                            else:
-                                # [FIX] User wants Gray for untested chapters
-                                color = "#CFD8DC"
-                        
-                        # STYLE & SHAPE
-                        # User wants: Circular nodes for chapters with Number inside.
-                        # Distinct from leaves.
-                        
-                        import re
-                        is_chapter_node = node in chapters
-                        label = node
-                        font = {"color": "black"} # Default
-                        
-                        if is_chapter_node:
-                             # 1. Parse Number
-                             num_match = re.search(r"\d+", node)
-                             num_str = num_match.group(0) if num_match else "?"
-                             
-                             # [FIX] Label = Number + Name (Outside)
-                             # Shape 'square' puts label outside.
-                             label = f"{num_str}. {node}" 
-                             shape = "square" # [FIX] Square shape (label defaults to outside)
-                             size = 25 # Fixed size for square
-                             
-                             # Custom font for BOLD effect
-                             # Vis.js allows shorthand string for font to set weight
-                             font = "bold 20px arial black" # [FIX] Bold font string
-                        
-                        else:
-                             # Leaf
-                             # [FIX] User wants Circular nodes always
-                             shape = "dot" 
-                             size = 20
-                        # Forces Ch1 -> Leftmost.
-                        # Logic: Chapter i is Level 2*i. Children are Level 2*i + 1.
-                        # [FIX] Use VISIBLE chapters only to avoid gaps in Condensed Mode
-                        level = 0
-                        try:
-                            owner_chap = node_to_chapter.get(node)
-                            # Identify visible order
-                            # We need to compute visible_chapters dynamically or assume based on added_nodes (which is filling up)
-                            # Safe approach: Use original index but 'compress' if mode is Rút gọn?
-                            # Actually, Graphviz/VisJS handles gaps fine, but for spine we need exact connections.
-                            # For Level: Keeping original index is safer for stability, gaps are okay.
-                            
-                            # [FIX] Compact Leveling Logic
-                            # Use the index from 'visible_chapters_ordered' instead of global 'sorted_chapters'
-                            # This removes the empty space where hidden chapters would be.
-                            
-                            c_idx = -1
-                            if owner_chap in visible_chapters_ordered:
-                                c_idx = visible_chapters_ordered.index(owner_chap)
-                                
-                            if c_idx != -1:
-                                if is_chapter_node:
-                                    level = c_idx * 2
-                                else:
-                                    level = c_idx * 2 + 1
-                        except: pass
+            # COLOR
+            if score_for_color >= 0.7: color = "#00C853"
+            elif score_for_color >= 0.5: color = "#FFD600"
+            elif score_for_color >= 0.0: color = "#FF5252"
+            else: color = "#CFD8DC" # [FIX] Gray for untested
 
-                        # Create Node
-                        node_kwargs = {
-                            "id": node, 
-                            "label": label, 
-                            "size": size, 
-                            "color": color, 
-                            "shape": shape, 
-                            "title": f"{node}\nĐiểm: {score:.0%}",
-                            "borderWidth": 3 if is_chapter_node else 1,
-                            "font": {'size': 24} if is_chapter_node else {'size': 14}, # Bigger Font -> Bigger Box
-                            "shapeProperties": {"borderRadius": 5} if is_chapter_node and shape == "box" else {},
-                            "level": level # [FIX] Force Hierarchy Level
-                        }
-                        
-                        # [REVERT] No manual fixing, let Hierarchical Engine handle it
-                            
-                        nodes.append(Node(**node_kwargs))
-                        added_nodes.add(node)
-                
-                # Add Edge
-                # [FIX] Thicker edges for Chapter -> Child (Root-like)
-                edge_width = 1
-                if final_src in chapters:
-                    edge_width = 3
-                
-                edges.append(Edge(source=final_src, target=tgt, color="#bdc3c7", width=edge_width))
+            nodes.append(Node(**spec, color=color, title=f"{node}\nĐiểm: {score:.0%}"))
 
-        # [FEATURE] FORCE SPINE EDGES (Connect Ch1->Ch2->Ch3)
-        # [FIX] Smart Spine: Connect CONSECUTIVE VISIBLE chapters
-        # Gather visible chapters in order
-        visible_chapters_sorted = [c for c in sorted_chapters if c in added_nodes]
-        
-        num_spine_edges = len(visible_chapters_sorted) - 1
-        max_width = 12
-        min_width = 2
-        
-        for i in range(num_spine_edges):
-            c1 = visible_chapters_sorted[i]
-            c2 = visible_chapters_sorted[i+1]
-            
-            # [FIX] Tapered Width Logic
-            # Width decreases linearly from max_width to min_width
-            if num_spine_edges > 1:
-                decay = (max_width - min_width) * (i / (num_spine_edges - 1))
-                current_width = max_width - decay
-            else:
-                current_width = max_width
-            
-            # [FIX] Thicker Spine + Tapered
-            edges.append(Edge(source=c1, target=c2, color="#2979FF", width=int(current_width), dashes=[15, 15]))
+        for src, tgt in graph_layout.edges:
+            # [FIX] Thicker edges for Chapter -> Child (Root-like)
+            edges.append(Edge(source=src, target=tgt, color="#bdc3c7", width=3 if src in chapters else 1))
+
+        # [FEATURE] FORCE SPINE EDGES: consecutive visible chapters, tapered width
+        for (c1, c2), w in zip(graph_layout.spine, spine_widths(len(graph_layout.spine), 12, 2)):
+            edges.append(Edge(source=c1, target=c2, color="#2979FF", width=w, dashes=[15, 15]))
         
         # [DEBUG] Check data validity
         if not nodes:
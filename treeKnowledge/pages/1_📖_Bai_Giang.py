@@ -5,13 +5,11 @@ import os
 import time
 import re
 import streamlit.components.v1 as components # Module để hiển thị HTML/MathJax
-import ast
 from db_utils import (
     get_graph_structure,
     get_resource,
     save_progress,
     get_node_status,
-    get_all_questions,
     get_user_settings,    # 👈 thêm
     log_activity,         # 👈 thêm
     get_user_progress,    # 👈 thêm (OPTIMIZATION)
@@ -28,11 +26,11 @@ from db_utils import (
     get_resource,
     save_progress,
     get_node_status,
-    get_all_questions,
     get_user_settings,
     log_activity,
     get_user_progress,
 )
+from question_index import get_question_index, question_options
 
 
 st.set_page_config(page_title="Bài Giảng", page_icon="📖", layout="wide")
@@ -141,16 +139,8 @@ st.title(f"📖 Thư viện Bài giảng: {current_subject}")
 
 df_structure = get_graph_structure(current_subject)
 
-# === Ngân hàng câu hỏi dùng lại ở nhiều chỗ ===
-@st.cache_data
-def load_questions_df(subject_id):
-    df = get_all_questions(subject_id)
-    if df is None or df.empty:
-        return pd.DataFrame()
-    df["skill_id_list"] = df["skill_id_list"].astype(str)
-    return df
-
-questions_df = load_questions_df(current_subject)
+# === Ngân hàng câu hỏi dùng lại ở nhiều chỗ (chỉ mục skill -> câu hỏi, theo content_version) ===
+question_index = get_question_index(current_subject)
 
 if df_structure.empty:
     st.error("⚠️ Chưa có dữ liệu cấu trúc bài học. Vui lòng nhờ Admin cập nhật.")
@@ -409,12 +399,11 @@ if current_node:
         </style>
         """, unsafe_allow_html=True)
 
-        if questions_df.empty:
+        if len(question_index) == 0:
             st.caption("📭 Ngân hàng câu hỏi chưa được cấu hình.")
         else:
-            # Lọc các câu hỏi có chứa current_node trong skill_id_list
-            qs = questions_df[questions_df["skill_id_list"].str.contains(current_node, na=False)]
-            qs = qs.reset_index(drop=True)
+            # Các câu hỏi gắn với current_node (khớp chính xác skill id)
+            qs = question_index.df.iloc[list(question_index.positions(current_node))].reset_index(drop=True)
             total_qs = len(qs)
 
             if total_qs == 0:
@@ -493,11 +482,8 @@ if current_node:
                     </div>
                     """, unsafe_allow_html=True)
                     
-                    # Parse options
-                    try:
-                        ops = ast.literal_eval(row["options"])
-                    except Exception:
-                        ops = [row["options"]]
+                    # Options (parse sẵn trong question index)
+                    ops = question_options(row) or [row["options"]]
 
                     # Radio đáp án
                     selected = st.radio(
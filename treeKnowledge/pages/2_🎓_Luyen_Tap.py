@@ -15,10 +15,13 @@ try:
         save_user_settings, 
         apply_forgetting_decay
     )
+    from mastery_store import get_mastery_store
+    from subject_graph import get_subject_graph
+    from question_index import get_question_index, question_options
     # Import logic lõi từ practice_engine mới
     from practice_engine import (
         load_practice_context,
-        recommend_next_skill_strict,
+        get_skill_frontier,
         pick_question_for_skill,
         grade_and_update
     )
@@ -162,14 +165,22 @@ try:
     # ============================================================
     st.title(f"🎓 Luyện tập: {selected_subject}")
 
+    # [OPTIMIZATION] Điểm thành thạo nạp 1 lần / session, cập nhật tại chỗ sau mỗi câu trả lời
+    mastery_store = get_mastery_store(current_username, selected_subject)
+
     # 1. Kích hoạt FASS (Forgetting Curve) - Chỉ chạy 1 lần khi load trang
     if "decay_applied" not in st.session_state:
         with st.spinner("⏳ Đang tính toán đường cong lãng quên..."):
-            apply_forgetting_decay(current_username, selected_subject, decay_rate=0.1)
+            for node, stat, scr in apply_forgetting_decay(current_username, selected_subject, decay_rate=0.1):
+                mastery_store.apply(node, stat, scr)
         st.session_state.decay_applied = True
 
     # 2. Load dữ liệu ngữ cảnh (Sử dụng hàm từ practice_engine)
-    k_graph_df, q_matrix_df, user_mastery = load_practice_context(current_username, selected_subject)
+    k_graph_df, q_matrix_df, user_mastery = load_practice_context(current_username, selected_subject, mastery_store=mastery_store)
+    subject_graph = get_subject_graph(selected_subject)  # Cha/con + thứ tự topo tính sẵn theo content_version
+    question_index = get_question_index(selected_subject, q_matrix_df)  # skill -> câu hỏi (khớp chính xác, chia sẵn độ khó)
+    # Vùng biên lộ trình, cập nhật tại chỗ khi mastery store đổi: gợi ý O(log N)
+    frontier = get_skill_frontier(mastery_store, subject_graph, question_index, mastery_threshold)
 
     # --- SESSION STATE INIT ---
     if 'current_question' not in st.session_state: st.session_state.current_question = None
@@ -180,10 +191,7 @@ try:
     # 3. Logic lấy câu hỏi mới (Nếu chưa có)
     if st.session_state.current_question is None:
         # A. Tìm node (skill) tiếp theo cần học
-        target_node, strategy, debug_log = recommend_next_skill_strict(
-            user_mastery, k_graph_df, q_matrix_df, 
-            threshold=mastery_threshold
-        )
+        target_node, strategy, debug_log = frontier.recommend()
 
         # B. Xử lý kết quả tìm node
         if target_node is None:
@@ -202,7 +210,7 @@ try:
         cur_score = user_mastery.get(target_node, 0.0)
         
         q_dict = pick_question_for_skill(
-            target_node, q_matrix_df, 
+            target_node, question_index, 
             current_mastery=cur_score,
             last_question_id=st.session_state.last_question_id,
             shuffle=True # Engine tự xử lý trộn đáp án
@@ -261,11 +269,12 @@ try:
             subject_id=selected_subject,
             node_id=t_skill,
             user_mastery=user_mastery,
-            q_matrix_df=q_matrix_df,
+            q_matrix_df=question_index,
             mastery_threshold=mastery_threshold,
             learning_rate=learning_rate,
             duration=duration,
-            strategy_info=strat_info
+            strategy_info=strat_info,
+            mastery_store=mastery_store
         )
 
         # 3. Lưu kết quả hiển thị ra UI
@@ -287,10 +296,8 @@ try:
         with col_content:
             st.markdown(f"<div class='question-text'>❓ {q_data['content']}</div>", unsafe_allow_html=True)
             
-            # Parse options để hiển thị (Engine đã shuffle và lưu dạng string list trong q_data['options'])
-            import ast
-            try: ops = ast.literal_eval(q_data['options'])
-            except: ops = []
+            # Options để hiển thị (Engine đã shuffle sẵn trong q_data['option_list'])
+            ops = question_options(q_data)
             
             st.radio(
                 "Lựa chọn của bạn:", 
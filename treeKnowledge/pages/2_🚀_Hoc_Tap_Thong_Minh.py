@@ -4,10 +4,7 @@ import sys
 import time
 import pandas as pd
 from streamlit_agraph import agraph, Node, Edge, Config
-import ast
 from datetime import datetime
-import re
-from collections import defaultdict
 
 # --- SETUP PATHS ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -22,15 +19,20 @@ try:
         apply_forgetting_decay,
         get_graph_structure,
         get_resource,
-        get_all_questions, 
         get_node_status,
-        get_mastered_question_ids,  # [NEW] Import for Smart Navigation
         get_question_status_map    # [NEW] Status Icons
     )
+    from mastery_store import get_mastery_store
+    from subject_graph import get_subject_graph
+    from question_index import get_question_index, question_options
+    from mastery_vectors import mastery_vector, aggregate_status
+    from graph_view import get_graph_view
+    from mastery_keys import MasteryKeyIndex
+    from review_scheduler import get_review_queue
     # Import logic lõi từ practice_engine mới
     from practice_engine import (
         load_practice_context,
-        recommend_next_skill_strict,
+        get_skill_frontier,
         pick_question_for_skill,
         grade_and_update,
         # CAT Logic
@@ -300,14 +302,24 @@ try:
     # ============================================================
     st.title(f"🚀 Học Tập Thông Minh: {selected_subject}")
     
+    # [OPTIMIZATION] Điểm thành thạo nạp 1 lần / session, cập nhật tại chỗ sau mỗi câu trả lời
+    mastery_store = get_mastery_store(current_username, selected_subject)
+
     # 1. Kích hoạt FASS
     if "decay_applied" not in st.session_state:
         with st.spinner("⏳ Đang tính toán đường cong lãng quên..."):
-            apply_forgetting_decay(current_username, selected_subject, decay_rate=0.1)
+            for node, stat, scr in apply_forgetting_decay(current_username, selected_subject, decay_rate=0.1):
+                mastery_store.apply(node, stat, scr)
         st.session_state.decay_applied = True
 
     # 2. Load dữ liệu ngữ cảnh
-    k_graph_df, q_matrix_df, user_mastery = load_practice_context(current_username, selected_subject)
+    k_graph_df, q_matrix_df, user_mastery = load_practice_context(current_username, selected_subject, mastery_store=mastery_store)
+    subject_graph = get_subject_graph(selected_subject)  # Cha/con + thứ tự topo tính sẵn theo content_version
+    question_index = get_question_index(selected_subject, q_matrix_df)  # skill -> câu hỏi (khớp chính xác, chia sẵn độ khó)
+    # Vùng biên lộ trình, cập nhật tại chỗ khi mastery store đổi: gợi ý O(log N)
+    frontier = get_skill_frontier(mastery_store, subject_graph, question_index, mastery_threshold)
+    # Hàng đợi ôn tập theo thời điểm đến hạn (min-heap), cũng cập nhật tại chỗ khi chấm điểm / FASS
+    review_queue = get_review_queue(mastery_store, mastery_threshold)
 
     # --- SESSION STATE INIT ---
     if 'current_question' not in st.session_state: st.session_state.current_question = None
@@ -336,10 +348,7 @@ try:
 
     # 3. RECOMMENDATION ENGINE (ALWAYS RUNS TO FIND TARGET SKILL)
     if not st.session_state.target_skill:
-        target_node, strategy, debug_log = recommend_next_skill_strict(
-            user_mastery, k_graph_df, q_matrix_df, 
-            threshold=mastery_threshold
-        )
+        target_node, strategy, debug_log = frontier.recommend()
         st.session_state.target_skill = target_node
         st.session_state.strategy_msg = strategy
         st.rerun()
@@ -384,68 +393,28 @@ try:
     # TAB 1: KNOWLEDGE GRAPH MAP
     # ============================================================
     with tab_map:
-        if not k_graph_df.empty:
-            k_graph_df['source'] = k_graph_df['source'].astype(str).str.strip()
-            k_graph_df['target'] = k_graph_df['target'].astype(str).str.strip()
-
-        # Children Map
-        children_map = defaultdict(list)
-        for _, row in k_graph_df.iterrows():
-            children_map[str(row['source']).strip()].append(str(row['target']).strip())
-
-        memo_calc = {} 
-        db_keys = list(user_mastery.keys())
-
-        def find_score_exact(node_id):
-            return user_mastery.get(node_id)
+        # [OPTIMIZATION] Điểm riêng -> vector NumPy; gộp Chương trong 1 lượt bottom-up (mastery_vectors)
+        key_index = MasteryKeyIndex(user_mastery) # Prefix Match = bisect O(log M)
 
         def find_score_fuzzy(node_id):
             if "." in node_id or str(node_id).isdigit():
-                for k in db_keys:
-                    if k.startswith(str(node_id) + "_") or k.startswith(str(node_id) + " "):
-                        return user_mastery[k]
+                k = key_index.prefix_match(node_id)
+                if k is not None:
+                    return user_mastery[k]
             return None
 
-        def calculate_node_node_status(node, threshold):
-            if node in memo_calc: return memo_calc[node]
-            
-            # 1. Exact Match
-            score = find_score_exact(node)
-            if score is not None: 
-                is_m = (score >= threshold)
-                memo_calc[node] = (score, is_m)
-                return score, is_m
-            
-            # 2. Aggregation (If has children)
-            kids = children_map.get(node, [])
-            if kids:
-                total_s = 0; all_m = True
-                valid_kids = 0
-                for kid in kids:
-                    s, m = calculate_node_node_status(kid, threshold)
-                    total_s += s
-                    if not m: all_m = False
-                    valid_kids += 1
-                
-                if valid_kids > 0:
-                    avg_s = total_s / valid_kids
-                    memo_calc[node] = (avg_s, all_m)
-                    return avg_s, all_m
-
-            # 3. Fuzzy Match (Fallback)
-            score = find_score_fuzzy(node)
+        # 1. Exact Match; Fuzzy Match chỉ là fallback cho node không có con
+        own_scores = {}
+        for n in subject_graph.nodes:
+            score = user_mastery.get(n)
+            if score is None and not subject_graph.children(n):
+                score = find_score_fuzzy(n)
             if score is not None:
-                is_m = (score >= threshold)
-                memo_calc[node] = (score, is_m)
-                return score, is_m
+                own_scores[n] = score
 
-            memo_calc[node] = (0.0, False)
-            return 0.0, False 
-
-        all_nodes = set(k_graph_df['source']).union(set(k_graph_df['target']))
-        node_info_map = {} 
-        for n in all_nodes:
-            node_info_map[n] = calculate_node_node_status(n, mastery_threshold)
+        # 2. Aggregation: node không có điểm riêng = trung bình các con
+        node_status = aggregate_status(subject_graph, mastery_vector(subject_graph, own_scores), mastery_threshold)
+        node_info_map = node_status.as_map()
 
         st.subheader("🗺️ Bản đồ Tri thức: Toàn cảnh")
         
@@ -460,6 +429,11 @@ try:
         </div>
         """, unsafe_allow_html=True)
 
+        # ⏰ Đến hạn ôn tập: k node quá hạn lâu nhất, O(k log N)
+        due_reviews = review_queue.due(3)
+        if due_reviews:
+            st.warning("⏰ **Đến hạn ôn tập:** " + " · ".join(f"{n} ({(sc or 0.0):.0%})" for n, _, sc in due_reviews))
+
         # [RESTORED] Fixed Height
         current_h = 950
 
@@ -485,92 +459,34 @@ try:
         """
         st.markdown(css_style, unsafe_allow_html=True)
 
-        # Chapters
-        chapters = []
-        for n in all_nodes:
-             if "Chg" in str(n) or str(n).isdigit() or (len(str(n)) < 5 and "." not in str(n)):
-                 chapters.append(str(n))
-        try: sorted_chapters = sorted(chapters, key=lambda x: int(re.search(r'\d+', x).group()))
-        except: sorted_chapters = list(chapters)
-
-        # Build Graph
+        # [OPTIMIZATION] Layout (Chương, owner chapter, level zig-zag, spine) cache theo phiên bản môn: chỉ tô màu mỗi lần rerun
+        graph_view = get_graph_view(subject_graph)
+        graph_layout = graph_view.project()
+        map_style = {
+            "name": "hoc_tap_map",
+            "chapter": {"shape": "square", "size": 40, "font": "bold 24px arial black"},
+            "lesson": {"shape": "dot", "size": 30, "font": {'size': 18, 'color': 'black'}},
+        }
         nodes = []
         edges = []
-        added_nodes = set()
-        
-        # [FIX] Enhanced Layout Logic (Ported from Page 3)
-        # 1. Build Adjacency List for hierarchical mapping
-        adj = defaultdict(list)
-        for _, row in k_graph_df.iterrows():
-            adj[str(row['source']).strip()].append(str(row['target']).strip())
-
-        # 2. Map Nodes to Chapters via BFS
-        node_to_chapter = {}
-        for chap in chapters:
-            queue = [chap]
-            visited = set()
-            while queue:
-                curr = queue.pop(0)
-                if curr not in node_to_chapter: node_to_chapter[curr] = chap
-                if curr in adj:
-                    for child in adj[curr]:
-                        if child in chapters and child != chap: continue # Don't cross into next chapter
-                        if child not in visited:
-                            visited.add(child); queue.append(child)
 
         with st.container(border=True):
             st.markdown('<div id="graph-location-marker"></div>', unsafe_allow_html=True)
-            for idx, row in k_graph_df.iterrows():
-                src = str(row['source']).strip()
-                tgt = str(row['target']).strip()
-                final_src = src
-                
-                for node in [final_src, tgt]:
-                    if node not in added_nodes:
-                        score, is_m = node_info_map.get(node, (0.0, False))
-                        color = "#CFD8DC"
-                        if is_m:
-                            if score >= 1.0: color = "#00C853"
-                            elif score >= 0.85: color = "#69F0AE"
-                            else: color = "#B9F6CA"
-                        elif score > 0: color = "#FFD600"
-                        
-                        is_target = (node == t_skill)
-                        borderColor = "#D50000" if is_target else "#2c3e50"
-                        borderWidth = 6 if is_target else 2
-                        shadow = {"enabled": True, "color": "#D50000", "size": 15} if is_target else {"enabled": False}
-                        label_prefix = "🎯 " if is_target else ""
-                        
-                        is_chap = node in chapters
-                        label = label_prefix + node
-                        
-                        if is_chap:
-                             shape = "square"; size = 40; font = "bold 24px arial black"
-                        else:
-                             shape = "dot"; size = 30; font = {'size': 18, 'color': 'black'}
-                             
-                        # [FIX] Level Calculation (Zig-Zag Layout)
-                        level = 0 
-                        try:
-                            owner_chap = node_to_chapter.get(node)
-                            c_idx = -1
-                            if owner_chap in sorted_chapters:
-                                c_idx = sorted_chapters.index(owner_chap)
-                            if c_idx != -1:
-                                level = c_idx * 2 if is_chap else c_idx * 2 + 1
-                        except: pass
-
-                        nodes.append(Node(id=node, label=label, size=size, color=color, shape=shape, 
-                                          font=font, borderWidth=borderWidth, border_color=borderColor, shadow=shadow,
-                                          title=f"{node}\nĐiểm: {score:.0%}", level=level))
-                        added_nodes.add(node)
-                
-                edges.append(Edge(source=final_src, target=tgt, color="#bdc3c7", width=2))
+            for spec in graph_view.node_specs(map_style):
+                node = spec["id"]
+                score, is_m = node_info_map.get(node, (0.0, False))
+                node_kwargs = dict(spec, color=node_status.color(node), borderWidth=2, border_color="#2c3e50",
+                                   shadow={"enabled": False}, title=f"{node}\nĐiểm: {score:.0%}")
+                if node == t_skill:
+                    node_kwargs.update(label="🎯 " + node, borderWidth=6, border_color="#D50000",
+                                       shadow={"enabled": True, "color": "#D50000", "size": 15})
+                nodes.append(Node(**node_kwargs))
+
+            for src, tgt in graph_layout.edges:
+                edges.append(Edge(source=src, target=tgt, color="#bdc3c7", width=2))
             
             # Spine
-            visible_chapters_sorted = [c for c in sorted_chapters if c in added_nodes]
-            for i in range(len(visible_chapters_sorted)-1):
-                c1 = visible_chapters_sorted[i]; c2 = visible_chapters_sorted[i+1]
+            for c1, c2 in graph_layout.spine:
                 edges.append(Edge(source=c1, target=c2, color="#2979FF", width=8, dashes=[10,10]))
 
             config_full = Config(
@@ -645,7 +561,7 @@ try:
         """, unsafe_allow_html=True)
 
         if is_mastered:
-             peek_node, _, _ = recommend_next_skill_strict(user_mastery, k_graph_df, q_matrix_df, threshold=mastery_threshold)
+             peek_node = frontier.next(exclude=t_skill)  # Next-next khi t_skill còn trong vùng biên
              if peek_node and peek_node != t_skill:
                  st.info(f"🎉 Bạn đã thành thạo **{t_skill}**. Bước tiếp theo:")
                  if st.button(f"➡️ Học bài tiếp theo: {peek_node}", type="primary", use_container_width=True):
@@ -759,7 +675,7 @@ try:
              st.info("Hệ thống đề xuất bạn làm bài kiểm tra CAT để đánh giá lại kỹ năng này.")
              
              # Calculate next skill for recommendation
-             peek_node, _, _ = recommend_next_skill_strict(user_mastery, k_graph_df, q_matrix_df, threshold=mastery_threshold)
+             peek_node = frontier.next(exclude=t_skill)  # Next-next khi t_skill còn trong vùng biên
              
              c_cat, c_next = st.columns([1, 1])
              
@@ -778,14 +694,8 @@ try:
                          st.session_state.current_q_idx = 0
                          st.rerun()
         
-        # Load Questions
-        q_data_dict = get_all_questions(selected_subject)
-        relevant_qs = []
-        if not q_data_dict.empty:
-            for _, row in q_data_dict.iterrows():
-                s_list = row['skill_id_list']
-                if pd.isna(s_list): continue
-                if t_skill in str(s_list): relevant_qs.append(row.to_dict())
+        # Load Questions (chỉ mục skill -> câu hỏi: khớp chính xác, không quét cả ngân hàng)
+        relevant_qs = [question_index.record(p) for p in question_index.positions(t_skill)]
         
         total_qs_count = len(relevant_qs)
 
@@ -804,8 +714,10 @@ try:
             
             # [SMART NAVIGATION] Auto-Jump logic (Existing)
             if total_qs_count > 0:
-                mastered_ids = get_mastered_question_ids(current_username, selected_subject, t_skill)
-                q_status_map = get_question_status_map(current_username, selected_subject, t_skill)
+                # Đọc theo khóa (username, subject_id, question_id) trong question_attempt_stats
+                q_ids = [q['question_id'] for q in relevant_qs]
+                q_status_map = get_question_status_map(current_username, selected_subject, t_skill, question_ids=q_ids)
+                mastered_ids = {q for q, s in q_status_map.items() if s == 'correct'}
                 smart_start_idx = 0
                 for idx, q in enumerate(relevant_qs):
                     if q['question_id'] not in mastered_ids:
@@ -859,8 +771,7 @@ try:
             </div>
             """, unsafe_allow_html=True)
             
-            try: ops = ast.literal_eval(q_row['options'])
-            except: ops = []
+            ops = question_options(q_row) # Parse sẵn trong question index
             
             # Check previous result
             res_data = st.session_state.get(f"res_{q_unique_key}") # (is_correct, corr_text/selected_opt, user_selection)
@@ -890,10 +801,11 @@ try:
                             subject_id=selected_subject,
                             node_id=t_skill,
                             user_mastery=user_mastery,
-                            q_matrix_df=q_matrix_df,
+                            q_matrix_df=question_index,
                             mastery_threshold=mastery_threshold,
                             learning_rate=learning_rate,
-                            duration=0, strategy_info="Manual Practice"
+                            duration=0, strategy_info="Manual Practice",
+                            mastery_store=mastery_store
                         )
                         # Save extended result: (is_correct, corr_text, user_selection)
                         st.session_state[f"res_{q_unique_key}"] = (is_correct, corr_text, selected_opt_text)
@@ -983,7 +895,7 @@ try:
     # ============================================================
     with tab_analytics:
         st.subheader("📊 Số liệu học tập")
-        uniq_nodes = set(k_graph_df['source']).union(set(k_graph_df['target']))
+        uniq_nodes = subject_graph.nodes
         total_skills = len(uniq_nodes) if uniq_nodes else 1
         
         mastered_count = sum(1 for s in user_mastery.values() if s >= mastery_threshold)
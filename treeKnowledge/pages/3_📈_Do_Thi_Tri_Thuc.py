@@ -3,10 +3,8 @@ import pandas as pd
 import numpy as np
 import os
 import sys
-import ast
 import streamlit.components.v1 as components # Module để hiển thị HTML/MathJax
 from streamlit_agraph import agraph, Node, Edge, Config
-from collections import defaultdict
 
 # --- SETUP ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -20,11 +18,18 @@ try:
         save_user_settings, 
         get_all_users_list
     )
+    from mastery_store import get_mastery_store
+    from subject_graph import get_subject_graph
+    from question_index import get_question_index, question_options
+    from mastery_vectors import mastery_vector, aggregate_status
+    from graph_view import get_graph_view, spine_widths
+    from mastery_keys import MasteryKeyIndex
     # 🔁 Dùng chung engine luyện tập
     from practice_engine import (
         pick_question_for_skill,
         grade_and_update,
-        recommend_next_skill_strict
+        recommend_next_skill_strict,
+        get_skill_frontier
     )
 except ImportError: 
     st.error("Lỗi: Không tìm thấy module db_utils hoặc practice_engine.")
@@ -201,21 +206,17 @@ def load_data(g, m):
     except: return None, None
 
 #k_graph_df, q_matrix_df = load_data(GRAPH_FILE, MATRIX_FILE)
-from db_utils import get_all_questions
-from db_utils import get_graph_structure
-k_graph_df = get_graph_structure(selected_subject) # Load từ DB
-q_matrix_df = get_all_questions(selected_subject) # Load từ DB
+# [OPTIMIZATION] Chỉ mục skill -> câu hỏi (khớp chính xác skill id, chia sẵn độ khó)
+question_index = get_question_index(selected_subject)
 
-# [FIX] Clean Whitespace
-if not k_graph_df.empty:
-    k_graph_df['source'] = k_graph_df['source'].astype(str).str.strip()
-    k_graph_df['target'] = k_graph_df['target'].astype(str).str.strip()
-
-
-if k_graph_df is None: st.stop()
+# [OPTIMIZATION] Đồ thị đã biên dịch (node id đã strip): cha/con, thứ tự topo tính sẵn theo content_version
+subject_graph = get_subject_graph(selected_subject)
 
 # --- LẤY DỮ LIỆU ĐIỂM SỐ ---
-raw_progress = get_user_progress(username, current_subject)
+# [OPTIMIZATION] Điểm của chính mình lấy từ mastery store của session (không query lại mỗi rerun).
+# Xem người khác (admin) thì vẫn đọc DB để luôn thấy số liệu mới nhất.
+mastery_store = get_mastery_store(username, current_subject) if username == real_user else None
+raw_progress = mastery_store.rows() if mastery_store is not None else get_user_progress(username, current_subject)
 direct_scores = {} # {id_in_db: score}
 direct_status = {}
 db_keys = [] # Danh sách key có trong DB để đối chiếu
@@ -233,12 +234,10 @@ user_mastery = direct_scores # Alias for practice engine compatibility
 # ============================================================
 # 🧠 SMART MATCHING & AGGREGATION
 # ============================================================
-children_map = defaultdict(list)
-for _, row in k_graph_df.iterrows():
-    children_map[row['source']].append(row['target'])
+# [OPTIMIZATION] Điểm riêng -> vector NumPy theo subject_graph; gộp Chương trong 1 lượt bottom-up (mastery_vectors)
 
-memo_calc = {} 
 matched_keys_log = {} # Để debug xem nó map cái gì với cái gì
+key_index = MasteryKeyIndex(db_keys) # [OPTIMIZATION] Key DB sắp xếp sẵn: Prefix Match = bisect O(log M)
 
 def find_best_score_in_db(graph_node_id):
     """
@@ -246,67 +245,27 @@ def find_best_score_in_db(graph_node_id):
     Ví dụ: Graph='2.2' sẽ khớp với DB='2.2_BucTranhLon'
     """
     # 1. Exact Match (Ưu tiên cao nhất)
-    if graph_node_id in direct_scores:
-        matched_keys_log[graph_node_id] = f"Exact: {graph_node_id}"
-        return direct_scores[graph_node_id], direct_status.get(graph_node_id, "")
-    
     # 2. Prefix Match (Thông minh)
     # Chỉ áp dụng cho node lá (có dấu chấm như 1.1, 2.2...) để tránh map nhầm '1' vào '10'
-    if "." in graph_node_id:
-        for db_k in db_keys:
-            if db_k.startswith(graph_node_id + "_") or db_k.startswith(graph_node_id + " "):
-                matched_keys_log[graph_node_id] = f"Smart Match: {db_k}"
-                return direct_scores[db_k], direct_status[db_k]
-                
-    return None, None # Không tìm thấy
-
-def calculate_node_status(node, threshold):
-    if node in memo_calc: return memo_calc[node]
-    
-    # --- SỬA ĐỔI QUAN TRỌNG ---
-    # 1. Luôn ưu tiên kiểm tra xem nút này có phải là bài học đã có điểm trong DB không
-    score, status = find_best_score_in_db(node)
-    
-    if score is not None: 
-        # Nếu ĐÃ CÓ điểm thực tế của chính nó (Dù nó có con hay không)
-        # Thì trạng thái của nó phụ thuộc vào chính nó, không phụ thuộc vào con.
-        is_mastered = (score >= threshold)
-        memo_calc[node] = (score, is_mastered, status)
-        return score, is_mastered, status
-
-    # 2. Chỉ khi KHÔNG có điểm trong DB (Ví dụ: Nút Chương/Mục lục "Chg1_TongQuan")
-    # Thì mới dùng logic gộp điểm từ các con
-    kids = children_map.get(node, [])
-    
-    # Trường hợp cô lập (không con, không điểm)
-    if not kids:
-        memo_calc[node] = (0.0, False, None)
-        return 0.0, False, None
-
-    # Trường hợp là Nút Chương (Container) -> Tính trung bình các con
-    total_score = 0
-    all_kids_mastered = True
-    
-    for kid in kids:
-        s, m, _ = calculate_node_status(kid, threshold)
-        total_score += s
-        if not m: all_kids_mastered = False
-            
-    avg_score = total_score / len(kids) if kids else 0.0
-    is_mastered = all_kids_mastered
-    
-    memo_calc[node] = (avg_score, is_mastered, None)
-    return avg_score, is_mastered, None
-
-# Tính toán toàn bộ
-all_nodes = set(k_graph_df['source']).union(set(k_graph_df['target']))
-node_info_map = {} 
-
-# --- 👇 QUAN TRỌNG: PHẢI BỎ COMMENT ĐOẠN NÀY ĐỂ TÍNH TOÁN ---
-# --- 👇 QUAN TRỌNG: PHẢI BỎ COMMENT ĐOẠN NÀY ĐỂ TÍNH TOÁN ---
-for n in all_nodes:
-    node_info_map[n] = calculate_node_status(n, mastery_threshold)
-# ------------------------------------------------------------
+    db_k = key_index.resolve(graph_node_id, fuzzy="." in graph_node_id)
+    if db_k is None:
+        return None, None # Không tìm thấy
+    matched_keys_log[graph_node_id] = f"Exact: {db_k}" if db_k == graph_node_id else f"Smart Match: {db_k}"
+    return direct_scores[db_k], direct_status.get(db_k, "")
+
+# 1. Điểm riêng của từng node (Exact / Smart Match); node không có điểm = NaN
+own_scores = {}
+own_status = {}
+for n in subject_graph.nodes:
+    score, status = find_best_score_in_db(n)
+    if score is not None:
+        own_scores[n] = score
+        own_status[n] = status
+
+# 2. Nút Chương (không có điểm riêng) = trung bình các con, Đạt khi tất cả con Đạt
+all_nodes = set(subject_graph.nodes)
+node_status = aggregate_status(subject_graph, mastery_vector(subject_graph, own_scores), mastery_threshold)
+node_info_map = {n: (s, m, own_status.get(n)) for n, (s, m) in node_status.as_map().items()}
 
 # ============================================================
 # [NEW] GIAO DIỆN & XỬ LÝ DỮ LIỆU ĐỒ THỊ
@@ -317,74 +276,20 @@ show_mode = "Đầy đủ (+)"
 st.session_state.graph3_auto_expanded = True # Flag compatibility
 
 # --- GRAPH DATA GENERATION ---
+# [OPTIMIZATION] Chương, owner chapter, level zig-zag, spine, nhãn & hình dạng: tính 1 lần / phiên bản môn (graph_view)
+# Mỗi lần rerun chỉ tô màu theo điểm của user
+MAP_STYLE = {
+    "name": "do_thi",
+    "numbered": True,
+    "chapter": {"shape": "square", "size": 50, "font": "bold 40px arial black", "borderWidth": 6},
+    "lesson": {"shape": "dot", "size": 40, "font": {'size': 28, 'color': 'black'}, "borderWidth": 2},
+}
+graph_view = get_graph_view(subject_graph)
+graph_layout = graph_view.project() # show_mode luôn "Đầy đủ (+)"
+chapters = graph_view.chapter_set
+node_to_chapter = graph_view.node_to_chapter
 nodes = []
 edges = []
-added_nodes = set()
-node_to_chapter = {}
-
-# 1. Identify Chapters & Map Nodes
-# Re-using previous logic or simplified:
-all_graph_nodes = set(k_graph_df['source']).union(set(k_graph_df['target']))
-chapters = []
-for n in all_graph_nodes:
-     if "Chg" in str(n) or str(n).isdigit() or (len(str(n)) < 5 and "." not in str(n)):
-         chapters.append(str(n))
-
-# BFS/Map Logic to find owner chapter
-adj = defaultdict(list)
-for _, row in k_graph_df.iterrows():
-    adj[str(row['source'])].append(str(row['target']))
-
-for chap in chapters:
-    queue = [chap]
-    visited = set()
-    while queue:
-        curr = queue.pop(0)
-        if curr not in node_to_chapter: node_to_chapter[curr] = chap
-        if curr in adj:
-            for child in adj[curr]:
-                if child in chapters and child != chap: continue
-                if child not in visited:
-                    visited.add(child); queue.append(child)
-
-# 2. Sort Chapters
-import re
-try:
-    sorted_chapters = sorted(chapters, key=lambda x: int(re.search(r'\d+', x).group()))
-except: 
-    sorted_chapters = list(chapters)
-
-# 3. Determine Visibility
-visible_nodes = set()
-
-# Pre-check scores for filtering
-nodes_with_scores = set()
-for n in all_graph_nodes:
-    # Use existing node_info_map if available or re-calc
-    # We have node_info_map from line 285
-    # node_info_map[n] = (score, is_mastered, status)
-    if node_info_map.get(n, (None, False, None))[0] is not None:
-         nodes_with_scores.add(n)
-
-# Check active chapters (having any tested child)
-active_chapters = set()
-for n, c in node_to_chapter.items():
-    if n in nodes_with_scores:
-        active_chapters.add(c)
-
-for n in all_graph_nodes:
-    is_chap = n in chapters
-    if show_mode == "Đầy đủ (+)":
-        visible_nodes.add(n)
-    else:
-        # Rút gọn
-        if is_chap:
-            if n in active_chapters or n in nodes_with_scores:
-                visible_nodes.add(n)
-        elif n in nodes_with_scores:
-            visible_nodes.add(n)
-
-visible_chapters_ordered = [c for c in sorted_chapters if c in visible_nodes]
 
 # ============================================================
 # [NEW] LEARNING PATH VISUALIZATION (PHASE 6)
@@ -393,11 +298,15 @@ recommended_node = None
 try:
     # Calculate next recommended node for visualization
     # We use the same strict logic as the Practice Page
-    # Reuse user_mastery, k_graph_df, q_matrix_df loaded above
-    rec_target, _, _ = recommend_next_skill_strict(
-        user_mastery, k_graph_df, q_matrix_df, 
-        threshold=mastery_threshold
-    )
+    # Reuse user_mastery, subject_graph, question_index loaded above
+    if mastery_store is not None:
+        # Của chính mình: frontier gắn với mastery store (O(log N))
+        rec_target = get_skill_frontier(mastery_store, subject_graph, question_index, mastery_threshold).next()
+    else:
+        rec_target, _, _ = recommend_next_skill_strict(
+            user_mastery, subject_graph, question_index, 
+            threshold=mastery_threshold
+        )
     recommended_node = rec_target
     
     # [VISUALIZATION] Banner thông báo mục tiêu
@@ -427,110 +336,37 @@ except Exception as e:
     pass
 
 # 4. Create Nodes & Edges
-for idx, row in k_graph_df.iterrows():
-    src = str(row['source'])
-    tgt = str(row['target'])
+for spec in graph_view.node_specs(MAP_STYLE):
+    node = spec["id"]
+    score, is_mastered, status = node_info_map.get(node, (None, False, None))
     
-    final_src = None
-    if src in visible_nodes and tgt in visible_nodes:
-        final_src = src
-    elif src not in visible_nodes and tgt in visible_nodes:
-        owner_chap = node_to_chapter.get(tgt)
-        if owner_chap and owner_chap in visible_nodes:
-            final_src = owner_chap
-            
-    if final_src:
-        # Add Nodes
-        for node in [final_src, tgt]:
-            if node not in added_nodes:
-                score, is_mastered, status = node_info_map.get(node, (None, False, None))
-                
-                # Logic màu sắc (Đồng bộ)
-                color = "#CFD8DC" # Xám
-                if is_mastered:
-                    if score >= 1.0: color = "#00C853"
-                    elif score >= 0.85: color = "#69F0AE"
-                    else: color = "#B9F6CA"
-                elif status == "Review": color = "#FF5252"
-                elif score is not None and score > 0: color = "#FFD600"
-                
-                # --- [PHASE 6] HIGHLIGHT RECOMMENDED NODE ---
-                is_target = (node == recommended_node)
-                if is_target:
-                    # Target Style: Red Border + Pulse Effect (Simulated by width)
-                    borderColor = "#D50000" # Red
-                    borderWidth = 8
-                    shadow = {"enabled": True, "color": "#D50000", "size": 20}
-                    label_prefix = "🎯 "
-                    title_suffix = "\n🔥 BÀI TIẾP THEO (Recommended)"
-                else:
-                    borderColor = "#2c3e50"
-                    shadow = {"enabled": False}
-                    label_prefix = ""
-                    title_suffix = ""
-
-                # Style
-                is_chapter_node = node in chapters
-                label = label_prefix + node
-                
-                if is_chapter_node:
-                    num_match = re.search(r"\d+", node)
-                    num_str = num_match.group(0) if num_match else "?"
-                    label = f"{num_str}. {node}"
-                    shape = "square"
-                    size = 50 
-                    font = "bold 40px arial black" 
-                    if not is_target: borderWidth = 6 
-                else:
-                    shape = "dot"
-                    size = 40
-                    font = {'size': 28, 'color': 'black'} 
-                    if not is_target: borderWidth = 2 
-                
-                # Level
-                level = 0
-                try:
-                    owner_chap = node_to_chapter.get(node)
-                    c_idx = -1
-                    if owner_chap in visible_chapters_ordered:
-                        c_idx = visible_chapters_ordered.index(owner_chap)
-                    if c_idx != -1:
-                        level = c_idx * 2 if is_chapter_node else c_idx * 2 + 1
-                except: pass
-
-                nodes.append(Node(
-                    id=node,
-                    label=label,
-                    size=size,
-                    color=color,
-                    shape=shape,
-                    font=font,
-                    borderWidth=borderWidth,
-                    border_color=borderColor if is_target else None,
-                    shadow=shadow,
-                    title=f"{node}\nTiến độ: {score:.0%}{title_suffix}" if score is not None else node,
-                    level=level,
-                    shapeProperties={"borderRadius": 5} if shape=="box" else {}
-                ))
-                added_nodes.add(node)
-        
-        # Add Edge
-        w = 6 if final_src in chapters else 2 # [ZOOM 2x] 3->6, 1->2
-        edges.append(Edge(source=final_src, target=tgt, color="#bdc3c7", width=w))
-
-# 5. Spine
-visible_chapters_sorted = [c for c in sorted_chapters if c in added_nodes]
-num_spine = len(visible_chapters_sorted) - 1
-max_w, min_w = 24, 4 # [ZOOM 2x] 12->24, 2->4
-
-for i in range(num_spine):
-    c1 = visible_chapters_sorted[i]
-    c2 = visible_chapters_sorted[i+1]
+    # Logic màu sắc (Đồng bộ): bucket tính sẵn, "Cần ôn tập" phủ lên
+    color = node_status.color(node)
+    if not is_mastered and status == "Review": color = "#FF5252"
+    
+    node_kwargs = dict(spec, color=color, shadow={"enabled": False},
+                       title=f"{node}\nTiến độ: {score:.0%}" if score is not None else node)
     
-    decay = (max_w - min_w) * (i / (num_spine - 1)) if num_spine > 1 else 0
-    cur_w = max_w - decay
+    # --- [PHASE 6] HIGHLIGHT RECOMMENDED NODE ---
+    if node == recommended_node:
+        # Target Style: Red Border + Pulse Effect (Simulated by width)
+        node_kwargs.update(
+            borderWidth=8,
+            border_color="#D50000", # Red
+            shadow={"enabled": True, "color": "#D50000", "size": 20},
+            title=node_kwargs["title"] + "\n🔥 BÀI TIẾP THEO (Recommended)"
+        )
+        if node not in chapters: node_kwargs["label"] = "🎯 " + node
     
-    edges.append(Edge(source=c1, target=c2, color="#2979FF", width=int(cur_w), dashes=[15, 15]))
+    nodes.append(Node(**node_kwargs))
+
+for src, tgt in graph_layout.edges:
+    w = 6 if src in chapters else 2 # [ZOOM 2x] 3->6, 1->2
+    edges.append(Edge(source=src, target=tgt, color="#bdc3c7", width=w))
+
+# 5. Spine
+for (c1, c2), w in zip(graph_layout.spine, spine_widths(len(graph_layout.spine), 24, 4)): # [ZOOM 2x] 12->24, 2->4
+    edges.append(Edge(source=c1, target=c2, color="#2979FF", width=w, dashes=[15, 15]))
 
 
 # 1. CSS ĐỂ TẠO LAYOUT TRÀN MÀN HÌNH & THẺ NỔI
@@ -603,7 +439,7 @@ if st.session_state.keep_dialog_open:
 if selected_skill is None and st.session_state.last_selected_node is not None:
     st.session_state.last_selected_node = None
     st.session_state.graph_version += 1
-    st.cache_data.clear() # Xóa cache toàn bộ để đảm bảo dữ liệu mới nhất
+    # Điểm đã nằm trong mastery store, nội dung được cache theo content_version: không cần xóa cache
     st.toast("🔄 Đang làm mới đồ thị...", icon="🔄")
     st.rerun()
 
@@ -666,16 +502,11 @@ def show_node_details(node_id):
 
     # 1. Lấy dữ liệu
     s_score, s_mastered, _ = node_info_map.get(node_id, (0.0, False, None))
-    kids = children_map.get(node_id, [])
+    kids = subject_graph.children(node_id)
     
     # Lọc câu hỏi
-    if q_matrix_df is not None:
-        qs = q_matrix_df[q_matrix_df['skill_id_list'].astype(str).str.contains(node_id, na=False)]
-        qs = qs.reset_index(drop=True)
-        total_qs = len(qs)
-    else:
-        qs = pd.DataFrame()
-        total_qs = 0
+    qs = question_index.df.iloc[list(question_index.positions(node_id))].reset_index(drop=True)
+    total_qs = len(qs)
 
     # --- TABS (Sẽ hiển thị ngay trên cùng) ---
     tab_info, tab_theory, tab_practice = st.tabs(["📊 Tổng quan & Chỉ số", "📖 Lý thuyết", "📝 Luyện tập & Câu hỏi"])
@@ -944,10 +775,7 @@ def show_node_details(node_id):
                 )
 
                 # 2. Các lựa chọn
-                try:
-                    ops = ast.literal_eval(q_data["options"])
-                except Exception:
-                    ops = []
+                ops = question_options(q_data)
 
                 st.radio(
                     "Lựa chọn của bạn:",
@@ -1027,9 +855,10 @@ def show_node_details(node_id):
                                     subject_id=current_subject,
                                     node_id=node_id,
                                     user_mastery=direct_scores,
-                                    q_matrix_df=q_matrix_df,
+                                    q_matrix_df=question_index,
                                     mastery_threshold=mastery_threshold,
-                                    learning_rate=db_alpha
+                                    learning_rate=db_alpha,
+                                    mastery_store=mastery_store
                                 )
                                 # Update State
                                 direct_scores[node_id] = new_score
@@ -1067,14 +896,13 @@ def show_node_details(node_id):
 if selected_skill:
     show_node_details(selected_skill)
 
-# --- DEBUGGER (ẨN/HIỆN) ---
-# with st.expander("🔍 Debug Dữ liệu (Kiểm tra kết nối)"):
-#     st.write("**1. Dữ liệu trong Database (User Progress):**")
-#     st.write(db_keys)
-    
-#     st.write("**2. Kết quả khớp nối (Graph Node -> DB Key):**")
-#     st.json(matched_keys_log)
-    
-#     st.write("**3. Các Node trên cây không tìm thấy dữ liệu:**")
-#     unmatched = [n for n in all_nodes if n not in matched_keys_log and not children_map.get(n)]
-#     st.write(unmatched)
\ No newline at end of file
+# --- DEBUGGER: khớp nối Graph Node -> DB Key (chỉ Admin nội dung) ---
+if user_role == "admin":
+    key_report = key_index.report(n for n in subject_graph.nodes if not subject_graph.children(n))
+    with st.expander(f"🔍 Khớp nối dữ liệu: {len(key_report['unresolved_keys'])} key DB không thuộc node nào"):
+        st.write("**1. Key trong Database (User Progress) không khớp node nào trên cây:**")
+        st.write(key_report["unresolved_keys"])
+        st.write("**2. Kết quả khớp nối (Graph Node -> DB Key):**")
+        st.json(matched_keys_log)
+        st.write("**3. Các node lá trên cây không tìm thấy dữ liệu:**")
+        st.write(key_report["unresolved_nodes"])
@@ -1,7 +1,6 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import ast
 import os
 import sys
 import random
@@ -18,8 +17,16 @@ sys.path.append(parent_dir)
 from db_utils import (
     get_user_progress, save_progress, log_activity, 
     get_all_chapters, get_graph_structure, get_all_questions,
-    get_students_in_class, get_test_packet, get_all_subjects # [NEW]
+    get_students_in_class, get_test_packet, get_all_subjects, get_content_version, # [NEW]
+    get_user_settings
 )
+from data_prefetch import prefetch_page_data
+from mastery_store import get_mastery_store, mastery_store_needs_load
+from review_scheduler import review_due_at
+from subject_graph import get_subject_graph
+from question_index import get_question_index, question_options
+from mastery_vectors import chapter_means
+from graph_view import get_graph_view, spine_widths
 
 
 if "authentication_status" not in st.session_state or st.session_state["authentication_status"] is None:
@@ -148,7 +155,7 @@ st.markdown("""
 # ------------------------------------------------------------
 st.sidebar.title("📁 Chọn Môn Học")
 
-all_subs = get_all_subjects() 
+all_subs = get_all_subjects()
 if not all_subs:
     st.error("Chưa có môn học nào.")
     st.stop()
@@ -188,16 +195,8 @@ def get_smart_test_nodes(username, subject_id):
     progress = get_user_progress(username, subject_id)
     user_map = {r[0]: {'status': r[1], 'score': r[2]} for r in progress}
     
-    # Lấy cấu trúc cây
-    parents_map = {} # node -> [parents]
-    all_nodes = set()
-    
-    # Build graph map
-    for _, row in k_graph_df.iterrows():
-        src, tgt = str(row['source']), str(row['target'])
-        if tgt not in parents_map: parents_map[tgt] = []
-        parents_map[tgt].append(src)
-        all_nodes.add(src); all_nodes.add(tgt)
+    # Lấy cấu trúc cây (SubjectGraph: cha tra O(degree))
+    all_nodes = subject_graph.nodes
         
     target_nodes = set()
     
@@ -213,7 +212,7 @@ def get_smart_test_nodes(username, subject_id):
         if node in user_map and user_map[node]['score'] >= 0.8:
             continue
             
-        parents = parents_map.get(node, [])
+        parents = subject_graph.parents(node)
         if not parents: # Node gốc
             # Nếu chưa học node gốc -> Thêm vào
             if node not in user_map: target_nodes.add(node)
@@ -233,9 +232,10 @@ def get_smart_test_nodes(username, subject_id):
     return list(target_nodes)
 
 @st.cache_data
-def load_meta_data():
+def load_meta_data(subject_id, content_version):
+    # content_version chỉ để làm khóa cache: admin sửa môn nào thì chỉ môn đó tải lại
     # [OPTIMIZATION] Try loading from Test Packet first
-    packet = get_test_packet(current_subject)
+    packet = get_test_packet(subject_id)
     
     if packet and packet.get('questions'):
         # Reconstruct DataFrames from JSON Packet
@@ -273,71 +273,46 @@ def load_meta_data():
         
     else:
         # Fallback to DB
-        k_df = get_graph_structure(current_subject)
-        q_df = get_all_questions(current_subject)
+        k_df = get_graph_structure(subject_id)
+        q_df = get_all_questions(subject_id)
         chapters = get_all_chapters() 
 
-    # --- INDEXING (Cached) ---
-    # 1. Pre-parse skill_id_list
-    def safe_parse(x):
-        try:
-            if isinstance(x, list): return [str(s).strip() for s in x]
-            x = str(x).strip()
-            if x.startswith('['):
-                return [str(s).strip() for s in ast.literal_eval(x)]
-            return [x]
-        except:
-            return []
-            
-    if 'parsed_skills' not in q_df.columns:
-        q_df['parsed_skills'] = q_df['skill_id_list'].apply(safe_parse)
-        
-    # 2. Build Index: Skill -> List of Rows (dict)
-    s_index = {}
-    q_records = q_df.to_dict('records')
-    
-    for row in q_records:
-        for s in row['parsed_skills']:
-            if s not in s_index: s_index[s] = []
-            s_index[s].append(row)
-            
-    return k_df, q_df, chapters, s_index
+    return k_df, q_df, chapters
 
-k_graph_df, q_matrix_df, available_chapters, q_skill_index = load_meta_data()
+content_version = get_content_version(current_subject)
+# [OPTIMIZATION] Tải song song các đọc khởi tạo độc lập: Test Packet -> DataFrame, điểm (nếu mastery store cần nạp)
+page_data = prefetch_page_data({"progress"} if mastery_store_needs_load(username, current_subject) else set(),
+                               username, current_subject,
+                               extra={"meta": lambda: load_meta_data(current_subject, content_version)})
+k_graph_df, q_matrix_df, available_chapters = page_data.extra["meta"]
+get_mastery_store(username, current_subject, rows=page_data.progress)
+# [OPTIMIZATION] Đồ thị biên dịch 1 lần / content_version, dùng chung mọi session: cha/con O(degree)
+subject_graph = get_subject_graph(current_subject, k_graph_df)
+# Chỉ mục skill -> câu hỏi (khớp chính xác skill id, chia sẵn độ khó), dùng chung mọi session
+question_index = get_question_index(current_subject, q_matrix_df)
 
 # --- HELPER FUNCTIONS ---
 def load_local_data(username, subject_id):
     """Pre-load data into session state for offline/fast mode"""
     with st.spinner("📥 Đang tải dữ liệu bài thi (Offline Mode)..."):
-        progress = get_user_progress(username, subject_id)
+        # Bản sao điểm từ mastery store: kết quả trong bài thi chỉ ghi vào bản sao này
+        store = get_mastery_store(username, subject_id)
         st.session_state.local_data = {
-            "user_progress": progress, # List of tuples
+            "subject_id": subject_id,
+            "user_mastery": dict(store.scores), # {node_id: score}
             "loaded_at": datetime.now()
         }
 
 def get_user_mastery_map():
     # [OPTIMIZATION] Read from local_data if available
-    if "local_data" in st.session_state and "user_progress" in st.session_state.local_data:
-        raw = st.session_state.local_data["user_progress"]
-    else:
-        raw = get_user_progress(username, current_subject)
-    return {r[0]: r[2] for r in raw} if raw else {}
-
-@st.cache_data(ttl=3600) # Cache cấu trúc chương vì ít thay đổi
-def get_nodes_in_chapters(chapters_list):
-    """Lọc ra các node thuộc các chương đã chọn"""
-    all_nodes = set(k_graph_df['source']).union(set(k_graph_df['target']))
-    valid_nodes = set()
-    for n in all_nodes:
-        n_str = str(n)
-        import re
-        match = re.match(r"^(\d+)\.", n_str)
-        if match:
-            if int(match.group(1)) in chapters_list: valid_nodes.add(n_str)
-        elif n_str.startswith("Chg"): # Support Chg1 format
-             match = re.search(r"\d+", n_str)
-             if match and int(match.group(0)) in chapters_list: valid_nodes.add(n_str)
-    return valid_nodes
+    local = st.session_state.get("local_data", {})
+    if local.get("subject_id") == current_subject and "user_mastery" in local:
+        return local["user_mastery"]
+    return get_mastery_store(username, current_subject).scores
+
+def get_nodes_in_chapters(chapters_list, subject_id=None, content_version=None):
+    """Lọc ra các node thuộc các chương đã chọn ("1.x" / "Chg1"); chương -> node tính sẵn trong subject_graph"""
+    return subject_graph.nodes_in_chapters(chapters_list)
 
 # ============================================================
 # 1. LOGIC KIỂM TRA ĐẦU VÀO (DIAGNOSTIC)
@@ -351,24 +326,17 @@ def generate_diagnostic_test():
     
     for chap in chapters:
         # Tìm các node thuộc chương này
-        nodes = get_nodes_in_chapters([chap])
+        nodes = get_nodes_in_chapters([chap], current_subject, content_version)
         if not nodes: continue
         
-        # [OPTIMIZED] Use q_skill_index instead of Loop
-        candidates = []
-        for node in nodes:
-            found_qs = q_skill_index.get(str(node), [])
-            candidates.extend(found_qs)
-            
-        # Deduplicate by ID
-        unique_cands = {c['question_id']: c for c in candidates}.values()
-        candidates = list(unique_cands)
+        # [OPTIMIZED] question_index: skill -> vị trí câu hỏi (set: tự loại trùng)
+        candidates = sorted({pos for node in nodes for pos in question_index.positions(node)})
         
         # Chọn 1 câu ngẫu nhiên (ưu tiên độ khó Medium)
         if candidates:
             # Thử tìm medium
-            mediums = [c for c in candidates if str(c.get('difficulty')).lower() == 'medium']
-            chosen = random.choice(mediums) if mediums else random.choice(candidates)
+            mediums = [pos for pos in candidates if question_index.levels[pos] == 'medium']
+            chosen = question_index.record(random.choice(mediums) if mediums else random.choice(candidates))
             
             questions.append({
                 "q_data": chosen,
@@ -399,13 +367,13 @@ def check_stopping_condition(history, limit_min=10, limit_max=50):
 # 2. LOGIC KIỂM TRA THÍCH ỨNG (SMART CAT - GRAPH TRAVERSAL)
 # ============================================================
 
-def get_parents(node, k_df):
-    return k_df[k_df['target'] == str(node)]['source'].tolist()
+def get_parents(node, graph):
+    return graph.parents(node)
 
-def get_children(node, k_df):
-    return k_df[k_df['source'] == str(node)]['target'].tolist()
+def get_children(node, graph):
+    return graph.children(node)
 
-def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None):
+def get_strategic_question(history, user_map, k_graph, q_index, valid_nodes_pool=None):
     """
     Chiến lược chọn câu hỏi thông minh dựa trên đồ thị:
     1. EXPLORATION (Đầu trận): Khảo sát ngẫu nhiên các nhánh khác nhau.
@@ -415,11 +383,17 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None)
     """
     # 0. Setup
     if user_map is None: user_map = get_user_mastery_map()
-    hist_q_ids = [h['q_id'] for h in history]
-    
-    # Filter available questions (exclude history)
-    available_qs = q_df[~q_df['question_id'].isin(hist_q_ids)].copy()
-    if available_qs.empty: return None, None, "Hết ngân hàng câu hỏi"
+    hist_q_ids = {h['q_id'] for h in history}
+
+    def is_unused(pos):
+        return q_index.question_ids[pos] not in hist_q_ids
+
+    def unused(positions):
+        # Exclude history
+        return [p for p in positions if is_unused(p)]
+
+    # Còn câu chưa làm? (any() dừng ngay ở câu đầu tiên tìm thấy)
+    if not any(qid not in hist_q_ids for qid in q_index.question_ids): return None, None, "Hết ngân hàng câu hỏi"
 
     # --- STRATEGY SELECTION ---
     target_node = None
@@ -450,7 +424,7 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None)
         if not last_correct:
             # ---> REMEDIATION: Backtrack to Parent
             strategy_name = "Remediation"
-            parents = get_parents(last_node, k_df)
+            parents = get_parents(last_node, k_graph)
             if parents:
                 # Pick a parent that is strictly NOT Mastered yet (or weak)
                 weak_parents = [p for p in parents if user_map.get(p, 0.5) < 0.8]
@@ -468,7 +442,7 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None)
         
         else:
             # ---> PROGRESSION: Move to Children or Harder
-            children = get_children(last_node, k_df)
+            children = get_children(last_node, k_graph)
             # Filter children that are IN SCOPE (if valid_nodes_pool is strict, but here we want expansion)
             # Let's verify children exist in our world
             # valid_children = [c for c in children if c in valid_nodes_pool] if valid_nodes_pool else children
@@ -491,17 +465,12 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None)
     # 1. Try finding Q for specific target_node
     if target_node:
         target_node_s = str(target_node)
-        # Use Index
-        raw_candidates = q_skill_index.get(target_node_s, [])
-        # Filter already taken
-        candidates = [r for r in raw_candidates if r['question_id'] not in hist_q_ids]
-        
-        # Filter by difficulty
-        diff_matches = [r for r in candidates if str(r.get('difficulty', 'medium')).lower() == difficulty_target]
-        final_pool = diff_matches if diff_matches else candidates
+        # Use Index (exact skill id), filter already taken
+        # Difficulty buckets tính sẵn; fallback (hard -> medium -> any) giống engine luyện tập
+        final_pool, _ = q_index.clad_pool(target_node_s, difficulty_target, keep=is_unused)
         
         if final_pool:
-            chosen = random.choice(final_pool)
+            chosen = q_index.record(random.choice(final_pool))
             return chosen, target_node_s, f"{strategy_name} ({difficulty_target})"
 
     # 2. Fallback: If no target node found or empty pool -> General Adaptive (IRT-ish)
@@ -515,21 +484,18 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None)
         random.shuffle(shuffled_nodes)
         
         for node in shuffled_nodes[:5]: # Try 5 nodes max
-            qs = q_skill_index.get(str(node), [])
-            valid_qs = [q for q in qs if q['question_id'] not in hist_q_ids]
+            valid_qs = unused(q_index.positions(node))
             
             if valid_qs:
-                chosen = random.choice(valid_qs)
+                chosen = q_index.record(random.choice(valid_qs))
                 return chosen, str(node), "Fallback"
 
     # 3. Last Resort: Random from available
-    if not available_qs.empty: # q_df passed in is 'available_qs' but we used index.
-                               # Actually get_strategic_question passes 'q_matrix_df' usually.
-                               # available_qs calculated at line 277 is a DF.
-        # Just pick ONE from available_qs dataframe
-        rand_row = available_qs.sample(1).iloc[0].to_dict()
+    available = unused(range(len(q_index)))
+    if available:
+        rand_row = q_index.record(random.choice(available))
         # Use parsed skills
-        skills = rand_row.get('parsed_skills', [])
+        skills = rand_row['parsed_skills']
         rand_skill = skills[0] if skills else "General"
         
         return rand_row, rand_skill, "Random"
@@ -548,14 +514,14 @@ def prepare_speculative_next(valid_nodes, full_history, current_skill, current_q
     
     # Append simulated result
     sim_hist_corr = full_history + [{"q_id": current_q_id, "skill": current_skill, "is_correct": True}]
-    q_corr, s_corr, _ = get_strategic_question(sim_hist_corr, map_correct, k_graph_df, q_matrix_df, valid_nodes)
+    q_corr, s_corr, _ = get_strategic_question(sim_hist_corr, map_correct, subject_graph, question_index, valid_nodes)
     
     # 2. Scenario Incorrect
     map_incorr = user_map.copy()
     map_incorr[current_skill] = 0.0
     
     sim_hist_inc = full_history + [{"q_id": current_q_id, "skill": current_skill, "is_correct": False}]
-    q_inc, s_inc, _ = get_strategic_question(sim_hist_inc, map_incorr, k_graph_df, q_matrix_df, valid_nodes)
+    q_inc, s_inc, _ = get_strategic_question(sim_hist_inc, map_incorr, subject_graph, question_index, valid_nodes)
     
     return {
         True: (q_corr, s_corr) if q_corr is not None else None,
@@ -585,8 +551,8 @@ if 'test_session' not in st.session_state:
 ts = st.session_state.test_session
 
 # Kiểm tra User mới hay cũ
-user_progress_data = get_user_progress(username, current_subject)
-is_new_user = len(user_progress_data) == 0
+# [OPTIMIZATION] Đọc từ mastery store của session thay vì query DB mỗi lần rerun
+is_new_user = len(get_mastery_store(username, current_subject)) == 0
 
 # [FIX] AUTO-RESET SESSION IF USER CHANGED OR INVALID STATE
 # 1. Ownership Check
@@ -660,7 +626,7 @@ if not ts["active"] and not st.session_state.get("show_result", False):
             if st.button("Bắt đầu Kiểm tra Đầu vào", type="primary", use_container_width=True):
                 # [MODIFIED] Switch to CAT Mode
                 # Load all chapters as target scope
-                all_nodes = get_nodes_in_chapters(available_chapters)
+                all_nodes = get_nodes_in_chapters(available_chapters, current_subject, content_version)
                 
                 st.session_state.test_session.update({
                     "active": True,
@@ -876,18 +842,18 @@ elif ts["active"]: # [FIX] Chỉ chạy khi Active = True
                  # Scope: target_nodes OR all chapters
                  valid_nodes = set(ts.get("target_nodes", []))
                  if not valid_nodes: 
-                     valid_nodes = get_nodes_in_chapters(available_chapters)
+                     valid_nodes = get_nodes_in_chapters(available_chapters, current_subject, content_version)
                  
                  # [OPTIMIZATION] If diagnostic_cat, maybe force Exploration Strategy logic inside get_strategic_question?
                  # For now, get_strategic_question's "Exploration" (history < 5) works well.
                      
             else: # Standard (Manual)
-                valid_nodes = get_nodes_in_chapters(ts["selected_chapters"])
+                valid_nodes = get_nodes_in_chapters(ts["selected_chapters"], current_subject, content_version)
             
             # Use cached index approach implicitly via get_strategic_question optimizations?
-            # Wait, get_strategic_question was optimized to use q_skill_index inside? Yes.
+            # Wait, get_strategic_question was optimized to use question_index inside? Yes.
             
-            q, s, msg = get_strategic_question(ts["history"], None, k_graph_df, q_matrix_df, valid_nodes)
+            q, s, msg = get_strategic_question(ts["history"], None, subject_graph, question_index, valid_nodes)
             
             if q is None: # Hết câu hỏi
                 ts["active"] = False
@@ -918,9 +884,9 @@ elif ts["active"]: # [FIX] Chỉ chạy khi Active = True
                 # Xác định valid_nodes
                 if ts["mode"] == "smart_cat":
                     v_nodes = set(ts["target_nodes"])
-                    if not v_nodes: v_nodes = get_nodes_in_chapters(available_chapters)
+                    if not v_nodes: v_nodes = get_nodes_in_chapters(available_chapters, current_subject, content_version)
                 else:
-                    v_nodes = get_nodes_in_chapters(ts["selected_chapters"])
+                    v_nodes = get_nodes_in_chapters(ts["selected_chapters"], current_subject, content_version)
                 
                 # Gọi hàm tính toán
                 ts["speculative_next"] = prepare_speculative_next(v_nodes, ts["history"], current_skill, current_q_data['question_id'])
@@ -953,10 +919,8 @@ elif ts["active"]: # [FIX] Chỉ chạy khi Active = True
         st.session_state.test_session = st.session_state.test_session # Force update
         
         # 2. UPDATE LOCAL DATA
-        if "local_data" in st.session_state and ts["mode"] != "diagnostic":
-            st.session_state.local_data["user_progress"].append(
-                (current_skill, 'Completed', 1.0 if is_correct else 0.0, datetime.now())
-            )
+        if "user_mastery" in st.session_state.get("local_data", {}) and ts["mode"] != "diagnostic":
+            st.session_state.local_data["user_mastery"][current_skill] = 1.0 if is_correct else 0.0
 
         # 3. LOG TO DB
         try:
@@ -975,11 +939,11 @@ elif ts["active"]: # [FIX] Chỉ chạy khi Active = True
                 # Fallback logic
                 if ts["mode"] in ["smart_cat", "diagnostic_cat"]:
                     valid_nodes = set(ts.get("target_nodes", []))
-                    if not valid_nodes: valid_nodes = get_nodes_in_chapters(available_chapters)
+                    if not valid_nodes: valid_nodes = get_nodes_in_chapters(available_chapters, current_subject, content_version)
                 else:
-                    valid_nodes = get_nodes_in_chapters(ts["selected_chapters"])
+                    valid_nodes = get_nodes_in_chapters(ts["selected_chapters"], current_subject, content_version)
                 
-                nq, ns, nmsg = get_strategic_question(ts["history"], None, k_graph_df, q_matrix_df, valid_nodes)
+                nq, ns, nmsg = get_strategic_question(ts["history"], None, subject_graph, question_index, valid_nodes)
                 if nq:
                     ts["next_q"] = (nq, ns)
         
@@ -1019,8 +983,7 @@ elif ts["active"]: # [FIX] Chỉ chạy khi Active = True
         </div>
         """, unsafe_allow_html=True)
         
-        try: ops = ast.literal_eval(current_q_data['options'])
-        except: ops = []
+        ops = question_options(current_q_data) # Parse sẵn trong question index
         
         # Check Mode
         submitted = ts.get("answer_submitted", False)
@@ -1177,19 +1140,21 @@ if st.session_state.get("show_result", False):
                 import sqlite3
                 conn = sqlite3.connect('local_course.db') 
                 c = conn.cursor()
+                unlock_threshold = get_user_settings(username, current_subject)[0]
                 
                 for chap in correct_chapters:
                     # Lấy tất cả node thuộc chương này
-                    nodes = get_nodes_in_chapters([chap])
+                    nodes = get_nodes_in_chapters([chap], current_subject, content_version)
                     for n in nodes:
                         # Chỉ update nếu chưa có điểm
                         try:
                             timestamp = datetime.now()
                             # Set điểm 0.8 (Màu xanh) cho các bài thuộc chương đã pass
                             c.execute('''
-                                INSERT OR IGNORE INTO user_progress (username, node_id, subject_id, status, score, timestamp)
-                                VALUES (?, ?, ?, ?, ?, ?)
-                            ''', (username, n, current_subject, 'Completed', 0.8, timestamp))
+                                INSERT OR IGNORE INTO user_progress (username, node_id, subject_id, status, score, timestamp, due_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)
+                            ''', (username, n, current_subject, 'Completed', 0.8, timestamp,
+                                  review_due_at('Completed', 0.8, timestamp, unlock_threshold)))
                             count_updated += 1
                         except: pass
                 
@@ -1248,257 +1213,54 @@ if st.session_state.get("show_result", False):
             skill = h.get('skill')
             if skill: current_map[skill] = 0.9 if h['is_correct'] else 0.4
             
-        added_nodes = set()
-        
-        # [FEATURE] SMART RE-WIRING (Gắn nhánh rời vào Chương)
-        # 1. Build map: Node -> Owner Chapter
-        node_to_chapter = {}
-        # Find all chapters first
-        all_graph_nodes = set(k_graph_df['source']).union(set(k_graph_df['target']))
-        chapters = []
-        for n in all_graph_nodes:
-             if "Chg" in str(n) or str(n).isdigit() or (len(str(n)) < 5 and "." not in str(n)):
-                 chapters.append(str(n))
-        
-        # BFS to assign chapter
-        # Build adjacency
-        adj = {}
-        for _, row in k_graph_df.iterrows():
-            s, t = str(row['source']), str(row['target'])
-            if s not in adj: adj[s] = []
-            adj[s].append(t)
-            
-        for chap in chapters:
-            queue = [chap]
-            visited = set()
-            while queue:
-                curr = queue.pop(0)
-                if curr not in node_to_chapter:
-                    node_to_chapter[curr] = chap
-                
-                if curr in adj:
-                    for child in adj[curr]:
-                        # [FIX] Stop if we hit another Chapter!
-                        # This prevents Chg1 from claiming Chg2's children.
-                        if child in chapters and child != chap:
-                             continue
-                             
-                        if child not in visited:
-                            visited.add(child)
-                            queue.append(child)
+        # [OPTIMIZATION] Chương, owner chapter (BFS), level zig-zag, spine: cache theo phiên bản môn (graph_view)
+        graph_view = get_graph_view(subject_graph)
+        chapters = graph_view.chapter_set
+        node_to_chapter = graph_view.node_to_chapter
 
         # [FEATURE] CHAPTER AGGREGATION (Tính điểm trung bình cho Chương)
-        chapter_agg_map = {}
-        for chap in chapters:
-            # Find all nodes belonging to this chapter (from node_to_chapter)
-            # OR better: Traverse graph again? No, node_to_chapter is populated now.
-            # But node_to_chapter only has *children*, not the chapter itself.
-            
-            # Find all children of this chapter
-            children = [n for n, c in node_to_chapter.items() if c == chap]
-            
-            # Calculate stats
-            total_tested = 0
-            total_score = 0
-            for child in children:
-                s = current_map.get(child, -1)
-                if s != -1:
-                    total_tested += 1
-                    total_score += s
-            
-            if total_tested > 0:
-                avg_score = total_score / total_tested
-                chapter_agg_map[chap] = avg_score
+        # -1 = Chương chưa có node nào được kiểm tra
+        chapter_agg_map = chapter_means(node_to_chapter, current_map)
+
+        # Pre-calculate visibility (None = Đầy đủ: layout dùng chung, không tính lại)
+        visible_nodes = None
+        if show_mode != "Đầy đủ (+)":
+            # Rút gọn: ONLY Tested Nodes AND Active Chapters
+            visible_nodes = {n for n in subject_graph.nodes if current_map.get(n, -1) != -1}
+            visible_nodes.update(c for c in chapters if chapter_agg_map.get(c, -1) != -1)
+
+        # Compact levels / re-wiring (Src ẩn -> nối từ Chương) nằm trong graph_view.project
+        graph_layout = graph_view.project(visible_nodes)
+        result_style = {
+            "name": "test_result",
+            "numbered": True,
+            "chapter": {"shape": "square", "size": 25, "borderWidth": 3, "font": {'size': 24}},
+            "lesson": {"shape": "dot", "size": 20, "borderWidth": 1, "font": {'size': 14}},
+        }
+        for spec in graph_view.node_specs(result_style, visible_nodes):
+            node = spec["id"]
+            score = current_map.get(node, -1)
+            if node in chapters:
+                # [FEATURE] OVERRIDE CHAPTER COLOR based on Aggregation
+                score_for_color = chapter_agg_map.get(node, -1)
             else:
-                chapter_agg_map[chap] = -1 # Not tested
+                score_for_color = score
 
-        # [RESTORED] SMART LEAF PLACEMENT & SPINE LOGIC
-        # 1. Sort Chapters for X-Axis placement
-        import re
-        sorted_chapters = []
-        try:
-             sorted_chapters = sorted(chapters, key=lambda x: int(re.search(r'\d+', x).group()))
-        except: 
-             sorted_chapters = list(chapters)
-             
-        # Map Chapter -> X Coordinate
-        chapter_x = {}
-        spacing_x = 300 # Distance between chapters
-        for i, chap in enumerate(sorted_chapters):
-             chapter_x[chap] = i * spacing_x
-
-        # 2. Add Nodes & Edges
-        # Pre-calculate visibility
-        visible_nodes = set()
-        for n in all_graph_nodes:
-            is_chap = n in chapters
-            if show_mode == "Đầy đủ (+)":
-                visible_nodes.add(n)
-            else:
-                # Rút gọn: ONLY Tested Nodes AND Active Chapters
-                has_score = current_map.get(n, -1) != -1
-                
-                keep_chapter = False
-                if is_chap:
-                    # Check if chapter has any tested children (via agg map)
-                    # If chapter itself has score or agg_score is present
-                    agg_score = chapter_agg_map.get(n, -1)
-                    if agg_score != -1 or has_score:
-                        keep_chapter = True
-                
-                if keep_chapter or (not is_chap and has_score):
-                    visible_nodes.add(n)
-
-        # [FIX] Pre-calculate visible chapters for Compact Leveling
-        # Identifying valid chapters that are in visible_nodes
-        # This allows us to assign Level 0, 2, 4... consecutively even if Ch 2 is missing.
-        visible_chapters_ordered = [c for c in sorted_chapters if c in visible_nodes]
-        for idx, row in k_graph_df.iterrows():
-            src = str(row['source'])
-            tgt = str(row['target'])
-            
-            # Logic:
-            # Case 1: Both Visible -> Draw Edge
-            # Case 2: Src Hidden, Tgt Visible -> Draw Edge (Chapter -> Tgt)
-            
-            final_src = None
-            if src in visible_nodes and tgt in visible_nodes:
-                final_src = src
-            elif src not in visible_nodes and tgt in visible_nodes:
-                # Re-wire to Chapter
-                owner_chap = node_to_chapter.get(tgt)
-                if owner_chap and owner_chap in visible_nodes:
-                    final_src = owner_chap
-            
-            if final_src:
-                # Add nodes if not added
-                for node in [final_src, tgt]:
-                    if node not in added_nodes:
-                        score = current_map.get(node, -1)
-                        
-                        # COLOR
-                        if score >= 0.7: color = "#00C853"
-                        elif score >= 0.5: color = "#FFD600"
-                        elif score >= 0.0: color = "#FF5252"
-                        else: color = "#CFD8DC"
-                        
-                        # [FEATURE] OVERRIDE CHAPTER COLOR based on Aggregation
-                        if node in chapters:
-                            agg_score = chapter_agg_map.get(node, -1)
-                            if agg_score != -1:
-                                if agg_score >= 0.7: color = "#00C853" # Green
-                                elif agg_score >= 0.5: color = "#FFD600" # Orange
-                                else: color = "#FF5252" # Red
-                            else:
-                                # [FIX] User wants Gray for untested chapters
-                                color = "#CFD8DC"
-                        
-                        # STYLE & SHAPE
-                        # User wants: Circular nodes for chapters with Number inside.
-                        # Distinct from leaves.
-                        
-                        import re
-                        is_chapter_node = node in chapters
-                        label = node
-                        font = {"color": "black"} # Default
-                        
-                        if is_chapter_node:
-                             # 1. Parse Number
-                             num_match = re.search(r"\d+", node)
-                             num_str = num_match.group(0) if num_match else "?"
-                             
-                             # [FIX] Label = Number + Name (Outside)
-                             # Shape 'square' puts label outside.
-                             label = f"{num_str}. {node}" 
-                             shape = "square" # [FIX] Square shape (label defaults to outside)
-                             size = 25 # Fixed size for square
-                             
-                             # Custom font for BOLD effect
-                             # Vis.js allows shorthand string for font to set weight
-                             font = "bold 20px arial black" # [FIX] Bold font string
-                        
-                        else:
-                             # Leaf
-                             # [FIX] User wants Circular nodes always
-                             shape = "dot" 
-                             size = 20
-                        # Forces Ch1 -> Leftmost.
-                        # Logic: Chapter i is Level 2*i. Children are Level 2*i + 1.
-                        # [FIX] Use VISIBLE chapters only to avoid gaps in Condensed Mode
-                        level = 0
-                        try:
-                            owner_chap = node_to_chapter.get(node)
-                            # Identify visible order
-                            # We need to compute visible_chapters dynamically or assume based on added_nodes (which is filling up)
-                            # Safe approach: Use original index but 'compress' if mode is Rút gọn?
-                            # Actually, Graphviz/VisJS handles gaps fine, but for spine we need exact connections.
-                            # For Level: Keeping original index is safer for stability, gaps are okay.
-                            
-                            # [FIX] Compact Leveling Logic
-                            # Use the index from 'visible_chapters_ordered' instead of global 'sorted_chapters'
-                            # This removes the empty space where hidden chapters would be.
-                            
-                            c_idx = -1
-                            if owner_chap in visible_chapters_ordered:
-                                c_idx = visible_chapters_ordered.index(owner_chap)
-                                
-                            if c_idx != -1:
-                                if is_chapter_node:
-                                    level = c_idx * 2
-                                else:
-                                    level = c_idx * 2 + 1
-                        except: pass
+            # COLOR
+            if score_for_color >= 0.7: color = "#00C853"
+            elif score_for_color >= 0.5: color = "#FFD600"
+            elif score_for_color >= 0.0: color = "#FF5252"
+            else: color = "#CFD8DC" # [FIX] Gray for untested
 
-                        # Create Node
-                        node_kwargs = {
-                            "id": node, 
-                            "label": label, 
-                            "size": size, 
-                            "color": color, 
-                            "shape": shape, 
-                            "title": f"{node}\nĐiểm: {score:.0%}",
-                            "borderWidth": 3 if is_chapter_node else 1,
-                            "font": {'size': 24} if is_chapter_node else {'size': 14}, # Bigger Font -> Bigger Box
-                            "shapeProperties": {"borderRadius": 5} if is_chapter_node and shape == "box" else {},
-                            "level": level # [FIX] Force Hierarchy Level
-                        }
-                        
-                        # [REVERT] No manual fixing, let Hierarchical Engine handle it
-                            
-                        nodes.append(Node(**node_kwargs))
-                        added_nodes.add(node)
-                
-                # Add Edge
-                # [FIX] Thicker edges for Chapter -> Child (Root-like)
-                edge_width = 1
-                if final_src in chapters:
-                    edge_width = 3
-                
-                edges.append(Edge(source=final_src, target=tgt, color="#bdc3c7", width=edge_width))
+            nodes.append(Node(**spec, color=color, title=f"{node}\nĐiểm: {score:.0%}"))
 
-        # [FEATURE] FORCE SPINE EDGES (Connect Ch1->Ch2->Ch3)
-        # [FIX] Smart Spine: Connect CONSECUTIVE VISIBLE chapters
-        # Gather visible chapters in order
-        visible_chapters_sorted = [c for c in sorted_chapters if c in added_nodes]
-        
-        num_spine_edges = len(visible_chapters_sorted) - 1
-        max_width = 12
-        min_width = 2
-        
-        for i in range(num_spine_edges):
-            c1 = visible_chapters_sorted[i]
-            c2 = visible_chapters_sorted[i+1]
-            
-            # [FIX] Tapered Width Logic
-            # Width decreases linearly from max_width to min_width
-            if num_spine_edges > 1:
-                decay = (max_width - min_width) * (i / (num_spine_edges - 1))
-                current_width = max_width - decay
-            else:
-                current_width = max_width
-            
-            # [FIX] Thicker Spine + Tapered
-            edges.append(Edge(source=c1, target=c2, color="#2979FF", width=int(current_width), dashes=[15, 15]))
+        for src, tgt in graph_layout.edges:
+            # [FIX] Thicker edges for Chapter -> Child (Root-like)
+            edges.append(Edge(source=src, target=tgt, color="#bdc3c7", width=3 if src in chapters else 1))
+
+        # [FEATURE] FORCE SPINE EDGES: consecutive visible chapters, tapered width
+        for (c1, c2), w in zip(graph_layout.spine, spine_widths(len(graph_layout.spine), 12, 2)):
+            edges.append(Edge(source=c1, target=c2, color="#2979FF", width=w, dashes=[15, 15]))
         
         # [DEBUG] Check data validity
         if not nodes:
@@ -12,7 +12,7 @@ sys.path.append(parent_dir)
 # Import các hàm từ db_utils
 # Đã thêm 'import_content_from_docx' vào danh sách import
 from db_utils import (
-    get_all_questions, add_question, delete_question, 
+    get_all_questions, add_question, delete_question, clear_content_caches,
     get_graph_structure, add_edge, delete_edge, 
     save_resource, get_resource,
     import_knowledge_structure, import_questions_bank, 
@@ -43,7 +43,7 @@ all_subjects = get_all_subjects() # Returns list of tuples (id, name)
 # Self-healing: If no subjects found, try clearing cache once (in case of stale cache after creation)
 if not all_subjects and "subject_retry" not in st.session_state:
     st.session_state["subject_retry"] = True
-    st.cache_data.clear()
+    get_all_subjects.clear()
     st.rerun()
 
 subject_options = [s[0] for s in all_subjects]
@@ -76,7 +76,7 @@ with col_create:
 col_cache, _ = st.columns([1, 5])
 with col_cache:
     if st.button("🔄 Xóa Cache Hệ thống", type="secondary", help="Xóa bộ nhớ đệm để cập nhật dữ liệu mới nhất từ Database"):
-        st.cache_data.clear()
+        clear_content_caches()
         st.toast("Đã xóa cache thành công!", icon="🧹")
 
 # --- TABS GIAO DIỆN ---
@@ -116,8 +116,7 @@ with tab1:
                     # Kiểm tra cột
                     if 'source' in df.columns and 'target' in df.columns:
                         success, msg = import_knowledge_structure(df, selected_subject)
-                        if success: 
-                            st.cache_data.clear() # Clear cache to show new data
+                        if success: # content_version của môn đã tăng -> chỉ môn này tải lại
                             st.success(msg)
                         else: st.error(msg)
                     else:
@@ -145,8 +144,7 @@ with tab1:
                     # Check sơ bộ
                     if 'question_id' in df.columns:
                         success, msg = import_questions_bank(df, selected_subject)
-                        if success: 
-                            st.cache_data.clear() # Clear cache to show new data
+                        if success: # content_version của môn đã tăng -> chỉ môn này tải lại
                             st.success(msg)
                         else: st.error(msg)
                     else: st.error("File thiếu cột 'question_id'")
@@ -337,7 +335,6 @@ with tab5: # Wait, I need to define tab5 in the tabs list unpacking
                 success, msg = delete_subject_content(target_subj)
                 if success:
                     st.success(msg)
-                    st.cache_data.clear()
                     time.sleep(1)
                     st.rerun()
                 else:
@@ -16,6 +16,9 @@ from db_utils import (
     get_all_users_list, get_all_questions,
     get_student_classes
 )
+from subject_graph import get_subject_graph
+from mastery_vectors import class_status
+from graph_view import get_graph_view
 
 st.set_page_config(page_title="Quản lý Lớp học", page_icon="🏫", layout="wide")
 
@@ -309,6 +312,15 @@ else:
             for user, score in weakest_students.items():
                 st.warning(f"**{user}**: {score:.1%} (Trung bình)")
     
+        # --- Tiến độ theo Chương (cả lớp trong 1 lượt gộp NumPy) ---
+        class_graph = get_subject_graph(target_subject)
+        if class_graph.levels:
+            tree_status = class_status(class_graph, df_matrix, 0.7)
+            # Cột = các Chương (Chg1, Chg2, ...), không phải gốc của đồ thị: các chương nối thành chuỗi nên chỉ có 1 gốc
+            chapter_df = tree_status.frame(get_graph_view(class_graph).sorted_chapters)
+            with st.expander("🌳 Tiến độ theo Chương (gộp theo cây tri thức)"):
+                st.dataframe(chapter_df.style.background_gradient(cmap='RdYlGn', axis=None, vmin=0, vmax=1).format("{:.0%}"), use_container_width=True)
+
         # 5. Xem chi tiết dạng bảng
         with st.expander("📋 Xem dữ liệu thô (Excel)"):
             st.dataframe(df_matrix.style.background_gradient(cmap='RdYlGn', axis=None), use_container_width=True)
\ No newline at end of file
@@ -2,7 +2,6 @@ import streamlit as st
 import pandas as pd
 import sys
 import os
-import ast
 
 # --- SETUP PATHS ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -12,8 +11,10 @@ sys.path.append(parent_dir)
 from db_utils import (
     get_connection, execute_query, 
     get_all_subjects, 
-    add_question, add_edge
+    add_question, add_edge,
+    bump_content_version, publish_content_versions
 )
+from question_index import parse_options, options_json
 
 st.set_page_config(page_title="Admin Import Data", page_icon="📥", layout="wide")
 
@@ -122,8 +123,10 @@ with tab_struct:
                         
                         progress_bar.progress((idx + 1) / total)
                     
+                    bumped = bump_content_version(conn, selected_subject_id)
                     conn.commit()
                     conn.close()
+                    publish_content_versions(bumped)
                     
                     st.success(f"✅ Đã import {count_ok} cạnh. Lỗi: {count_err}")
                     if logs:
@@ -179,14 +182,13 @@ with tab_quest:
                             diff = str(row.get('difficulty', 'Medium')).strip()
                             exp = str(row.get('explanation', '')).strip()
                             
-                            # Validate Options format (List string)
-                            try:
-                                dummy = ast.literal_eval(options_raw)
-                                if not isinstance(dummy, list): raise ValueError("Options not a list")
-                            except:
+                            # Validate Options format (List string) -> lưu chuẩn hoá dạng mảng JSON
+                            options_list = parse_options(options_raw)
+                            if not options_list:
                                 logs.append(f"Row {idx} (QID: {q_id}): Format Options sai. Phải là list ['A...', 'B...'].")
                                 count_err += 1
                                 continue
+                            options_raw = options_json(options_list)
                             
                             # Insert/Update
                             # First delete if exist to update
@@ -205,8 +207,10 @@ with tab_quest:
                         
                         progress_bar.progress((idx + 1) / total)
                     
+                    bumped = bump_content_version(conn, selected_subject_id)
                     conn.commit()
                     conn.close()
+                    publish_content_versions(bumped)
                     
                     st.success(f"✅ Đã import {count_ok} câu hỏi. Lỗi: {count_err}")
                     if logs:
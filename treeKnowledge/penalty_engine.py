@@ -0,0 +1,106 @@
+"""
+Multi-hop prerequisite penalty (GAKT).
+
+A wrong answer on a node penalizes its whole ancestor closure, attenuated with
+the hop distance: penalty * decay^(d - 1), d = 1 for direct parents (so they
+keep the full penalty, as before) and decay = 0 is the old parents-only rule.
+
+The closure is a sparse (nodes x ancestors) matrix of hop distances, built by
+one vectorized BFS over the parent CSR of a compiled SubjectGraph and cached
+per graph (i.e. per subject content_version):
+
+    m = get_ancestor_matrix(subject_graph)
+    m.penalties("3.4", 0.15, decay=0.5)   # {"3.2": 0.15, "3.1": 0.075, "Chg3": 0.0375}
+"""
+import threading
+import weakref
+
+import numpy as np
+
+PENALTY_DECAY = 0.5
+PENALTY_MAX_HOPS = 8  # 0.5^7 < 0.01: deeper ancestors would not move a score
+
+
+class AncestorMatrix:
+    """CSR rows: ancestors of node i are idx[ptr[i]:ptr[i + 1]] at hops[...] (nearest first)."""
+
+    def __init__(self, graph, max_hops=PENALTY_MAX_HOPS):
+        self.graph = graph
+        n = len(graph)
+        parent_ptr = np.asarray(graph._parent_ptr, dtype=np.int64)
+        parent_idx = np.asarray(graph._parent_idx, dtype=np.int64)
+        degree = np.diff(parent_ptr)
+
+        # Frontier of (source, node) pairs for every source at once; key = source * n + node
+        src = cur = np.arange(n, dtype=np.int64)
+        seen = src * n + cur  # Self excluded (cycles lead back to the source)
+        rows, cols, hops = [], [], []
+        for hop in range(1, max_hops + 1):
+            counts = degree[cur]
+            total = int(counts.sum())
+            if not total:
+                break
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            nxt = parent_idx[np.repeat(parent_ptr[cur], counts) + offsets]
+            key = np.unique(np.repeat(src, counts) * n + nxt)
+            key = key[~np.isin(key, seen, assume_unique=True)]
+            if not len(key):
+                break
+            seen = np.union1d(seen, key)
+            src, cur = key // n, key % n
+            rows.append(src); cols.append(cur); hops.append(np.full(len(key), hop, dtype=np.int8))
+
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.int64)
+        hops = np.concatenate(hops) if hops else np.empty(0, dtype=np.int8)
+        order = np.lexsort((cols, hops, rows))
+        self.idx = cols[order]
+        self.hops = hops[order]
+        self.ptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=n))))
+
+    def __len__(self):
+        return len(self.idx)
+
+    def ancestors(self, node_id):
+        """[(ancestor_id, hops)] nearest first."""
+        i = self.graph.index.get(str(node_id))
+        if i is None:
+            return []
+        lo, hi = self.ptr[i], self.ptr[i + 1]
+        return [(self.graph.ids[j], int(h)) for j, h in zip(self.idx[lo:hi].tolist(), self.hops[lo:hi].tolist())]
+
+    def penalties(self, node_id, penalty, decay=PENALTY_DECAY):
+        """{ancestor_id: penalty * decay^(hops - 1)} (zero amounts dropped)."""
+        i = self.graph.index.get(str(node_id))
+        if i is None:
+            return {}
+        lo, hi = self.ptr[i], self.ptr[i + 1]
+        amounts = penalty * np.power(float(decay), self.hops[lo:hi] - 1.0)
+        keep = amounts > 0
+        ids = self.graph.ids
+        return {ids[j]: a for j, a in zip(self.idx[lo:hi][keep].tolist(), amounts[keep].tolist())}
+
+
+# ============================================================
+# 🗂️ PROCESS CACHE (one matrix per compiled graph = per subject version)
+# ============================================================
+
+_matrices = weakref.WeakKeyDictionary()
+_matrices_lock = threading.Lock()
+
+
+def get_ancestor_matrix(graph):
+    matrix = _matrices.get(graph)
+    if matrix is None:
+        with _matrices_lock:
+            matrix = _matrices.get(graph)
+            if matrix is None:
+                matrix = AncestorMatrix(graph)
+                _matrices[graph] = matrix
+    return matrix
+
+
+def ancestor_penalties(subject_id, node_id, penalty, decay=PENALTY_DECAY):
+    """penalties() of node_id on the current compiled graph of subject_id."""
+    from subject_graph import get_subject_graph # Lazy: subject_graph imports db_utils
+    return get_ancestor_matrix(get_subject_graph(subject_id)).penalties(node_id, penalty, decay)
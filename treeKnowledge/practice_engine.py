@@ -1,69 +1,66 @@
-import ast
 import random
-from collections import defaultdict
-import heapq
 
 from db_utils import (
     get_user_progress, save_progress, get_all_questions,
     get_graph_structure, log_activity,
     apply_forgetting_decay, penalize_parents,
-    get_connection
+    get_mastered_question_ids, unit_of_work
 )
+from subject_graph import get_subject_graph, as_subject_graph
+from question_index import as_question_index, clad_level, options_json, question_options
+from skill_frontier import SkillFrontier, explain_choice
 
 # =========================================================================================
 # 1. CORE ENGINE (Knowledge Graph & Question Selection)
 # =========================================================================================
 
-def load_practice_context(username, subject_id):
-    """Dùng chung cho cả tab Luyện tập và Đồ thị tri thức."""
+def load_practice_context(username, subject_id, mastery_store=None):
+    """
+    Dùng chung cho cả tab Luyện tập và Đồ thị tri thức.
+    mastery_store: dùng điểm trong session (không đọc lại DB mỗi lần rerun).
+    """
     k_graph_df = get_graph_structure(subject_id)
     q_matrix_df = get_all_questions(subject_id)
+    if mastery_store is not None:
+        return k_graph_df, q_matrix_df, mastery_store.scores
     raw_progress = get_user_progress(username, subject_id)
     user_mastery = {row[0]: row[2] for row in raw_progress} if raw_progress else {}
     return k_graph_df, q_matrix_df, user_mastery
 
 def get_strict_topological_order(k_graph):
-    adj_list = defaultdict(list)
-    in_degree = defaultdict(int)
-    all_nodes = set(k_graph['source']).union(set(k_graph['target']))
-
-    for node in all_nodes:
-        in_degree[node] = 0
-    for _, row in k_graph.iterrows():
-        u, v = row['source'], row['target']
-        adj_list[u].append(v)
-        in_degree[v] += 1
-
-    min_heap = []
-    for node in all_nodes:
-        if in_degree[node] == 0:
-            heapq.heappush(min_heap, node)
-
-    topo_order = []
-    while min_heap:
-        u = heapq.heappop(min_heap)
-        topo_order.append(u)
-        for v in adj_list[u]:
-            in_degree[v] -= 1
-            if in_degree[v] == 0:
-                heapq.heappush(min_heap, v)
-
-    if len(topo_order) < len(all_nodes):
-        rem = list(all_nodes - set(topo_order))
-        topo_order.extend(sorted(rem))
-    return topo_order
-
+    """k_graph: SubjectGraph (thứ tự đã tính sẵn) hoặc DataFrame cạnh."""
+    return list(as_subject_graph(k_graph).topo_order)
 
 def has_q(skill, q_matrix_df):
-    return not q_matrix_df[q_matrix_df['skill_id_list'].str.contains(skill, na=False, regex=False)].empty
+    """q_matrix_df: QuestionIndex (khớp chính xác skill id, O(1)) hoặc DataFrame câu hỏi."""
+    return as_question_index(q_matrix_df).has(skill)
 
 
+def get_skill_frontier(mastery_store, graph, question_index, threshold):
+    """
+    SkillFrontier gắn với mastery store của session: store.apply() cập nhật nó tại chỗ,
+    nên gợi ý node tiếp theo là O(log N) thay vì duyệt lại cả lộ trình mỗi lần rerun.
+    """
+    key = ("frontier", graph.subject_id, graph.content_version, question_index.content_version, threshold)
+    frontier = mastery_store.derived.get(key)
+    if frontier is None:
+        # Nội dung / ngưỡng đổi -> bỏ frontier cũ
+        for old in [k for k in mastery_store.derived if k[0] == "frontier"]:
+            del mastery_store.derived[old]
+        frontier = mastery_store.derived[key] = SkillFrontier(graph, question_index, mastery_store.scores, threshold)
+    return frontier
+
 def recommend_next_skill_strict(user_mastery, k_graph_df, q_matrix_df, threshold, exclude_id=None):
     """
     Trả về (target_skill, strategy_msg, debug_log)
-    -> Tab Luyện tập dùng cái này để biết hôm nay học node nào.
+    -> Duyệt toàn bộ lộ trình (debug_log chi tiết từng node). Trong trang có mastery store
+       thì dùng get_skill_frontier(...).recommend() (cùng kết quả, O(log N)).
+    k_graph_df: nên truyền SubjectGraph (get_subject_graph) để tra cha O(degree).
+    q_matrix_df: nên truyền QuestionIndex (get_question_index).
     """
-    learning_path = get_strict_topological_order(k_graph_df)
+    graph = as_subject_graph(k_graph_df)
+    q_index = as_question_index(q_matrix_df)
+    learning_path = graph.topo_order
     debug_log = []
     target = None
     strat = ""
@@ -75,15 +72,15 @@ def recommend_next_skill_strict(user_mastery, k_graph_df, q_matrix_df, threshold
             debug_log.append(f"✅ {node}: Đã xong ({score:.0%}) → Bỏ qua.")
             continue
 
-        if not has_q(node, q_matrix_df):
+        if not q_index.has(node):
             debug_log.append(f"⏭️ {node}: Không có câu hỏi → Bỏ qua.")
             continue
 
-        parents = k_graph_df[k_graph_df['target'] == node]['source'].tolist()
+        parents = graph.parents(node)
         is_locked = False
         locked_by = None
         for p in parents:
-            if has_q(p, q_matrix_df) and user_mastery.get(p, 0.0) < threshold:
+            if q_index.has(p) and user_mastery.get(p, 0.0) < threshold:
                 is_locked = True
                 locked_by = p
                 break
@@ -95,23 +92,7 @@ def recommend_next_skill_strict(user_mastery, k_graph_df, q_matrix_df, threshold
         target = node
         
         # --- XAI LOGIC ---
-        reason_code = "NEW"
-        reason_desc = "Đây là bài học tiếp theo trong lộ trình."
-        
-        if score > 0:
-            reason_code = "DECAY"
-            reason_desc = f"Kiến thức đang bị hao mòn ({score:.0%}). Cần ôn tập lại ngay!"
-        else:
-            reason_code = "NEW"
-            if parents:
-                 # Check if parents are strongly mastered
-                 strong_parents = [p for p in parents if user_mastery.get(p,0) >= 0.8]
-                 if len(strong_parents) == len(parents):
-                     reason_desc = "Bạn đã nắm vững kiến thức nền. Đã sẵn sàng học bài mới!"
-                 else:
-                     reason_desc = "Đã đủ điều kiện qua môn. Tiếp tục tiến lên!"
-            else:
-                 reason_desc = "Bắt đầu hành trình với bài học đầu tiên."
+        reason_code, reason_desc = explain_choice(node, user_mastery, parents)
 
         strat = {
             "name": "Strict Tree",
@@ -130,100 +111,60 @@ def recommend_next_skill_strict(user_mastery, k_graph_df, q_matrix_df, threshold
 
 def pick_question_for_skill(skill_id, q_matrix_df, current_mastery=0.0, last_question_id=None, shuffle=True):
     """Lấy 1 câu hỏi cho skill_id, có tính đến độ khó (CLAD)."""
-    qs = q_matrix_df[q_matrix_df['skill_id_list'].str.contains(skill_id, na=False, regex=False)]
-    if qs.empty:
+    q_index = as_question_index(q_matrix_df)
+    positions = q_index.positions(skill_id)
+    if not positions:
         return None
 
     # Tránh lặp lại ngay
-    if last_question_id and len(qs) > 1:
-        qs2 = qs[qs['question_id'] != last_question_id]
-        if not qs2.empty:
-            qs = qs2
+    skip = set()
+    if last_question_id and len(positions) > 1:
+        skip = {p for p in positions if q_index.question_ids[p] == last_question_id}
+        if len(skip) == len(positions):
+            skip = set()
 
     # --- CLAD: Difficulty Control ---
-    # Phân loại độ khó dựa trên Mastery hiện tại
-    # Quy ước DB: 1/Easy/Dễ, 2/Medium/TB, 3/Hard/Khó
-    target_diffs = []
-    if current_mastery < 0.4:
-        target_diffs = ['1', 'Easy', 'De', 'Dễ']        # Mới học -> Dễ
-    elif current_mastery < 0.7:
-        target_diffs = ['2', 'Medium', 'TB', 'Trung bình', 'Normal'] # Đang học -> Vừa
-    else:
-        target_diffs = ['3', 'Hard', 'Kho', 'Khó', 'Advanced']     # Thành thạo -> Khó
-
-    final_q = None
-    
-    # Thử tìm câu hỏi có độ khó phù hợp
-    if 'difficulty' in qs.columns:
-        # Case-insensitive check
-        qs_filtered = qs[qs['difficulty'].astype(str).str.strip().str.lower().isin([d.lower() for d in target_diffs])]
-        
-        if not qs_filtered.empty:
-            final_q = qs_filtered.sample(1).iloc[0]
-        else:
-            # Fallback 1: Nếu master cao mà ko có câu khó -> Lấy câu TB
-            if current_mastery >= 0.7:
-                fallback_diffs = ['2', 'Medium', 'TB', 'Trung bình', 'Normal']
-                qs_fb = qs[qs['difficulty'].astype(str).str.strip().str.lower().isin([d.lower() for d in fallback_diffs])]
-                if not qs_fb.empty: final_q = qs_fb.sample(1).iloc[0]
-
-    # Fallback cuối cùng: Random trong tập còn lại (hoặc toàn bộ qs)
-    if final_q is None:
-        final_q = qs.sample(1).iloc[0]
-
-    q_dict = final_q.to_dict()
-
-    if shuffle:
-        try:
-            ops_list = ast.literal_eval(q_dict['options'])
-            true_ans = str(q_dict['answer']).strip().upper()
-
-            parsed_items = []
-            valid_format = True
-            for op in ops_list:
-                parts = op.split('.', 1)
-                if len(parts) < 2:
-                    valid_format = False
-                    break
-                label = parts[0].strip().upper()
-                content = parts[1].strip()
-                is_target = (label == true_ans)
-                parsed_items.append({"content": content, "is_target": is_target})
-
-            if valid_format and parsed_items:
-                random.shuffle(parsed_items)
-                labels = ['A', 'B', 'C', 'D', 'E', 'F']
-                new_ops_list = []
-                new_ans_char = true_ans
-
-                for idx, item in enumerate(parsed_items):
-                    lab = labels[idx] if idx < len(labels) else str(idx)
-                    new_ops_list.append(f"{lab}. {item['content']}")
-                    if item['is_target']:
-                        new_ans_char = lab
-
-                q_dict['options'] = str(new_ops_list)
-                q_dict['answer'] = new_ans_char
-        except Exception:
-            pass
+    # Độ khó mục tiêu theo Mastery hiện tại; bucket tính sẵn trong index, fallback chung với CAT (clad_pool)
+    candidates, _ = q_index.clad_pool(skill_id, clad_level(current_mastery), keep=lambda p: p not in skip)
+
+    pos = random.choice(candidates)
+    q_dict = q_index.record(pos)
+
+    # Đảo đáp án trên (label, content) đã tách sẵn trong index: không parse lại
+    choices = q_index.choices[pos]
+    if shuffle and choices:
+        order = random.sample(range(len(choices)), len(choices))
+        labels = ['A', 'B', 'C', 'D', 'E', 'F']
+        new_ops_list = []
+        new_ans_char = str(q_dict['answer']).strip().upper()
+        for idx, k in enumerate(order):
+            lab = labels[idx] if idx < len(labels) else str(idx)
+            new_ops_list.append(f"{lab}. {choices[k][1]}")
+            if k == q_index.answer_idx[pos]:
+                new_ans_char = lab
+
+        q_dict['option_list'] = new_ops_list
+        q_dict['options'] = options_json(new_ops_list)
+        q_dict['answer'] = new_ans_char
 
     return q_dict
 
+def progress_status(score, mastery_threshold):
+    return "Completed" if score >= mastery_threshold else ("Review" if score <= 0.3 else "In Progress")
+
 def grade_and_update(
     q_data, selected_option, username, subject_id, node_id,
     user_mastery, q_matrix_df, mastery_threshold, learning_rate,
-    duration=0.0, strategy_info=None
+    duration=0.0, strategy_info=None, mastery_store=None
 ):
     """
     Trả về:
       is_correct, new_score, correct_answer_text, status
     và đồng thời cập nhật DB + log_activity + penalize_parents + FASS.
+    mastery_store: sau khi commit, cập nhật luôn điểm node + cha trong session (write-through).
     """
-    # 1. Parse options & check
-    try:
-        ops = ast.literal_eval(q_data['options'])
-    except Exception:
-        ops = []
+    # 1. Options (đã parse sẵn trong index) & check
+    ops = question_options(q_data)
 
     # --- IMPROVED ROBUST GRADING LOGIC ---
     try:
@@ -273,60 +214,59 @@ def grade_and_update(
     old_score = user_mastery.get(node_id, 0.0)
 
     # A. Tổng số câu trong kho cho node_id
-    skill_qs = q_matrix_df[q_matrix_df['skill_id_list'].str.contains(node_id, na=False, regex=False)]
-    all_question_ids = set(skill_qs['question_id'].unique())
+    all_question_ids = as_question_index(q_matrix_df).question_ids_for(node_id)
     total_questions_in_bank = len(all_question_ids)
 
-    if is_correct:
-        # Lấy danh sách câu đã làm đúng từ DB (Postgres)
-        conn = get_connection()
-        if conn:
-            c = conn.cursor()
-            try:
-                c.execute("""
-                SELECT DISTINCT question_id FROM learning_logs
-                WHERE username = %s AND subject_id = %s AND node_id = %s AND is_correct = 1
-                """, (username, subject_id, node_id))
-                answered_correctly_ids = {row[0] for row in c.fetchall()}
-            except Exception:
-                answered_correctly_ids = set()
-            finally:
-                conn.close()
-        else:
-            answered_correctly_ids = set()
+    att = 1.0 if is_correct else 0.0
+    new_score = (1 - learning_rate) * old_score + learning_rate * att
 
-        answered_correctly_ids.add(q_data['question_id'])
-        valid_correct_count = len(answered_correctly_ids.intersection(all_question_ids))
+    # B. Đọc câu đã đúng + phạt cha + lưu điểm + log: 1 kết nối, 1 transaction, 1 commit
+    parent_updates = {}
+    saved = False
+    try:
+        with unit_of_work() as conn:
+            if conn is None: raise RuntimeError("Lỗi kết nối DB")
+            if is_correct:
+                # Lấy danh sách câu đã làm đúng từ DB (Postgres)
+                answered_correctly_ids = get_mastered_question_ids(username, subject_id, node_id, conn=conn, question_ids=all_question_ids)
 
-        # LOGIC MỚI: Nếu làm đúng hết câu hỏi trong ngân hàng -> 100% (Completed)
-        if valid_correct_count >= total_questions_in_bank and total_questions_in_bank > 0:
-            new_score = 1.0 # Set max score
-        else:
-            att = 1.0
-            new_score = (1 - learning_rate) * old_score + learning_rate * att
+                answered_correctly_ids.add(q_data['question_id'])
+                valid_correct_count = len(answered_correctly_ids.intersection(all_question_ids))
 
-        # reset FASS flag ở phía UI (caller sẽ set)
-    else:
-        att = 0.0
-        new_score = (1 - learning_rate) * old_score + learning_rate * att
-        # phạt cha (GAKT)
-        penalize_parents(username, subject_id, node_id, penalty_factor=0.15)
-
-    status = "Completed" if new_score >= mastery_threshold else ("Review" if new_score <= 0.3 else "In Progress")
-    save_progress(username, node_id, subject_id, status, new_score)
-
-    # log
-    log_activity(
-        username=username,
-        action_type='practice',
-        subject_id=subject_id,
-        node_id=node_id,
-        question_id=q_data['question_id'],
-        is_correct=is_correct,
-        duration_seconds=duration,
-        details=strategy_info
-    )
+                # LOGIC MỚI: Nếu làm đúng hết câu hỏi trong ngân hàng -> 100% (Completed)
+                if valid_correct_count >= total_questions_in_bank and total_questions_in_bank > 0:
+                    new_score = 1.0 # Set max score
 
+                # reset FASS flag ở phía UI (caller sẽ set)
+            else:
+                # phạt cha + các tiền đề xa hơn, giảm dần theo số bước (GAKT)
+                parent_updates = penalize_parents(username, subject_id, node_id, penalty_factor=0.15, conn=conn, threshold=mastery_threshold)
+
+            status = progress_status(new_score, mastery_threshold)
+            save_progress(username, node_id, subject_id, status, new_score, conn=conn, threshold=mastery_threshold)
+
+            # log
+            log_activity(
+                username=username,
+                action_type='practice',
+                subject_id=subject_id,
+                node_id=node_id,
+                question_id=q_data['question_id'],
+                is_correct=is_correct,
+                duration_seconds=duration,
+                details=strategy_info,
+                conn=conn
+            )
+        saved = True
+    except Exception as e:
+        # Transaction đã rollback (không ghi nửa vời); kết quả chấm vẫn trả về cho UI
+        print(f"Grade Save Error: {e}")
+
+    status = progress_status(new_score, mastery_threshold)
+    if saved and mastery_store is not None:
+        mastery_store.apply(node_id, status, new_score)
+        for p_node, (p_status, p_score) in parent_updates.items():
+            mastery_store.apply(p_node, p_status, p_score)
     return is_correct, new_score, correct_answer_text, status
 
 
@@ -340,23 +280,14 @@ def get_smart_test_nodes(username, subject_id, k_graph_df=None):
     1. Tìm Frontier Nodes (Cha đã xong, con chưa xong).
     2. Tìm Review Nodes (Cần ôn tập).
     """
-    if k_graph_df is None:
-        k_graph_df = get_graph_structure()
+    graph = get_subject_graph() if k_graph_df is None else as_subject_graph(k_graph_df)
         
     # 1. Lấy dữ liệu
     progress = get_user_progress(username, subject_id)
     user_map = {r[0]: {'status': r[1], 'score': r[2]} for r in progress}
     
-    # Lấy cấu trúc cây
-    parents_map = {} # node -> [parents]
-    all_nodes = set()
-    
-    # Build graph map
-    for _, row in k_graph_df.iterrows():
-        src, tgt = str(row['source']), str(row['target'])
-        if tgt not in parents_map: parents_map[tgt] = []
-        parents_map[tgt].append(src)
-        all_nodes.add(src); all_nodes.add(tgt)
+    # Lấy cấu trúc cây (SubjectGraph: cha tra O(degree))
+    all_nodes = graph.nodes
         
     target_nodes = set()
     
@@ -372,7 +303,7 @@ def get_smart_test_nodes(username, subject_id, k_graph_df=None):
         if node in user_map and user_map[node]['score'] >= 0.8:
             continue
             
-        parents = parents_map.get(node, [])
+        parents = graph.parents(node)
         if not parents: # Node gốc
             # Nếu chưa học node gốc -> Thêm vào
             if node not in user_map: target_nodes.add(node)
@@ -407,11 +338,11 @@ def check_stopping_condition(history, limit_min=10, limit_max=50):
         
     return False
 
-def get_parents(node, k_df):
-    return k_df[k_df['target'] == str(node)]['source'].tolist()
+def get_parents(node, k_graph):
+    return as_subject_graph(k_graph).parents(node)
 
-def get_children(node, k_df):
-    return k_df[k_df['source'] == str(node)]['target'].tolist()
+def get_children(node, k_graph):
+    return as_subject_graph(k_graph).children(node)
 
 def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None):
     """
@@ -422,20 +353,28 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None)
     4. FRONTIER (Mặc định): Đánh vào vùng biên kiến thức.
     """
     # 0. Setup
-    hist_q_ids = [h['q_id'] for h in history]
-    
-    # Filter available questions (exclude history)
-    # Filter available questions (exclude history)
-    available_qs = q_df[~q_df['question_id'].isin(hist_q_ids)].copy()
-    
+    graph = as_subject_graph(k_df)
+    q_index = as_question_index(q_df)
+    hist_q_ids = {h['q_id'] for h in history}
+
+    def is_unused(pos):
+        return q_index.question_ids[pos] not in hist_q_ids
+
+    def unused(positions):
+        # Exclude history
+        return [p for p in positions if is_unused(p)]
+
     # --- CRITICAL FIX: STRICT SCOPE ENFORCEMENT ---
     if valid_nodes_pool:
-        # Only allow questions belonging to nodes in the pool
-        # Using simple string check for list-like column
-        pattern = '|'.join([str(n) for n in valid_nodes_pool])
-        available_qs = available_qs[available_qs['skill_id_list'].str.contains(pattern, na=False, regex=True)]
+        # Only allow questions belonging to nodes in the pool (exact skill match via the index)
+        scope = set()
+        for n in valid_nodes_pool:
+            scope.update(q_index.positions(n))
+        available = unused(sorted(scope))
+    else:
+        available = unused(range(len(q_index)))
         
-    if available_qs.empty: return None, None, "Hết ngân hàng câu hỏi (Scope Limit)"
+    if not available: return None, None, "Hết ngân hàng câu hỏi (Scope Limit)"
 
     # --- STRATEGY SELECTION ---
     target_node = None
@@ -466,7 +405,7 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None)
         if not last_correct:
             # ---> REMEDIATION: Backtrack to Parent
             strategy_name = "Remediation"
-            parents = get_parents(last_node, k_df)
+            parents = get_parents(last_node, graph)
             if parents:
                 # Pick a parent that is strictly NOT Mastered yet (or weak)
                 weak_parents = [p for p in parents if user_map.get(p, 0.5) < 0.8]
@@ -484,7 +423,7 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None)
         
         else:
             # ---> PROGRESSION: Move to Children or Harder
-            children = get_children(last_node, k_df)
+            children = get_children(last_node, graph)
             
             # Prioritize children that are NOT Mastered
             unmastered_children = [c for c in children if user_map.get(c, 0.0) < 0.7]
@@ -504,17 +443,12 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None)
     if target_node:
         target_node_s = str(target_node)
         
-        # Filter available by skill
-        candidates = available_qs[available_qs['skill_id_list'].str.contains(target_node_s, na=False)]
+        # Exact skill lookup, difficulty buckets pre-split in the index (same fallback as practice)
+        final_pool, _ = q_index.clad_pool(target_node_s, difficulty_target, keep=is_unused)
         
-        if not candidates.empty:
-            # Filter by difficulty
-            diff_matches = candidates[candidates['difficulty'].astype(str).str.lower() == difficulty_target]
-            final_pool = diff_matches if not diff_matches.empty else candidates
-            
-            if not final_pool.empty:
-                chosen = final_pool.sample(1).iloc[0].to_dict()
-                return chosen, target_node_s, f"{strategy_name} ({difficulty_target})"
+        if final_pool:
+            chosen = q_index.record(random.choice(final_pool))
+            return chosen, target_node_s, f"{strategy_name} ({difficulty_target})"
 
     # 2. Fallback: If no target node found or empty pool -> General Adaptive
     if valid_nodes_pool:
@@ -523,18 +457,17 @@ def get_strategic_question(history, user_map, k_df, q_df, valid_nodes_pool=None)
         random.shuffle(shuffled_nodes)
         
         for node in shuffled_nodes[:5]: # Try 5 nodes max
-            candidates = available_qs[available_qs['skill_id_list'].str.contains(str(node), na=False)]
+            candidates = unused(q_index.positions(node))
             
-            if not candidates.empty:
-                chosen = candidates.sample(1).iloc[0].to_dict()
+            if candidates:
+                chosen = q_index.record(random.choice(candidates))
                 return chosen, str(node), "Fallback"
 
     # 3. Last Resort: Random from available
-    if not available_qs.empty:
-        rand_row = available_qs.sample(1).iloc[0].to_dict()
+    if available:
+        rand_row = q_index.record(random.choice(available))
         # Use parsed skills
-        # Just grab random skill string from the list if possible, or "General"
-        skills_str = str(rand_row.get('skill_id_list', 'General'))
-        return rand_row, skills_str, "Random Last Resort"
+        skills = rand_row['parsed_skills']
+        return rand_row, (skills[0] if skills else "General"), "Random Last Resort"
 
     return None, None, "Hết câu hỏi"
@@ -0,0 +1,229 @@
+"""
+Exact skill -> question inverted index over one subject's question bank.
+
+skill_id_list is parsed once ("1.1", '["1.1", "1.2"]', "['1.1']"), so lookups
+are O(1) and exact: "1.1" no longer matches "1.10" or "1.1_KhaiNiem" the way
+str.contains did. Difficulty is normalized once into a small-int code
+(difficulty_level: unknown / easy / medium / hard) and every skill's
+questions are pre-split by level, so CLAD picks are bucket lookups with one
+fallback order shared by the practice and CAT engines (clad_pool).
+Options are parsed once too: option_list (display strings), choices
+((label, content) pairs) and answer_idx, so serving / shuffling / grading a
+question does no literal_eval.
+
+    idx = get_question_index(subject_id)
+    idx.has("1.2")
+    idx.positions("1.2", "easy")   # row positions in idx.df
+    idx.clad_pool("1.2", clad_level(0.8))  # hard -> medium -> any
+    idx.record(pos)                # fresh dict of that row (safe to mutate)
+"""
+import ast
+import json
+import threading
+from array import array
+
+import pandas as pd
+
+from db_utils import get_all_questions, get_content_version
+
+DIFFICULTY_LEVELS = ("easy", "medium", "hard")
+LEVEL_NAMES = ("unknown",) + DIFFICULTY_LEVELS  # index = small-int code (0 = không rõ)
+LEVEL_CODES = {level: code for code, level in enumerate(LEVEL_NAMES)}
+
+# CLAD: bucket cạn thì lùi về mức gần Medium, cuối cùng mới lấy mọi câu của skill
+CLAD_FALLBACK = {
+    "easy": ("easy", "medium"),
+    "medium": ("medium",),
+    "hard": ("hard", "medium"),
+}
+
+# Quy ước DB: 1/Easy/Dễ, 2/Medium/TB, 3/Hard/Khó
+_DIFFICULTY_ALIASES = {
+    "easy": ("1", "easy", "de", "dễ"),
+    "medium": ("2", "medium", "tb", "trung bình", "normal"),
+    "hard": ("3", "hard", "kho", "khó", "advanced"),
+}
+_LEVEL_OF = {alias: level for level, aliases in _DIFFICULTY_ALIASES.items() for alias in aliases}
+
+
+def difficulty_level(raw):
+    """'Dễ' / '1' / 'Easy' -> 'easy' (None if unknown)."""
+    if raw is None:
+        return None
+    return _LEVEL_OF.get(str(raw).strip().lower())
+
+
+def clad_level(mastery):
+    """CLAD target level from the current mastery of the skill."""
+    if mastery < 0.4:
+        return "easy"    # Mới học -> Dễ
+    if mastery < 0.7:
+        return "medium"  # Đang học -> Vừa
+    return "hard"        # Thành thạo -> Khó
+
+
+def parse_skills(raw):
+    """skill_id_list cell -> [skill ids] (a single id or a JSON / Python list literal)."""
+    if raw is None:
+        return []
+    if isinstance(raw, (list, tuple)):
+        return [str(s).strip() for s in raw if str(s).strip()]
+    text = str(raw).strip()
+    if not text or text.lower() == "nan":
+        return []
+    if text.startswith("["):
+        for parse in (json.loads, ast.literal_eval):
+            try:
+                return [str(s).strip() for s in parse(text) if str(s).strip()]
+            except Exception:
+                continue
+        return []
+    return [text]
+
+
+def parse_options(raw):
+    """options cell (JSON array / Python list literal / list) -> [option strings]; [] if not a list."""
+    if raw is None:
+        return []
+    if isinstance(raw, (list, tuple)):
+        return [str(o) for o in raw]
+    text = str(raw).strip()
+    if not text.startswith("["):
+        return []
+    for parse in (json.loads, ast.literal_eval):
+        try:
+            return [str(o) for o in parse(text)]
+        except Exception:
+            continue
+    return []
+
+
+def split_options(options):
+    """["A. x", "B. y"] -> (("A", "x"), ("B", "y")); None if an option has no "label." prefix."""
+    choices = []
+    for op in options:
+        parts = op.split('.', 1)
+        if len(parts) < 2:
+            return None
+        choices.append((parts[0].strip().upper(), parts[1].strip()))
+    return tuple(choices) or None
+
+
+def options_json(options):
+    """Normalized storage form of the options column (JSON array)."""
+    return json.dumps(list(options), ensure_ascii=False)
+
+
+def question_options(q):
+    """Display options of a question dict / row: pre-parsed option_list if present, else parsed now."""
+    ops = q.get("option_list")
+    if isinstance(ops, (list, tuple)):
+        return list(ops)
+    return parse_options(q.get("options"))
+
+
+class QuestionIndex:
+    """Read-only after construction: shared by every session (record() hands out copies)."""
+
+    def __init__(self, q_df, subject_id=None, content_version=None):
+        self.subject_id = subject_id
+        self.content_version = content_version
+        self.df = q_df.reset_index(drop=True)
+
+        records = self.df.to_dict("records")
+        self._records = records
+        self.question_ids = tuple(r.get("question_id") for r in records)
+        self.skills = tuple(tuple(parse_skills(r.get("skill_id_list"))) for r in records)
+        self.levels = tuple(difficulty_level(r.get("difficulty")) for r in records)
+        self.level_codes = array("b", (LEVEL_CODES.get(level, 0) for level in self.levels))
+        self.options = tuple(tuple(parse_options(r.get("options"))) for r in records)
+        self.choices = tuple(split_options(ops) for ops in self.options)
+        self.answer_idx = tuple(self._answer_index(self.choices[pos], r.get("answer")) for pos, r in enumerate(records))
+        if len(self.df):
+            self.df["option_list"] = list(self.options)
+            self.df["difficulty_level"] = pd.Categorical.from_codes(self.level_codes.tolist(), categories=LEVEL_NAMES)
+
+        by_skill = {}
+        by_level = {}
+        for pos, skills in enumerate(self.skills):
+            level = self.levels[pos]
+            for skill in dict.fromkeys(skills):  # A row lists a skill once
+                by_skill.setdefault(skill, []).append(pos)
+                if level is not None:
+                    by_level.setdefault((skill, level), []).append(pos)
+        self._by_skill = {s: tuple(p) for s, p in by_skill.items()}
+        self._by_level = {k: tuple(p) for k, p in by_level.items()}
+
+    @staticmethod
+    def _answer_index(choices, answer):
+        if not choices:
+            return None
+        key = str(answer).strip().upper()
+        return next((i for i, (label, _) in enumerate(choices) if label == key), None)
+
+    def __len__(self):
+        return len(self._records)
+
+    def has(self, skill):
+        return str(skill) in self._by_skill
+
+    def positions(self, skill, level=None):
+        """Row positions of the questions of skill (optionally only one difficulty level)."""
+        if level is None:
+            return self._by_skill.get(str(skill), ())
+        return self._by_level.get((str(skill), level), ())
+
+    def clad_pool(self, skill, level=None, keep=None):
+        """
+        (positions, level used) for a CLAD pick: the first non-empty bucket along CLAD_FALLBACK[level],
+        else every question of skill (level None). keep(pos): extra filter, e.g. not answered yet.
+        """
+        for lv in CLAD_FALLBACK.get(level, ()):
+            pool = [p for p in self.positions(skill, lv) if keep is None or keep(p)]
+            if pool:
+                return pool, lv
+        return [p for p in self.positions(skill) if keep is None or keep(p)], None
+
+    def question_ids_for(self, skill):
+        return {self.question_ids[p] for p in self.positions(skill)}
+
+    def record(self, pos):
+        """Row as a new dict (+ parsed_skills, option_list)."""
+        row = dict(self._records[pos])
+        row["parsed_skills"] = list(self.skills[pos])
+        row["option_list"] = list(self.options[pos])
+        return row
+
+
+# ============================================================
+# 🗂️ PROCESS CACHE (one index per subject, latest content_version)
+# ============================================================
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_question_index(subject_id=None, q_df=None):
+    """
+    Index of subject_id's questions; rebuilt only when its content_version changes.
+    q_df: question table the caller already holds (e.g. from the test packet), used instead of a DB read on rebuild.
+    """
+    version = get_content_version(subject_id)
+    index = _indexes.get(subject_id)
+    if index is not None and index.content_version == version:
+        return index
+    with _indexes_lock:
+        index = _indexes.get(subject_id)
+        if index is None or index.content_version != version:
+            if q_df is None:
+                q_df = get_all_questions(subject_id)
+            index = QuestionIndex(q_df, subject_id, version)
+            _indexes[subject_id] = index
+    return index
+
+
+def as_question_index(q_matrix):
+    """Accepts a QuestionIndex or a question DataFrame (indexed on the fly: prefer passing the index)."""
+    if isinstance(q_matrix, QuestionIndex):
+        return q_matrix
+    return QuestionIndex(q_matrix)
@@ -0,0 +1,119 @@
+"""
+Spaced-repetition review scheduling (due-time min-heap).
+
+Every progress row gets a due time, persisted in user_progress.due_at:
+'Review' / 'In Progress' rows are due from their last update; mastered rows
+(Done / Mastered / Completed) are due on the first day the forgetting curve
+S0 * (1 - alpha)^days drops below the threshold - the day decay would flag
+them 'Review'. The next reviews are then the rows with the earliest due_at:
+
+    queue = get_review_queue(mastery_store, threshold)   # heap, kept in sync by store.apply()
+    queue.due(3)             # [(node_id, status, score)] due now, most overdue first, O(k log N)
+    queue.due_at("1.2")
+
+get_smart_recommendations() reads the same order straight off the
+(username, subject_id, due_at) index when there is no session store.
+"""
+import heapq
+import math
+from datetime import datetime, timedelta
+
+from decay_engine import DEFAULT_THRESHOLD, DECAY_RATE
+
+MASTERED_STATUSES = ("Done", "Mastered", "Completed")
+
+
+def as_datetime(ts):
+    """DB timestamp (datetime, or ISO text on SQLite) -> naive datetime; None if unreadable."""
+    if isinstance(ts, datetime):
+        return ts.replace(tzinfo=None) if ts.tzinfo else ts
+    try:
+        dt = datetime.fromisoformat(str(ts))
+    except (TypeError, ValueError):
+        return None
+    return dt.replace(tzinfo=None) if dt.tzinfo else dt
+
+
+def days_until_review(score, threshold=DEFAULT_THRESHOLD, decay_rate=DECAY_RATE):
+    """Whole days until S0 * (1 - alpha)^days < threshold (0 if already below)."""
+    if score is None or score < threshold or score <= 0 or not 0 < decay_rate < 1:
+        return 0
+    return math.floor(math.log(threshold / score) / math.log(1 - decay_rate)) + 1
+
+
+def review_due_at(status, score, timestamp, threshold=DEFAULT_THRESHOLD, decay_rate=DECAY_RATE):
+    """Due time of one progress row (None if its timestamp is unreadable)."""
+    ts = as_datetime(timestamp)
+    if ts is None:
+        return None
+    if status in MASTERED_STATUSES:
+        return ts + timedelta(days=days_until_review(score, threshold, decay_rate))
+    return ts
+
+
+class ReviewQueue:
+    """
+    Due-time min-heap over one user's progress (e.g. a MasteryStore: .scores / .statuses / .timestamps).
+    Stale heap entries are dropped lazily, as in SkillFrontier.
+    """
+
+    def __init__(self, store, threshold=DEFAULT_THRESHOLD, decay_rate=DECAY_RATE):
+        self.store = store
+        self.threshold = threshold
+        self.decay_rate = decay_rate
+        self._due = {}   # node_id -> due_at
+        self._heap = []  # (due_at, node_id)
+        for node in store.scores:
+            due = self._compute(node)
+            if due is not None:
+                self._due[node] = due
+                self._heap.append((due, node))
+        heapq.heapify(self._heap)
+
+    def _compute(self, node):
+        return review_due_at(self.store.statuses.get(node), self.store.scores.get(node),
+                             self.store.timestamps.get(node), self.threshold, self.decay_rate)
+
+    def update(self, node):
+        """node was graded / decayed / penalized: reschedule it (O(log N))."""
+        due = self._compute(node)
+        if due is None:
+            self._due.pop(node, None)
+        elif self._due.get(node) != due:
+            self._due[node] = due
+            heapq.heappush(self._heap, (due, node))
+
+    def due_at(self, node):
+        return self._due.get(node)
+
+    def due(self, k=3, now=None):
+        """Up to k nodes due at `now`, most overdue first: [(node_id, status, score)]."""
+        now = now or datetime.now()
+        found, popped, seen = [], [], set()
+        while self._heap and len(found) < k:
+            item = heapq.heappop(self._heap)
+            due, node = item
+            if self._due.get(node) != due or node in seen:
+                continue  # Rescheduled since: newer entry is elsewhere in the heap
+            seen.add(node)
+            popped.append(item)
+            if due > now:
+                break
+            found.append((node, self.store.statuses.get(node), self.store.scores.get(node, 0.0)))
+        for item in popped:
+            heapq.heappush(self._heap, item)
+        return found
+
+    def __len__(self):
+        return len(self._due)
+
+
+def get_review_queue(mastery_store, threshold=DEFAULT_THRESHOLD):
+    """ReviewQueue attached to the session store (store.apply() keeps it in sync)."""
+    key = ("review", threshold)
+    queue = mastery_store.derived.get(key)
+    if queue is None:
+        for old in [k for k in mastery_store.derived if k[0] == "review"]:
+            del mastery_store.derived[old]
+        queue = mastery_store.derived[key] = ReviewQueue(mastery_store, threshold)
+    return queue
@@ -0,0 +1,114 @@
+"""
+Incremental "strict tree" recommender.
+
+The frontier is every node that has questions, is below the mastery threshold,
+and whose parents with questions are all mastered. recommend_next_skill_strict
+returns its node with the lowest topological rank. SkillFrontier keeps that set
+in a heap keyed by topological rank:
+
+    frontier = SkillFrontier(graph, question_index, store.scores, threshold)
+    frontier.next()          # O(log N)
+    frontier.peek(2)         # next + next-next
+    frontier.update("1.2")   # score of 1.2 changed: O(degree · log N)
+
+Building it is O(N + E). MasteryStore keeps attached frontiers in sync, so
+grading and decay never trigger a full walk of the topological order.
+"""
+import heapq
+
+
+def explain_choice(node, user_mastery, parents):
+    """XAI: (reason_code, reason_desc) for recommending node."""
+    score = user_mastery.get(node, 0.0)
+    if score > 0:
+        return "DECAY", f"Kiến thức đang bị hao mòn ({score:.0%}). Cần ôn tập lại ngay!"
+    if parents:
+        # Check if parents are strongly mastered
+        strong_parents = [p for p in parents if user_mastery.get(p, 0) >= 0.8]
+        if len(strong_parents) == len(parents):
+            return "NEW", "Bạn đã nắm vững kiến thức nền. Đã sẵn sàng học bài mới!"
+        return "NEW", "Đã đủ điều kiện qua môn. Tiếp tục tiến lên!"
+    return "NEW", "Bắt đầu hành trình với bài học đầu tiên."
+
+
+class SkillFrontier:
+    def __init__(self, graph, question_index, scores, threshold):
+        self.graph = graph
+        self.q_index = question_index
+        self.scores = scores          # Live {node: score} (e.g. MasteryStore.scores)
+        self.threshold = threshold
+        self._rank = {node: r for r, node in enumerate(graph.topo_order)}
+        self._members = set()
+        self._heap = []               # (rank, node); stale entries are dropped lazily
+        for node in graph.topo_order:
+            if self._eligible(node):
+                self._members.add(node)
+                self._heap.append((self._rank[node], node))
+        heapq.heapify(self._heap)
+
+    def _eligible(self, node):
+        if not self.q_index.has(node):
+            return False
+        if self.scores.get(node, 0.0) >= self.threshold:
+            return False
+        # Locked while a parent that has questions is not mastered yet
+        for p in self.graph.parents(node):
+            if self.q_index.has(p) and self.scores.get(p, 0.0) < self.threshold:
+                return False
+        return True
+
+    def _refresh(self, node):
+        if self._eligible(node):
+            if node not in self._members:
+                self._members.add(node)
+                heapq.heappush(self._heap, (self._rank[node], node))
+        else:
+            self._members.discard(node)
+
+    def update(self, node):
+        """node's score changed: re-check it and the children it may (un)lock."""
+        if node not in self._rank:
+            return
+        self._refresh(node)
+        for child in self.graph.children(node):
+            self._refresh(child)
+
+    def peek(self, k=1, exclude=None):
+        """Up to k frontier nodes in learning-path order (O(k log N))."""
+        found, popped, seen = [], [], set()
+        while self._heap and len(found) < k:
+            item = heapq.heappop(self._heap)
+            node = item[1]
+            if node not in self._members or node in seen:
+                continue  # Left the frontier, or a duplicate push
+            seen.add(node)
+            popped.append(item)
+            if node != exclude:
+                found.append(node)
+        for item in popped:
+            heapq.heappush(self._heap, item)
+        return found
+
+    def next(self, exclude=None):
+        nodes = self.peek(1, exclude=exclude)
+        return nodes[0] if nodes else None
+
+    def __len__(self):
+        return len(self._members)
+
+    def recommend(self, exclude_id=None):
+        """Same contract as recommend_next_skill_strict: (target_skill, strategy, debug_log)."""
+        target = self.next(exclude=exclude_id)
+        debug_log = [f"🧭 Vùng biên: {len(self._members)} node đã mở khóa, chưa thành thạo."]
+        if target is None:
+            return None, {"reason_code": "COMPLETED", "reason_desc": "Hoàn thành xuất sắc!"}, debug_log
+
+        reason_code, reason_desc = explain_choice(target, self.scores, self.graph.parents(target))
+        strat = {
+            "name": "Strict Tree",
+            "reason_code": reason_code,
+            "reason_desc": reason_desc,
+            "current_score": self.scores.get(target, 0.0)
+        }
+        debug_log.append(f"🎯 CHỌN: {target} (Lý do: {reason_code})")
+        return target, strat, debug_log
@@ -0,0 +1,209 @@
+"""
+Compiled, immutable index of one subject's knowledge graph.
+
+Built once per (subject_id, content_version) and shared by every session in
+the process, so graph queries are O(degree) lookups instead of O(E) scans of
+the knowledge_structure DataFrame:
+
+    g = get_subject_graph(subject_id)
+    g.parents("1.2")            # same order as the edge table
+    g.children("1.2")
+    g.topo_order                # lexicographic (min-heap) topological order
+    g.nodes_in_chapters([1, 3]) # chapter membership ("1.x" / "Chg1")
+    g.depth("1.2")              # longest path from a root
+"""
+import heapq
+import re
+import threading
+from array import array
+
+from db_utils import get_graph_structure, get_content_version
+
+_CHAPTER_DOT_RE = re.compile(r"^(\d+)\.")
+_DIGITS_RE = re.compile(r"\d+")
+
+
+def chapter_number(node_id):
+    """Chapter of a node id: "3.1_X" -> 3, "Chg2" -> 2, else None."""
+    m = _CHAPTER_DOT_RE.match(node_id)
+    if m:
+        return int(m.group(1))
+    if node_id.startswith("Chg"):
+        m = _DIGITS_RE.search(node_id)
+        if m:
+            return int(m.group(0))
+    return None
+
+
+def _csr(n, pairs):
+    """(row, col) int pairs -> (ptr, idx) arrays; keeps input order within a row."""
+    counts = [0] * (n + 1)
+    for r, _ in pairs:
+        counts[r + 1] += 1
+    for i in range(n):
+        counts[i + 1] += counts[i]
+    ptr = array("i", counts)
+    idx = array("i", bytes(4 * len(pairs)))
+    fill = list(counts[:n])
+    for r, c in pairs:
+        idx[fill[r]] = c
+        fill[r] += 1
+    return ptr, idx
+
+
+class SubjectGraph:
+    """Read-only after construction: safe to share between sessions/threads."""
+
+    def __init__(self, edges, subject_id=None, content_version=None):
+        self.subject_id = subject_id
+        self.content_version = content_version
+
+        # --- Intern node ids (first-seen order) ---
+        index = {}
+        pairs = []
+        seen = set()
+        for src, tgt in edges:
+            src, tgt = str(src), str(tgt)
+            u = index.setdefault(src, len(index))
+            v = index.setdefault(tgt, len(index))
+            if (u, v) not in seen:  # Duplicate rows in knowledge_structure
+                seen.add((u, v))
+                pairs.append((u, v))
+        self.ids = tuple(index)
+        self.index = index
+        n = len(self.ids)
+        self.edge_count = len(pairs)
+
+        # --- CSR adjacency ---
+        self._child_ptr, self._child_idx = _csr(n, pairs)
+        self._parent_ptr, self._parent_idx = _csr(n, [(v, u) for u, v in pairs])
+
+        # --- Topological order (Kahn + min-heap on the id: same order as before) ---
+        in_degree = [self._parent_ptr[i + 1] - self._parent_ptr[i] for i in range(n)]
+        heap = [self.ids[i] for i in range(n) if in_degree[i] == 0]
+        heapq.heapify(heap)
+        order = []
+        while heap:
+            u = index[heapq.heappop(heap)]
+            order.append(u)
+            for k in range(self._child_ptr[u], self._child_ptr[u + 1]):
+                v = self._child_idx[k]
+                in_degree[v] -= 1
+                if in_degree[v] == 0:
+                    heapq.heappush(heap, self.ids[v])
+        if len(order) < n:  # Cycle: the leftovers go last, sorted
+            placed = set(order)
+            order.extend(sorted((i for i in range(n) if i not in placed), key=self.ids.__getitem__))
+        self.topo_order = tuple(self.ids[i] for i in order)
+
+        # --- Depth levels (longest path from a root, along the topo order) ---
+        # Only forward edges count: in a cycle a back edge would grow depth forever
+        pos = array("i", bytes(4 * n))
+        for p, u in enumerate(order):
+            pos[u] = p
+        depth = array("i", bytes(4 * n))
+        for u in order:
+            for k in range(self._child_ptr[u], self._child_ptr[u + 1]):
+                v = self._child_idx[k]
+                if pos[u] < pos[v] and depth[v] < depth[u] + 1:
+                    depth[v] = depth[u] + 1
+        self._depth = depth
+        levels = {}
+        for i in order:
+            levels.setdefault(depth[i], []).append(self.ids[i])
+        self.levels = tuple(tuple(levels[d]) for d in sorted(levels))
+
+        # --- Chapter membership ---
+        chapters = {}
+        self._chapter = {}
+        for node_id in self.ids:
+            chap = chapter_number(node_id)
+            if chap is not None:
+                self._chapter[node_id] = chap
+                chapters.setdefault(chap, []).append(node_id)
+        self.chapter_nodes = {c: frozenset(ns) for c, ns in chapters.items()}
+        self.chapters = tuple(sorted(chapters))
+
+    @classmethod
+    def from_df(cls, k_df, subject_id=None, content_version=None):
+        if k_df is None or k_df.empty:
+            return cls([], subject_id, content_version)
+        return cls(zip(k_df["source"].tolist(), k_df["target"].tolist()), subject_id, content_version)
+
+    # --- lookups (O(1) / O(degree)) ---
+    @property
+    def nodes(self):
+        return self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, node_id):
+        return str(node_id) in self.index
+
+    def parents(self, node_id):
+        i = self.index.get(str(node_id))
+        if i is None: return []
+        return [self.ids[j] for j in self._parent_idx[self._parent_ptr[i]:self._parent_ptr[i + 1]]]
+
+    def children(self, node_id):
+        i = self.index.get(str(node_id))
+        if i is None: return []
+        return [self.ids[j] for j in self._child_idx[self._child_ptr[i]:self._child_ptr[i + 1]]]
+
+    def in_degree(self, node_id):
+        i = self.index.get(str(node_id))
+        return 0 if i is None else self._parent_ptr[i + 1] - self._parent_ptr[i]
+
+    def depth(self, node_id):
+        i = self.index.get(str(node_id))
+        return None if i is None else self._depth[i]
+
+    def chapter_of(self, node_id):
+        return self._chapter.get(str(node_id))
+
+    def nodes_in_chapters(self, chapters):
+        result = set()
+        for c in chapters:
+            result.update(self.chapter_nodes.get(c, ()))
+        return result
+
+    def edges(self):
+        """(source, target) pairs, deduplicated, grouped by source."""
+        for u in range(len(self.ids)):
+            for k in range(self._child_ptr[u], self._child_ptr[u + 1]):
+                yield self.ids[u], self.ids[self._child_idx[k]]
+
+
+# ============================================================
+# 🗂️ PROCESS CACHE (one graph per subject, latest content_version)
+# ============================================================
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+def get_subject_graph(subject_id=None, k_df=None):
+    """
+    Compiled graph of subject_id (None = all subjects); rebuilt only when its content_version changes.
+    k_df: edge table the caller already holds (e.g. from the test packet), used instead of a DB read on rebuild.
+    """
+    version = get_content_version(subject_id)
+    graph = _graphs.get(subject_id)
+    if graph is not None and graph.content_version == version:
+        return graph
+    with _graphs_lock:
+        graph = _graphs.get(subject_id)
+        if graph is None or graph.content_version != version:
+            if k_df is None:
+                k_df = get_graph_structure(subject_id)
+            graph = SubjectGraph.from_df(k_df, subject_id, version)
+            _graphs[subject_id] = graph
+    return graph
+
+
+def as_subject_graph(k_graph):
+    """Accepts a SubjectGraph or an edge DataFrame (compiled on the fly: prefer passing the graph)."""
+    if isinstance(k_graph, SubjectGraph):
+        return k_graph
+    return SubjectGraph.from_df(k_graph)
@@ -3,7 +3,9 @@ import pandas as pd
 import streamlit as st
 from datetime import datetime
 import os
-from db_utils import get_connection
+from db_utils import get_connection, write_logs
+from db_migrations import add_column
+from review_scheduler import review_due_at
 import warnings
 
 # Suppress pandas UserWarning about DBAPI2 connection
@@ -56,8 +58,10 @@ def init_local_db():
             status TEXT, 
             score REAL, 
             timestamp DATETIME,
+            due_at DATETIME,
             PRIMARY KEY (username, node_id, subject_id)
         )''')
+    add_column(conn, "user_progress", "due_at", "DATETIME")  # Caches created before review scheduling
         
     # 4. Learning Logs
     c.execute('''
@@ -230,20 +234,27 @@ def sync_down(username, subject_id="MayHoc", skip_static=False):
         sb_conn.close()
         local_conn.close()
 
+def progress_due_at(row):
+    """due_at of a synced progress row: the source row's, else recomputed (review_scheduler)."""
+    due = row.get('due_at')
+    if due is None or pd.isna(due):
+        return review_due_at(row['status'], row['score'], row['timestamp'])
+    return due
+
 def upsert_sqlite_progress(table, conn, keys, data_iter):
     """Custom upsert for User Progress."""
-    for row in data_iter:
-        # keys correspond to df columns. 
-        # structure: username, node_id, subject_id, status, score, timestamp
-        # row is a tuple of values
+    for values in data_iter:
+        # keys correspond to df columns (cloud: username, node_id, subject_id, status, score, timestamp, due_at)
+        row = dict(zip(keys, values))
         
         # SQLite UPSERT syntax
         conn.execute("""
-            INSERT INTO user_progress (username, node_id, subject_id, status, score, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT INTO user_progress (username, node_id, subject_id, status, score, timestamp, due_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
             ON CONFLICT(username, node_id, subject_id) DO UPDATE SET
-            status=excluded.status, score=excluded.score, timestamp=excluded.timestamp
-        """, row)
+            status=excluded.status, score=excluded.score, timestamp=excluded.timestamp, due_at=excluded.due_at
+        """, (row['username'], row['node_id'], row['subject_id'], row['status'], row['score'], row['timestamp'],
+              progress_due_at(row)))
 
 def upsert_sqlite_settings(table, conn, keys, data_iter):
     for row in data_iter:
@@ -276,14 +287,16 @@ def sync_up(username):
         count = 0
         for _, row in l_df.iterrows():
             sb_c.execute("""
-                INSERT INTO user_progress (username, node_id, subject_id, status, score, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s)
+                INSERT INTO user_progress (username, node_id, subject_id, status, score, timestamp, due_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
                 ON CONFLICT (username, node_id, subject_id)
                 DO UPDATE SET
                     status    = EXCLUDED.status,
                     score     = EXCLUDED.score,
-                    timestamp = GREATEST(user_progress.timestamp, EXCLUDED.timestamp) 
-            """, (row['username'], row['node_id'], row['subject_id'], row['status'], row['score'], row['timestamp']))
+                    timestamp = GREATEST(user_progress.timestamp, EXCLUDED.timestamp),
+                    due_at    = EXCLUDED.due_at
+            """, (row['username'], row['node_id'], row['subject_id'], row['status'], row['score'], row['timestamp'],
+                  progress_due_at(row)))
             # GREATEST logic: keep latest timestamp? 
             # Actually, standard logic is just overwrite if we assume Local is 'Working Copy'. 
             # But let's use standard DO UPDATE SET...
@@ -310,10 +323,12 @@ def sync_up(username):
             """, (username, row['question_id'], row['timestamp']))
             
             if not sb_c.fetchone():
-                sb_c.execute("""
-                    INSERT INTO learning_logs (username, action_type, subject_id, node_id, question_id, is_correct, timestamp)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """, (username, row['action_type'], row['subject_id'], row['node_id'], row['question_id'], int(row['is_correct']), row['timestamp']))
+                # Same row as the local log (INSERT_LOG_SQL order); write_logs keeps the cloud
+                # question_attempt_stats in step, same transaction
+                log_row = tuple(None if pd.isna(v) else v for v in (
+                    username, row['action_type'], row['subject_id'], row['node_id'], row['question_id'],
+                    int(row['is_correct']), row.get('duration_seconds', 0.0), row.get('details'), row['timestamp']))
+                write_logs(sb_conn, [log_row])
                 log_count += 1
                 
         sb_conn.commit()
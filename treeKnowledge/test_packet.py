@@ -0,0 +1,141 @@
+"""
+Test packet: a compiled per-subject content bundle (questions + graph).
+
+generate_packet() reads the subject from the DB once and writes
+<PACKET_DIR>/<subject>.packet.json.gz:
+
+    {"format": 1, "subject_id": ..., "content_version": 3, "hash": "<sha256>",
+     "built_at": ..., "questions": {qid: {"c", "o", "a", "d", "s", "e"}},
+     "graph": {"edges": [[src, tgt], ...], "nodes": [...]}}
+
+load_packet() is a single file read. The packet is only trusted while its
+content_version matches the subject's current one (get_content_version, served
+from the shared cache) and its payload still hashes to the stored "hash"; a
+stale, corrupted or missing packet is rebuilt from the DB.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+from datetime import datetime
+
+from db_utils import get_connection, execute_query, get_content_version, ALL_SUBJECTS
+
+PACKET_FORMAT = 2
+PACKET_DIR = os.environ.get(
+    "TEST_PACKET_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge", "packets"),
+)
+
+
+def packet_path(subject_id):
+    safe = re.sub(r"[^\w.-]", "_", str(subject_id))
+    return os.path.join(PACKET_DIR, f"{safe}.packet.json.gz")
+
+
+def _content_hash(questions, graph):
+    canonical = json.dumps({"questions": questions, "graph": graph}, sort_keys=True,
+                           ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _none_to_empty(v):
+    return "" if v is None else v
+
+
+def build_packet(subject_id):
+    """Reads the subject's questions + graph (one connection) into the packet dict."""
+    conn = get_connection()
+    if not conn: return None
+    try:
+        # Version first: if an edit lands in between, the packet is newer than its
+        # version says and simply gets rebuilt on the next load (never the reverse)
+        c = execute_query(conn, "SELECT version FROM content_versions WHERE subject_id = %s", (subject_id or ALL_SUBJECTS,))
+        row = c.fetchone()
+        version = row[0] if row else 0
+
+        c = execute_query(conn, """
+            SELECT question_id, content, options, answer, difficulty, skill_id_list, explanation
+            FROM questions WHERE subject_id = %s ORDER BY question_id
+        """, (subject_id,))
+        questions = {
+            str(qid): {"c": _none_to_empty(content), "o": _none_to_empty(options), "a": _none_to_empty(answer),
+                       "d": _none_to_empty(diff), "s": _none_to_empty(skills), "e": _none_to_empty(expl)}
+            for qid, content, options, answer, diff, skills, expl in c.fetchall()
+        }
+
+        c = execute_query(conn, "SELECT source, target FROM knowledge_structure WHERE subject_id = %s", (subject_id,))
+        # Same rows, same order as get_graph_structure(): SubjectGraph/layout follow first-seen edge order
+        edges = [(str(s).strip(), str(t).strip()) for s, t in c.fetchall()]
+    finally:
+        conn.close()
+
+    nodes = sorted({n for e in edges for n in e})
+    graph = {"edges": [list(e) for e in edges], "nodes": nodes}
+    return {
+        "format": PACKET_FORMAT,
+        "subject_id": subject_id,
+        "content_version": version,
+        "hash": _content_hash(questions, graph),
+        "built_at": datetime.now().isoformat(timespec="seconds"),
+        "questions": questions,
+        "graph": graph,
+    }
+
+
+def write_packet(packet):
+    """Atomic write (tmp file + rename): readers never see a half-written packet."""
+    os.makedirs(PACKET_DIR, exist_ok=True)
+    path = packet_path(packet["subject_id"])
+    fd, tmp = tempfile.mkstemp(dir=PACKET_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6, mtime=0) as gz:
+            gz.write(json.dumps(packet, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    return path
+
+
+def read_packet(subject_id):
+    path = packet_path(subject_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        with gzip.open(path, "rb") as f:
+            packet = json.loads(f.read().decode("utf-8"))
+    except Exception as e:
+        print(f"⚠️ Test packet unreadable ({path}): {e}")
+        return None
+    if packet.get("format") != PACKET_FORMAT or packet.get("subject_id") != subject_id:
+        return None
+    if packet.get("hash") != _content_hash(packet.get("questions"), packet.get("graph")):
+        print(f"⚠️ Test packet hash mismatch ({path}): corrupted or edited, ignored")
+        return None
+    return packet
+
+
+def generate_packet(subject_id):
+    """Builds + writes the packet. Returns (packet, path)."""
+    packet = build_packet(subject_id)
+    if packet is None:
+        return None, None
+    return packet, write_packet(packet)
+
+
+def load_packet(subject_id, rebuild_if_stale=True):
+    """Fresh packet for subject_id, or None (caller falls back to the DB queries)."""
+    packet = read_packet(subject_id)
+    if packet is not None and packet.get("content_version") == get_content_version(subject_id):
+        return packet
+    if not rebuild_if_stale:
+        return None
+    try:
+        packet, _ = generate_packet(subject_id)
+        return packet
+    except Exception as e:
+        print(f"⚠️ Test packet rebuild failed ({subject_id}): {e}")
+        return None